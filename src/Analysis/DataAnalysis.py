@@ -1,7 +1,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import os
-import re
+from PyLab.FitCatalog import FitCatalog
 
 
 ###############################
@@ -9,55 +8,42 @@ import re
 ###############################
 
 
-def get_fit_data(working_directories, key_str="Qi", attenuation=-66):
+def get_fit_data(working_directories, key_str="Qi", attenuation=-66, catalog=None):
+    """
+    Get fit results over the power at the chip
+
+    :param working_directories: directories of the fits
+    :param key_str: key of the fit results, or a list of keys (all are read at once)
+    :param attenuation: attenuation of the input line if the directory name does not contain it (legacy .fit files)
+    :param catalog: FitCatalog or path of a catalog file to read from. If None, the .fit files of the working directories
+                    are read into a temporary catalog.
+    :return: powers and values of the key (a list of values for each key, if key_str is a list), sorted by power
+    """
 
     #############################################
     ##### Core - doesn't need to be changed #####
     #############################################
 
+    if catalog is None:
+        catalog = FitCatalog(":memory:")
+        catalog.rebuild(working_directories, attenuation=attenuation)
+        directories = None
+    else:
+        catalog = FitCatalog(catalog) if not isinstance(catalog, FitCatalog) else catalog
+        directories = working_directories
 
-    power_data = {}
-
-
-    for directory in working_directories:
-
-        match = re.search('((-)?\d+)dBm', directory)
-        if match:
-            attenuation = int(match.group(1))
-        else:
-            print("no match - assuming attenuation to -70")
-            pass
-
-        for filename in os.listdir(directory):
-            if filename.endswith(".fit"):
-                match = re.search('_((-)?\d+)dBm', filename)
-                if not match:
-                    continue
-                power = int(match.group(1))
-
-                dict = {}
-
-                with open(f"{directory}/{filename}") as file:
-                    for line in file:
-                        sub = line.split("\t")
-                        dict[sub[0]] = float(sub[1])
-
-                power_data[power+attenuation] = dict
-
-
-    power = []
-    key_arr = []
-
-    for key, dict in power_data.items():
-        if key < -200 or key > -70:
-            continue
-        power.append(key)
-        key_arr.append(dict[key_str])
+    keys = [key_str] if isinstance(key_str, str) else list(key_str)
+    data = catalog.get(keys, directories=directories, min_power=-200, max_power=-70)
 
-    key_arr_sorted = [key_arr for _, key_arr in sorted(zip(power, key_arr))]
-    power = sorted(power)
+    # several fits at the same power: the latest one is used (sorted by time within a power)
+    power, last = np.unique(data["chip_power"][::-1], return_index=True)
+    last = len(data["chip_power"]) - 1 - last
+    if len(last) < len(data["chip_power"]):
+        print(f"{len(data['chip_power']) - len(last)} fit(s) replaced by a later fit at the same power")
 
-    return power, key_arr_sorted
+    power = [int(p) if float(p).is_integer() else p for p in power]
+    values = [data[key][last].tolist() for key in keys]
+    return (power, values[0]) if isinstance(key_str, str) else (power, values)
 
 
 # x_pre, y_pre, y_err_pre = get_res_data([f"/Users/niklas/Documents/Studium/MasterThesis/XLD/NB/B25-2v2/-10dBm_warm_detailed/Res1", f"/Users/niklas/Documents/Studium/MasterThesis/XLD/NB/B25-2v2/-60dBm_warm_detailed/Res1"], -60, 1e5)
@@ -71,8 +57,7 @@ def get_fit_data(working_directories, key_str="Qi", attenuation=-66):
 #
 #     save_path = f"/home/measure/from windows PC/Measurements/Results/NB/P8-1/full_sweep_-70dBm/Res{res_id}"
 #
-#     pow, q_i = get_fit_data([f"/home/measure/from windows PC/Measurements/Results/NB/P8-1/full_sweep_-70dBm/Res{res_id}"], "Qi")
-#     pow, q_i_err = get_fit_data([f"/home/measure/from windows PC/Measurements/Results/NB/P8-1/full_sweep_-70dBm/Res{res_id}"], "Qi_err")
+#     pow, (q_i, q_i_err) = get_fit_data([f"/home/measure/from windows PC/Measurements/Results/NB/P8-1/full_sweep_-70dBm/Res{res_id}"], ["Qi", "Qi_err"])
 #     # print(len(pow))
 #     plt.figure(0)
 #     plt.errorbar(pow, q_i, q_i_err)
@@ -0,0 +1,680 @@
+import asyncio
+import numpy as np
+import logging
+import time
+from contextlib import asynccontextmanager
+import pyvisa
+from PyLab.Measurement import Measurement, merge_measurements, split_data
+from PyLab.SCPITools import query_complex_data, BINARY_FORMATS, get_completion, get_segments, join_commands, \
+    InstrumentState
+
+
+"""
+asyncio versions of the PNA driver and the VNA frontend. Waiting for a sweep or a data transfer does not block the event
+loop, so several instruments can sweep in parallel from one controller, e.g.
+
+    async with await AsyncVNA.open('TCPIP0::10.1.1.32::5025::SOCKET') as vna1, \\
+            await AsyncVNA.open('TCPIP0::10.1.1.25::5025::SOCKET') as vna2:
+        await vna1.set_measurement(measurement1)
+        await vna2.set_measurement(measurement2)
+        await asyncio.gather(vna1.measure(), vna2.measure())
+
+Raw socket addresses (...::SOCKET, also SimSCPIServer) are read with asyncio streams, other VISA addresses (e.g. VXI-11
+...::inst0::INSTR) go through pyvisa in a worker thread.
+"""
+
+
+async def open_transport(address, timeout=5.):
+    """
+    Connect to an instrument
+
+    :param address: VISA resource name, e.g. TCPIP0::10.1.1.32::5025::SOCKET or TCPIP0::10.1.1.32::inst0::INSTR
+    :param timeout: default timeout of a query in s
+    :return: the connected SocketTransport or VisaTransport
+    """
+    parts = address.split("::")
+    if parts[-1].upper() == "SOCKET":
+        transport = SocketTransport(parts[1], int(parts[2]), timeout)
+    else:
+        transport = VisaTransport(address, timeout)
+    await transport.connect()
+    return transport
+
+
+class SocketTransport:
+    """
+    SCPI over a raw TCP socket (port 5025 of most instruments) with asyncio streams. Messages are terminated by a
+    newline, binary blocks are read by their IEEE 488.2 length header.
+    """
+
+    def __init__(self, host, port, timeout=5.):
+        """
+        :param host: host name or IP address of the instrument
+        :param port: TCP port, usually 5025
+        :param timeout: default timeout of a query in s
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        # a query and its answer must not be interleaved with other messages
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        # an ASCII trace is a single line of up to a few MB
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port,
+                                                                                    limit=2**28), self.timeout)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = None
+
+    async def clear(self):
+        """
+        Discard unread answers by reconnecting, e.g. after a failed transfer
+        """
+        async with self._lock:
+            await self.close()
+            await self.connect()
+
+    async def write(self, message):
+        """
+        :param message: SCPI program message
+        """
+        async with self._lock:
+            await self._send(message)
+
+    async def query(self, message, timeout=None):
+        """
+        :param message: SCPI program message with a query
+        :param timeout: timeout in s, by default the one of the transport
+        :return: the answer without termination
+        """
+        async with self._lock:
+            await self._send(message)
+            line = await asyncio.wait_for(self._reader.readline(), timeout or self.timeout)
+        if not line.endswith(b"\n"):
+            raise ConnectionError(f"connection to {self.host}:{self.port} closed")
+        return line.decode().strip()
+
+    async def query_complex(self, message, data_format="ASCII", timeout=None):
+        """
+        Query complex-valued trace data, see SCPITools.query_complex_data
+
+        :param message: SCPI query, e.g. "CALCulate:DATA? SDATa"
+        :param data_format: "REAL,64" or "REAL,32" for a little-endian binary block, "ASCII" for comma separated values
+        :param timeout: timeout in s, by default the one of the transport
+        :return: complex-valued np array
+        """
+        if data_format not in BINARY_FORMATS:
+            data = np.array((await self.query(message, timeout)).split(","), dtype=float)
+            return data[0::2] + 1j*data[1::2]
+
+        async with self._lock:
+            await self._send(message)
+            payload = await asyncio.wait_for(self._read_block(), timeout or self.timeout)
+        # one copy makes the buffer writable
+        return np.frombuffer(payload, dtype="<" + BINARY_FORMATS[data_format]).astype(np.float64).view(np.complex128)
+
+    # Utility methods
+
+    async def _send(self, message):
+        self._writer.write((message + "\n").encode())
+        await self._writer.drain()
+
+    async def _read_block(self):
+        """
+        Read a definite length block #<number of digits><length><payload> and the termination
+        """
+        start = await self._reader.readexactly(2)
+        if start[:1] != b"#" or not start[1:].isdigit() or start[1:] == b"0":
+            # the rest of the answer is read, so that the next query gets its own answer
+            rest = await self._reader.readline()
+            raise ValueError(f"no binary block: {(start + rest)[:50]!r}")
+        length = int(await self._reader.readexactly(int(start[1:])))
+        payload = await self._reader.readexactly(length)
+        await self._reader.readline()
+        return payload
+
+
+class VisaTransport:
+    """
+    SCPI over any VISA resource (e.g. VXI-11 or HiSLIP), the blocking pyvisa calls run in a worker thread
+    """
+
+    def __init__(self, address, timeout=5.):
+        """
+        :param address: VISA resource name
+        :param timeout: default timeout of a query in s
+        """
+        self.address = address
+        self.timeout = timeout
+        self._resource = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        self._resource = await asyncio.to_thread(pyvisa.ResourceManager().open_resource, self.address,
+                                                 timeout=self.timeout*1000)
+        if self.address.upper().endswith('::SOCKET'):
+            # raw sockets have no end-of-message indicator
+            self._resource.read_termination = '\n'
+            self._resource.write_termination = '\n'
+
+    async def close(self):
+        if self._resource is not None:
+            await asyncio.to_thread(self._resource.close)
+            self._resource = None
+
+    async def clear(self):
+        async with self._lock:
+            await asyncio.to_thread(self._resource.clear)
+
+    async def write(self, message):
+        async with self._lock:
+            await asyncio.to_thread(self._resource.write, message)
+
+    async def query(self, message, timeout=None):
+        async with self._lock:
+            return (await asyncio.to_thread(self._call, self._resource.query, timeout, message)).strip()
+
+    async def query_complex(self, message, data_format="ASCII", timeout=None):
+        async with self._lock:
+            return await asyncio.to_thread(self._call, query_complex_data, timeout, self._resource, message,
+                                           data_format)
+
+    # Utility methods
+
+    def _call(self, function, timeout, *args):
+        """
+        Call a pyvisa function with a temporary timeout (runs in the worker thread)
+        """
+        old_timeout = self._resource.timeout
+        self._resource.timeout = (timeout or self.timeout)*1000
+        try:
+            return function(*args)
+        finally:
+            self._resource.timeout = old_timeout
+
+
+async def run_sweeps(transport, completion, sweep_time, count=1):
+    """
+    Run a number of single sweeps without blocking the event loop, see SCPITools.run_sweeps. The poll and opc strategies
+    of SCPITools are supported, their parameters are used.
+
+    :param transport: connected transport of the instrument
+    :param completion: sweep completion strategy (PollingCompletion or OPCCompletion)
+    :param sweep_time: nominal time of a single sweep in s
+    :param count: number of sweeps, e.g. for sweep averaging
+    :return: the overhead in s
+    """
+    queries = 0
+    start = time.perf_counter()
+    for i in range(count):
+        if completion.name == "poll":
+            await transport.write("*CLS;INIT:IMM;*OPC")
+            await asyncio.sleep(completion.initial_fraction*sweep_time)
+            max_interval = min(completion.max_interval, max(completion.min_interval, 0.05*sweep_time))
+            interval = completion.min_interval
+            queries += 1
+            # Check first bit in the event status register for OPC
+            while not (int(await transport.query("*ESR?")) & 1):
+                await asyncio.sleep(interval)
+                interval = min(interval*completion.backoff, max_interval)
+                queries += 1
+        elif completion.name == "opc":
+            await transport.write("*CLS;INIT:IMM")
+            await transport.query("*OPC?", completion.margin*sweep_time + completion.timeout_offset)
+            queries += 1
+        else:
+            raise ValueError(f"Sweep completion {completion.name} is not supported by the asyncio driver, use poll or "
+                             f"opc.")
+    completion.queries = queries
+    elapsed = time.perf_counter() - start
+    overhead = elapsed - count*sweep_time
+    logging.info(f"{count} sweep(s) with {completion.name} completion took {elapsed:.3f} s (nominal "
+                 f"{count*sweep_time:.3f} s, overhead {overhead:.3f} s, {queries} completion queries)")
+    return overhead
+
+
+class AsyncPNA:
+    '''
+    asyncio driver for S21 measurements with the Keysight PNA, same commands and settings cache as PNA
+    '''
+
+    def __init__(self, transport, channel_index=1, data_format='REAL,64', completion='poll'):
+        """
+        Use open() to connect to an instrument
+
+        :param transport: connected SocketTransport or VisaTransport
+        :param channel_index: channel of the measurement
+        :param data_format: format for the transfer of the measured data, see set_data_format()
+        :param completion: strategy for detecting the end of a sweep, poll or opc
+        """
+        self._transport = transport
+        self._ci = channel_index
+
+        #default init values
+        self.power = -20
+        self.bandwidth = 100
+        self.averages = 1
+        self.frequencies = np.linspace(4e9, 6e9, 1001)
+        self.data_format = data_format
+        self.completion = get_completion(completion)
+        # last confirmed settings, unchanged settings are not sent again (see SCPITools.InstrumentState)
+        self.state = InstrumentState()
+        # commands written within batch() are collected and sent together, see SCPITools.CommandBatch
+        self._commands = []
+        self._batch_depth = 0
+        self._batch_sent = False  # whether the current batch sent commands, i.e. its errors have to be checked
+        self.max_length = 1000
+        self.round_trips = 0
+
+    @classmethod
+    async def open(cls, address, timeout=5., **kwargs):
+        """
+        Connect to an instrument
+
+        :param address: VISA resource name, see open_transport()
+        :param timeout: default timeout of a query in s
+        :param kwargs: further arguments of the constructor
+        :return: the AsyncPNA object
+        """
+        return cls(await open_transport(address, timeout), **kwargs)
+
+    async def close(self):
+        await self._transport.close()
+
+    async def query(self, cmd: str, timeout=None):
+        """
+        Query a SCPI command
+        :param cmd: SCPI command
+        :param timeout: timeout in s, by default the one of the transport
+        :return: evaluation of the SCPI command
+        """
+        # commands of a running batch must be processed before the answer is meaningful
+        await self._flush()
+        return await self._transport.query(cmd, timeout)
+
+    async def write(self, cmd: str):
+        """
+        Write a SCPI command
+        :param cmd: SCPI command
+        """
+        self._add(cmd)
+        if self._batch_depth == 0:
+            await self._send()
+
+    @asynccontextmanager
+    async def batch(self):
+        """
+        Context for collecting the written commands, which are sent as one message with a single final *OPC? when the
+        context ends, see PNA.batch(). Errors of the instrument raise a RuntimeError.
+        """
+        if self._batch_depth == 0:
+            self._batch_sent = False
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                # the commands of a failed batch are dropped
+                self._commands = []
+            # it is unknown which of the collected settings were applied
+            self.state.invalidate()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth > 0:
+            return
+        try:
+            await self._flush()
+            # all settings were skipped, nothing to check
+            errors = await self._check_errors() if self._batch_sent else []
+        except BaseException:
+            self.state.invalidate()
+            raise
+        if len(errors) > 0:
+            self.state.invalidate()
+            raise RuntimeError(f"Instrument reported errors in command batch: {'; '.join(errors)}")
+
+    async def set(self, key: str, value, cmd: str):
+        """
+        Write a SCPI command applying a setting, unless the setting already has this value
+        :param key: name of the setting
+        :param value: new value of the setting
+        :param cmd: SCPI command
+        :return: True if the command was sent, False if it was skipped
+        """
+        sent = self.state.set(key, value, self._add, cmd)
+        if sent and self._batch_depth == 0:
+            await self._send()
+        return sent
+
+    def invalidate(self):
+        """
+        Forget the known settings, so that all of them are sent again
+        """
+        self.state.invalidate()
+
+    async def resync(self):
+        """
+        Read the settings back from the instrument into the known settings
+        """
+        self.state.invalidate()
+        self.state.confirm('power', await self.get_power())
+        self.state.confirm('bandwidth', await self.get_bandwidth())
+        self.state.confirm('points', await self.get_nop())
+        self.state.confirm('start', await self.get_start_frequency())
+        self.state.confirm('stop', await self.get_stop_frequency())
+
+    async def wait(self):
+        """
+        Wait until the pending operations are complete
+        :return: 1 as soon as the operation is complete
+        """
+        return await self._flush() or await self._transport.query('*OPC?')
+
+    async def set_rf_on(self):
+        await self.write('OUTPut:STATe ON')
+
+    async def set_rf_off(self):
+        await self.write('OUTPut:STATe OFF')
+
+    async def set_frequencies(self, start: float, stop: float, nop: int):
+        """
+        Set the frequencies for the sweep
+        :param start: start frequency in Hz
+        :param stop: stop frequency in Hz
+        :param nop: number of points
+        """
+        self.frequencies = np.linspace(start, stop, nop)
+        await self.set('sweep_type', 'LIN', f"SENSe{self._ci}:SWEep:TYPE LIN")
+        await self.set('points', len(self.frequencies), f':SENSe{self._ci}:SWEep:POINts {len(self.frequencies)}')
+        await self.set('start', self.frequencies[0], f':SENSe{self._ci}:FREQuency:STARt {self.frequencies[0]:.3f}')
+        await self.set('stop', self.frequencies[-1], f':SENSe{self._ci}:FREQuency:STOP {self.frequencies[-1]:.3f}')
+
+    async def set_segments(self, segments: list):
+        """
+        Set a segmented sweep, see PNA.set_segments()
+        :param segments: list of (start, stop, nop) tuples with frequencies in Hz, ascending and not overlapping
+        """
+        segments = [(float(start), float(stop), int(nop)) for start, stop, nop in segments]
+        self.frequencies = np.concatenate([np.linspace(start, stop, nop) for start, stop, nop in segments])
+        if self.state.get('segments') != segments:
+            self.state.invalidate('segments')
+            async with self.batch():
+                await self.write(f"SENSe{self._ci}:SEGMent:DELete:ALL")
+                await self.write(f"SENSe{self._ci}:SEGMent:BWIDth:CONTrol OFF")
+                await self.write(f"SENSe{self._ci}:SEGMent:POWer:CONTrol OFF")
+                for i, (start, stop, nop) in enumerate(segments, 1):
+                    await self.write(f"SENSe{self._ci}:SEGMent{i}:ADD")
+                    await self.write(f"SENSe{self._ci}:SEGMent{i}:FREQuency:STARt {start:.3f}")
+                    await self.write(f"SENSe{self._ci}:SEGMent{i}:FREQuency:STOP {stop:.3f}")
+                    await self.write(f"SENSe{self._ci}:SEGMent{i}:SWEep:POINts {nop}")
+                    await self.write(f"SENSe{self._ci}:SEGMent{i}:STATe ON")
+            self.state.confirm('segments', segments)
+        await self.set('sweep_type', 'SEGMENT', f"SENSe{self._ci}:SWEep:TYPE SEGMent")
+
+    async def set_power(self, power: float):
+        """
+        Set the output power in dBm
+        :param power: power in dBm
+        """
+        self.power = power
+        await self.set('power', self.power, f':SOURce{self._ci}:POWer {self.power}')
+
+    async def set_bandwidth(self, bandwidth: int):
+        """
+        Set the IF bandwith of the VNA
+        :param bandwidth: bandwidth in Hz
+        """
+        self.bandwidth = bandwidth
+        await self.set('bandwidth', self.bandwidth, f'SENSe{self._ci}:BANDwidth:RESolution {self.bandwidth}')
+
+    async def set_averages(self, averages: int):
+        """
+        Set the amount of sweep averages
+        :param averages: amount of averages, 1 means no averaging
+        """
+        if averages == 0 or averages == 1:
+            self.averages = 1
+            await self.set('average_state', 'OFF', f'SENSe{self._ci}:AVERage:STATe OFF')
+        else:
+            self.averages = averages
+            await self.set('average_state', 'ON', f'SENSe{self._ci}:AVERage:STATe ON')
+            await self.set('average_count', self.averages, f'SENSe{self._ci}:AVERage:COUNt {self.averages}')
+
+    def set_completion(self, completion):
+        """
+        Set the strategy for detecting the end of a sweep
+        :param completion: poll or opc, or a strategy object from SCPITools
+        """
+        self.completion = get_completion(completion)
+
+    async def set_data_format(self, data_format: str):
+        """
+        Set the format for the transfer of the measured data
+        :param data_format: REAL,64 or REAL,32 for binary transfer, ASCII for text
+        """
+        if data_format in BINARY_FORMATS:
+            # little-endian byte order, i.e. no byte swapping on the PC
+            await self.set('data_format', data_format, f'FORMat:BORDer SWAPped;:FORMat {data_format}')
+        elif data_format == 'ASCII':
+            await self.set('data_format', data_format, 'FORMat ASCii,0')
+        else:
+            raise ValueError("Data format must be REAL,64 (default), REAL,32 or ASCII.")
+        self.data_format = data_format
+
+    async def measure(self):
+        """
+        Perform a measurement with the chosen settings, other coroutines run while the VNA sweeps
+        :return: dictionary containing the measured S parameter data
+        """
+        await self.set('continuous', 'OFF', "INIT:CONT OFF")
+        full_time = await self.get_sweep_time()
+        logging.info(f"sweep time: {full_time:.3f} s")
+
+        # run the sweeps (one per average), the sweep time query above already waited for the settings
+        await run_sweeps(self._transport, self.completion, full_time/self.averages, self.averages)
+        return {'S-parameter': await self.get_data()}
+
+    async def get_data(self):
+        """
+        Get the measured complex data. Uses binary transfer unless data_format is ASCII, falls back to ASCII if the
+        binary transfer fails.
+        :return: complex-valued np array
+        """
+        await self.set_data_format(self.data_format)
+        await self._flush()
+        # the transfer of a long trace may take longer than a short query
+        timeout = self._transport.timeout + 1e-6*len(self.frequencies)
+        if self.data_format in BINARY_FORMATS:
+            try:
+                return await self._transport.query_complex("CALCulate:DATA? SDATa", self.data_format, timeout)
+            except (pyvisa.errors.VisaIOError, ValueError) as error:
+                logging.warning(f"Binary data transfer failed ({error}), falling back to ASCII.")
+                await self._transport.clear()
+                await self.set_data_format('ASCII')
+        return await self._transport.query_complex("CALCulate:DATA? SDATa", "ASCII", timeout)
+
+    async def get_sweep_time(self):
+        """
+        Get the sweep time in seconds
+        :return: full sweep time in seconds
+        """
+        return float(await self.query(f':SENSe{self._ci}:SWEep:TIME?'))*self.averages
+
+    async def get_power(self):
+        return float(await self.query(f':SOURce{self._ci}:POWer?'))
+
+    async def get_start_frequency(self):
+        return float(await self.query(f':SENSe{self._ci}:FREQuency:STARt?'))
+
+    async def get_stop_frequency(self):
+        return float(await self.query(f':SENSe{self._ci}:FREQuency:STOP?'))
+
+    async def get_bandwidth(self):
+        return float(await self.query(f'SENSe{self._ci}:BANDwidth:RESolution?'))
+
+    async def get_nop(self):
+        return int(await self.query(f':SENSe{self._ci}:SWEep:POINts?'))
+
+    # Utility methods
+
+    def _add(self, cmd):
+        # commands following a semicolon are relative to the previous header path, unless they start with a colon
+        self._commands.append(cmd if cmd.startswith((":", "*")) else ":" + cmd)
+
+    async def _send(self):
+        """
+        Send the collected commands without waiting for them
+        """
+        commands, self._commands = self._commands, []
+        for message in join_commands(commands, self.max_length) if len(commands) > 0 else []:
+            await self._transport.write(message)
+            self.round_trips += 1
+
+    async def _flush(self):
+        """
+        Send the collected commands and wait until the instrument has processed them
+
+        :return: the answer to the final *OPC?, or None if there was nothing to send
+        """
+        if len(self._commands) == 0:
+            return None
+        commands, self._commands = self._commands, []
+        if not self._batch_sent:
+            # errors left by earlier commands must not be blamed on the batch
+            commands.insert(0, "*CLS")
+            self._batch_sent = True
+        messages = join_commands(commands, self.max_length)
+        for message in messages[:-1]:
+            await self._transport.write(message)
+        self.round_trips += len(messages)
+        return await self._transport.query(messages[-1] + ";*OPC?")
+
+    async def _check_errors(self):
+        errors = []
+        error = await self._transport.query("SYST:ERR?")
+        # the queue is read until it reports 0 (no error), bounded in case an instrument never does
+        while not error.startswith(("0,", "+0,")) and len(errors) < 100:
+            errors.append(error)
+            error = await self._transport.query("SYST:ERR?")
+        return errors
+
+
+class AsyncVNA:
+    '''
+    asyncio version of the VNA frontend (Keysight PNA command set)
+    '''
+
+    def __init__(self, pna: AsyncPNA):
+        """
+        Use open() to connect to an instrument
+
+        :param pna: the connected AsyncPNA driver
+        """
+        self._measurement = None
+        self.pna = pna
+
+    @classmethod
+    async def open(cls, address, timeout=5., **kwargs):
+        """
+        Connect to an instrument
+        :param address: VISA resource name, e.g. TCPIP0::10.1.1.32::5025::SOCKET
+        :param timeout: default timeout of a query in s
+        :param kwargs: further arguments of AsyncPNA (channel_index, data_format, completion)
+        :return: the AsyncVNA object
+        """
+        return cls(await AsyncPNA.open(address, timeout, **kwargs))
+
+    async def close(self):
+        await self.pna.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            await self.rf_off()
+        finally:
+            await self.close()
+
+    async def set_measurement(self, measurement: Measurement):
+        """
+        Sets the Measurement object for the VNA, see VNA.set_measurement()
+        :param measurement: a Measurement object containing all the information for a measurement
+        """
+        self._measurement = measurement
+
+        # all settings are sent in one batch
+        async with self.pna.batch():
+            await self.pna.set_power(self._measurement.get_power())
+            await self.pna.set_bandwidth(self._measurement.get_bandwidth())
+            frequencies = self._measurement.get_frequencies()
+            segments = get_segments(frequencies)
+            if len(segments) == 1:
+                await self.pna.set_frequencies(frequencies[0], frequencies[-1], len(frequencies))
+            else:
+                # non-uniform frequencies are measured as a segmented sweep
+                await self.pna.set_segments(segments)
+            await self.pna.set_averages(self._measurement.get_averages())
+
+    async def measure(self, save=True, writer=None):
+        """
+        Start a VNA measurement with the parameters of the Measurement object
+        :param save: if false, the data won't be saved
+        :param writer: AsyncWriter saving the data in the background, None to save in a worker thread before returning
+        :return: the path of the saved measurement data, without suffix (a Future of it if a writer is used) - or None,
+                 if the data wasn't saved
+        """
+        if self._measurement is None:
+            raise TypeError("Measurement has not been set yet!")
+        self._measurement.set_data((await self.pna.measure())['S-parameter'])
+        if not save:
+            return None
+        # the disk must not block the other instruments
+        if writer is None:
+            return await asyncio.to_thread(self._measurement.save)
+        return await asyncio.to_thread(writer.save_measurement, self._measurement)
+
+    async def measure_segmented(self, measurements, save=True, writer=None):
+        """
+        Measure several Measurement objects with separate frequency windows in a single segmented sweep, see
+        VNA.measure_segmented()
+        :param measurements: list of Measurement objects with equal bandwidth, power and averages
+        :param save: if false, the data won't be saved
+        :param writer: AsyncWriter saving the data in the background, None to save in a worker thread before returning
+        :return: list of the paths of the saved measurement data, without suffix (Futures of them if a writer is used) -
+                 or of None, if the data wasn't saved
+        """
+        merged = merge_measurements(measurements)
+        await self.set_measurement(merged)
+        await self.measure(save=False)
+        split_data(merged, measurements)
+        if not save:
+            return [None]*len(measurements)
+        if writer is None:
+            return [await asyncio.to_thread(measurement.save) for measurement in measurements]
+        return [await asyncio.to_thread(writer.save_measurement, measurement) for measurement in measurements]
+
+    async def get_measurement_time(self):
+        return await self.pna.get_sweep_time()
+
+    async def rf_on(self):
+        await self.pna.set_rf_on()
+
+    async def rf_off(self):
+        await self.pna.set_rf_off()
+
+    async def wait(self):
+        await self.pna.wait()
+
+    async def query_command(self, command):
+        return await self.pna.query(command)
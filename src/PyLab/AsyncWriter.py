@@ -0,0 +1,217 @@
+from concurrent.futures import Future
+import numpy as np
+import atexit
+import copy
+import logging
+import queue
+import threading
+import time
+from PyLab.Measurement import Measurement
+from PyLab.FitCatalog import FitCatalog
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+except ImportError:
+    Figure = None
+
+
+"""
+background writer for measurements and fit artifacts: the acquisition hands finished objects over to a bounded queue and
+goes on with the next sweep, while writer threads save them to disk. A full queue blocks the acquisition (backpressure)
+instead of growing without bound, and everything queued is written before the interpreter exits.
+"""
+
+
+class AsyncWriter:
+
+    def __init__(self, threads=1, max_queue=64):
+        """
+        Start the writer threads
+
+        :param threads: number of writer threads, more than one only helps for slow network shares
+        :param max_queue: maximum number of queued writes, submitting more blocks until the writers caught up
+        """
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        # a submit racing close() must not queue behind the stop signals of the threads. Not self._lock, which the
+        # threads need after each write while a submit may wait for a free place in the queue.
+        self._submit_lock = threading.Lock()
+        # matplotlib is not thread safe, plots are made one at a time
+        self._plot_lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {"submitted": 0, "written": 0, "failed": 0, "max_depth": 0, "latency": 0., "max_latency": 0.,
+                       "write_time": 0., "blocked_time": 0.}
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work, name=f"AsyncWriter-{i}", daemon=True)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a write, blocks only while the queue is full
+
+        :param function: function doing the write
+        :param args: arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: a Future resolving to the return value of the function
+        """
+        future = Future()
+        start = time.perf_counter()
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError("the writer is closed")
+            self._queue.put((function, args, kwargs, future, start))
+        with self._lock:
+            self._stats["submitted"] += 1
+            self._stats["blocked_time"] += time.perf_counter() - start
+            self._stats["max_depth"] = max(self._stats["max_depth"], self._queue.qsize())
+        return future
+
+    def save_measurement(self, measurement: Measurement, base_path=r"D:\Measurements\Resonators", txt=False):
+        """
+        Queue Measurement.save() of a copy of the measurement, so the object can be reused for the next sweep
+
+        :param measurement: the measured Measurement object
+        :param base_path: base path, see Measurement.save()
+        :param txt: if true, the data is additionally exported to a txt file
+        :return: a Future resolving to the path of the saved data, without suffix
+        """
+        snapshot = Measurement.from_dict(measurement.to_dict(), np.array(measurement.get_frequencies()),
+                                         np.array(measurement.get_data()))
+        return self.submit(snapshot.save, base_path, txt)
+
+    def save_fit(self, fit, fit_path=None, plot_path=None, catalog=None, **metadata):
+        """
+        Queue saving the fit results and the plot of a circle fit
+
+        :param fit: fitted circuit object (e.g. notch_port)
+        :param fit_path: path for save_fitresults(), without suffix - or None, if the results shouldn't be saved
+        :param plot_path: path of the plot, e.g. a pdf - or None, if nothing should be plotted
+        :param catalog: path of a FitCatalog file the fit results are added to, None for no catalog
+        :param metadata: chip, resonator, power and attenuation of the fit for the catalog, see FitCatalog.add()
+        :return: a Future resolving to the fit results
+        """
+        # a later autofit() of the same object must not change what is written
+        fit = copy.copy(fit)
+        fit.fitresults = dict(fit.fitresults)
+        return self.submit(self._save_fit, fit, fit_path, plot_path, None if catalog is None else str(catalog),
+                           metadata)
+
+    def pending(self):
+        """
+        Get the number of queued writes (queue depth)
+
+        :return: the number of writes waiting for a writer thread
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Get statistics of the writes so far
+
+        :return: dictionary with the current queue depth (pending), its maximum (max_depth), the number of submitted,
+                 written and failed writes, the mean and maximum latency from submitting to finishing a write, the mean
+                 duration of a write (all in s) and the total time the submitters waited for a full queue (blocked_time)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        finished = max(stats["written"] + stats["failed"], 1)
+        return {"pending": self._queue.qsize(), "max_depth": stats["max_depth"], "submitted": stats["submitted"],
+                "written": stats["written"], "failed": stats["failed"], "mean_latency": stats["latency"]/finished,
+                "max_latency": stats["max_latency"], "mean_write_time": stats["write_time"]/finished,
+                "blocked_time": stats["blocked_time"]}
+
+    def flush(self):
+        """
+        Wait until all queued writes are finished
+        """
+        self._queue.join()
+
+    def close(self, wait=True):
+        """
+        Stop the writer threads, called at exit of the interpreter as well
+
+        :param wait: if true, all queued writes are finished first. Otherwise queued writes are cancelled.
+        """
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        if not wait:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                item[3].cancel()
+                self._queue.task_done()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Utility methods
+
+    def _work(self):
+        """
+        Loop of a writer thread
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            function, args, kwargs, future, submitted = item
+            if future.set_running_or_notify_cancel():
+                start = time.perf_counter()
+                try:
+                    result = function(*args, **kwargs)
+                except BaseException as error:
+                    logging.error(f"Background write failed: {error!r}")
+                    future.set_exception(error)
+                    failed = True
+                else:
+                    future.set_result(result)
+                    failed = False
+                end = time.perf_counter()
+                with self._lock:
+                    self._stats["failed" if failed else "written"] += 1
+                    self._stats["write_time"] += end - start
+                    self._stats["latency"] += end - submitted
+                    self._stats["max_latency"] = max(self._stats["max_latency"], end - submitted)
+            self._queue.task_done()
+        for catalog in getattr(self._local, "catalogs", {}).values():
+            catalog.close()
+
+    def _save_fit(self, fit, fit_path, plot_path, catalog, metadata):
+        """
+        Save the fit results and the plot (runs in a writer thread)
+        """
+        if catalog is not None:
+            # a connection can only be used by the thread which opened it
+            catalogs = self._local.__dict__.setdefault("catalogs", {})
+            if catalog not in catalogs:
+                catalogs[catalog] = FitCatalog(catalog)
+            fit.save_fitresults(fit_path, catalogs[catalog], **metadata)
+        elif fit_path is not None:
+            fit.save_fitresults(fit_path)
+        if plot_path is not None:
+            if Figure is None:
+                raise ImportError("matplotlib not found")
+            # pyplot (and a GUI backend) must not be used outside of the main thread, the plot gets a figure of its
+            # own with a non-interactive canvas
+            with self._plot_lock:
+                figure = Figure()
+                FigureCanvasAgg(figure)
+                fit.plotall(plot_path, figure=figure)
+        return fit.fitresults
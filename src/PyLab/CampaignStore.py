@@ -0,0 +1,212 @@
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+from PyLab.Measurement import Measurement, encode_frequencies, decode_frequencies
+
+
+"""
+append-only store of all measurements and fit results of a campaign (e.g. a power sweep of all resonators of a chip) in
+a single directory: the traces go to a few large binary data files, their settings and fit results to an index with
+one JSON line per record.
+"""
+
+
+class CampaignStore:
+
+    def __init__(self, path, file_size=2**30):
+        """
+        Open a campaign store, it is created if it does not exist
+
+        :param path: directory of the store
+        :param file_size: size of a data file in bytes, a new file is started beyond it
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.file_size = file_size
+        self._index = self.path/"index.jsonl"
+        self._lock = threading.Lock()
+        self._records = []
+        self._fits = {}
+        self._load()
+
+    def append(self, measurement: Measurement, fitresults=None, **metadata):
+        """
+        Append a measured trace. The data is flushed to disk before the index line that refers to it, so a crash at any
+        time leaves the store consistent: a record is either complete or not in the index.
+
+        :param measurement: the measured Measurement object
+        :param fitresults: fit results of the trace, they can also be added later with add_fit()
+        :param metadata: further columns of the record, e.g. resonator (name or number) or step. The columns record,
+                         power, bandwidth, averages, nop, f_start, f_stop and time are always filled.
+        :return: number of the record
+        """
+        data = np.ascontiguousarray(measurement.get_data(), dtype=np.complex128)
+        frequencies = np.asarray(measurement.get_frequencies(), dtype=float)
+        if len(data) != len(frequencies):
+            raise ValueError("frequency and data size do not match")
+
+        with self._lock:
+            data_file, offset = self._get_data_file()
+            segments = encode_frequencies(frequencies)
+            with open(self.path/data_file, "ab") as handle:
+                handle.write(data.tobytes())
+                if segments is None:
+                    handle.write(frequencies.tobytes())
+                handle.flush()
+                os.fsync(handle.fileno())
+
+            record = dict(metadata, record=len(self._records), power=measurement.get_power(),
+                          bandwidth=measurement.get_bandwidth(), averages=measurement.get_averages(), nop=len(data),
+                          f_start=float(frequencies[0]), f_stop=float(frequencies[-1]),
+                          time=datetime.now().isoformat(timespec="seconds"), settings=measurement.to_dict(),
+                          file=data_file, offset=offset,
+                          frequencies=segments if segments is not None else {"offset": offset + data.nbytes})
+            self._write_line(record)
+            self._records.append(record)
+            if fitresults is not None:
+                self._add_fit(record["record"], fitresults)
+            return record["record"]
+
+    def add_fit(self, record, fitresults):
+        """
+        Store the fit results of a record, a later fit of the same record replaces them
+
+        :param record: number of the record
+        :param fitresults: dictionary of fit results, e.g. fitresults of a circle fit
+        """
+        with self._lock:
+            if not 0 <= record < len(self._records):
+                raise KeyError(f"no record {record} in {self.path}")
+            self._add_fit(record, fitresults)
+
+    def get_measurement(self, record, mmap=True):
+        """
+        Get the Measurement object of a record
+
+        :param record: number of the record
+        :param mmap: if true, the data is a read-only memory map of the data file, it is only read when accessed
+        :return: the Measurement object
+        """
+        entry = self._records[record]
+        if isinstance(entry["frequencies"], list):
+            frequencies = decode_frequencies(entry["frequencies"])
+        else:
+            frequencies = self._read(entry["file"], entry["frequencies"]["offset"], entry["nop"], np.float64, mmap)
+        data = self._read(entry["file"], entry["offset"], entry["nop"], np.complex128, mmap)
+        return Measurement.from_dict(entry["settings"], frequencies, data)
+
+    def get_fit(self, record):
+        """
+        Get the fit results of a record
+
+        :param record: number of the record
+        :return: dictionary of fit results, None if there is no fit
+        """
+        return self._fits.get(record)
+
+    def get_record(self, record):
+        """
+        Get the index entry of a record
+
+        :param record: number of the record
+        :return: dictionary of the columns and settings of the record
+        """
+        return self._records[record]
+
+    def select(self, **conditions):
+        """
+        Find records by their columns, e.g. select(resonator=3, power=-120)
+
+        :param conditions: required values of columns
+        :return: list of record numbers, in the order of appending
+        """
+        return [entry["record"] for entry in self._records
+                if all(entry.get(column) == value for column, value in conditions.items())]
+
+    def table(self, *columns, records=None):
+        """
+        Get columns of the index and of the fit results as arrays, e.g. table("power", "Qi", "Qi_err")
+
+        :param columns: names of index columns or fit results (missing values are NaN)
+        :param records: record numbers, by default all records
+        :return: dictionary of np arrays
+        """
+        records = range(len(self._records)) if records is None else records
+        rows = [dict(self._fits.get(record, {}), **self._records[record]) for record in records]
+        return {column: np.array([row.get(column, np.nan) for row in rows]) for column in columns}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        """
+        Iterate over the measurements in the order of appending, the data is memory mapped, see get_measurement()
+        """
+        for record in range(len(self._records)):
+            yield self.get_measurement(record)
+
+    # Utility methods
+
+    def _load(self):
+        """
+        Read the index, a line cut off by a crash is skipped
+        """
+        if not self._index.exists():
+            return
+        with open(self._index) as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping incomplete index line in {self._index}.")
+                    continue
+                if "fit" in entry:
+                    self._fits[entry["fit"]] = entry["fitresults"]
+                else:
+                    self._records.append(entry)
+
+    def _add_fit(self, record, fitresults):
+        self._write_line({"fit": record, "fitresults": fitresults})
+        self._fits[record] = dict(fitresults)
+
+    def _get_data_file(self):
+        """
+        Get the name of the data file to append to and the current end of it
+        """
+        number = 0
+        if len(self._records) > 0:
+            number = int(self._records[-1]["file"][5:-4])
+        data_file = f"data_{number:05d}.bin"
+        if (self.path/data_file).exists() and (self.path/data_file).stat().st_size >= self.file_size:
+            data_file = f"data_{number + 1:05d}.bin"
+        # data written before a crash, but not indexed, stays unreferenced at the end of the file
+        size = (self.path/data_file).stat().st_size if (self.path/data_file).exists() else 0
+        return data_file, size
+
+    def _read(self, data_file, offset, nop, dtype, mmap):
+        if mmap:
+            return np.memmap(self.path/data_file, dtype=dtype, mode="r", offset=offset, shape=(nop,))
+        with open(self.path/data_file, "rb") as handle:
+            handle.seek(offset)
+            return np.fromfile(handle, dtype=dtype, count=nop)
+
+    def _write_line(self, entry):
+        """
+        Append a line to the index, flushed to disk before returning
+        """
+        # settings and fit results may contain numpy scalars
+        line = json.dumps(entry, default=lambda value: value.item()) + "\n"
+        # a line cut off by a crash must not swallow the new one
+        if self._index.exists() and self._index.stat().st_size > 0:
+            with open(self._index, "rb") as handle:
+                handle.seek(-1, os.SEEK_END)
+                if handle.read(1) != b"\n":
+                    line = "\n" + line
+        with open(self._index, "a") as handle:
+            handle.write(line)
+            handle.flush()
+            os.fsync(handle.fileno())
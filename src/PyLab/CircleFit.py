@@ -25,6 +25,73 @@ except (ImportError, AttributeError):
         plot_enable = True
     except ImportError:
         plot_enable = False
+try:
+    import numba
+    numba_enable = True
+except ImportError:
+    numba_enable = False
+
+
+# Fields of the structured array returned by circuit.autofit_batch(). The names
+# match the keys of circuit.fitresults.
+fitresult_dtype = np.dtype([(key, float) for key in (
+    "delay", "delay_remaining", "a", "alpha", "theta", "phi", "fr", "Ql", "Qc",
+    "Qc_no_dia_corr", "Qi", "Qi_no_dia_corr", "fr_err", "Ql_err", "absQc_err",
+    "phi_err", "Qi_err", "Qi_no_dia_corr_err", "chi_square"
+)])
+
+
+def _circle_moments(z_data, x_norm, y_norm, amp_norm):
+    """
+    Matrices of moments (averaged over points) of the normalized traces z_data
+    with shape (n_traces, n_points) for the algebraic circle fit. Built as
+    D D^T from the design matrix D = (x^2+y^2, x, y, 1) in one matrix product.
+    """
+    n_traces, n_points = np.shape(z_data)
+    D = np.empty((n_traces, 4, n_points))
+    np.subtract(z_data.real, x_norm[:, np.newaxis], out=D[:, 1])
+    np.subtract(z_data.imag, y_norm[:, np.newaxis], out=D[:, 2])
+    D[:, 1:3] /= amp_norm[:, np.newaxis, np.newaxis]
+    np.einsum("tkp,tkp->tp", D[:, 1:3], D[:, 1:3], out=D[:, 0])
+    D[:, 3] = 1.
+    return np.matmul(D, np.swapaxes(D, -1, -2)) / n_points
+
+
+if numba_enable:
+    @numba.njit(cache=True)
+    def _circle_moments_compiled(z_data, x_norm, y_norm, amp_norm):
+        """
+        Compiled version of _circle_moments() accumulating all moments in a
+        single loop without temporary arrays.
+        """
+        n_traces, n_points = z_data.shape
+        M = np.empty((n_traces, 4, 4))
+        for t in range(n_traces):
+            sz2 = sxz = syz = sz = sx2 = sxy = sx = sy2 = sy = 0.
+            for p in range(n_points):
+                x = (z_data[t, p].real - x_norm[t]) / amp_norm[t]
+                y = (z_data[t, p].imag - y_norm[t]) / amp_norm[t]
+                z = x*x + y*y
+                sz2 += z*z
+                sxz += x*z
+                syz += y*z
+                sz += z
+                sx2 += x*x
+                sxy += x*y
+                sx += x
+                sy2 += y*y
+                sy += y
+            M[t, 0, 0] = sz2
+            M[t, 0, 1] = M[t, 1, 0] = sxz
+            M[t, 0, 2] = M[t, 2, 0] = syz
+            M[t, 0, 3] = M[t, 3, 0] = sz
+            M[t, 1, 1] = sx2
+            M[t, 1, 2] = M[t, 2, 1] = sxy
+            M[t, 1, 3] = M[t, 3, 1] = sx
+            M[t, 2, 2] = sy2
+            M[t, 2, 3] = M[t, 3, 2] = sy
+            M[t, 3, 3] = n_points
+        return M / n_points
 
 
 class circuit:
@@ -32,19 +99,37 @@ class circuit:
     Base class for common routines and definitions shared between both ports.
 
     inputs:
-    - f_data: Frequencies for which scattering data z_data_raw is taken
+    - f_data: Frequencies for which scattering data z_data_raw is taken. The
+              spacing does not need to be uniform, e.g. points concentrated
+              around the resonance (cf. ResonatorTools).
     - z_data_raw: Measured values for scattering parameter S11 or S21 taken at
                   frequencies f_data
     """
 
     def __init__(self, f_data, z_data_raw=None):
-        self.f_data = np.array(f_data)
-        self.z_data_raw = np.array(z_data_raw)
+        # no copy, memory mapped data (e.g. of Measurement.load()) is only read
+        # from disk when fitted
+        self.f_data = np.asarray(f_data)
+        self.z_data_raw = np.asarray(z_data_raw)
+        # The fit needs ascending frequencies (e.g. segments measured in any
+        # order)
+        if z_data_raw is not None and np.any(np.diff(self.f_data) < 0):
+            order = np.argsort(self.f_data, kind="stable")
+            self.f_data = self.f_data[order]
+            self.z_data_raw = self.z_data_raw[order]
         self.z_data_norm = None
 
         self.fitresults = {}
 
         self.fit_delay_max_iterations = 5
+        # Skip the staged phase fit if good guesses are known (e.g. during the
+        # iterations in _fit_delay()), the staged fit is the fallback
+        self.phase_fit_single_stage = True
+
+        # Number of evaluations of the phase model and its Jacobian during the
+        # phase fits of the last autofit()
+        self.phase_fit_nfev = 0
+        self.phase_fit_njev = 0
 
     @classmethod
     def Sij(cls, f, fr, Ql, Qc, phi=0., a=1., alpha=0., delay=0.):
@@ -70,21 +155,41 @@ class circuit:
                 1. - 2.*Ql / (complexQc * cls.n_ports * (1. + 2j*Ql*(f/fr-1.)))
         )
 
-    def autofit(self, calc_errors=True, fixed_delay=None):
+    def autofit(self, calc_errors=True, fixed_delay=None, warm_start=None):
         """
         Automatically calibrate data, normalize it and extract quality factors.
         If the autofit fails or the results look bad, please discuss with
         author.
+
+        inputs:
+        - calc_errors (opt.): Whether errors should be calculated
+        - fixed_delay (opt.): Known cable delay, skips the delay fit
+        - warm_start (opt.): fitresults dict (or fit object) of a previous fit
+                             of the same resonator, e.g. at the previous power
+                             step. Its delay, fr, Ql and theta are used as
+                             starting values and the phase fits are done in a
+                             single stage.
         """
         # TODO: implement refine results?
 
+        if isinstance(warm_start, circuit):
+            warm_start = warm_start.fitresults
+        if warm_start is not None and not all(
+                np.isfinite(warm_start.get(key, np.nan))
+                for key in ("delay", "fr", "Ql", "theta")
+        ):
+            logging.warning("Incomplete warm start results, fitting from scratch.")
+            warm_start = None
+
+        self.phase_fit_nfev = 0
+        self.phase_fit_njev = 0
         if fixed_delay is None:
-            self._fit_delay()
+            self._fit_delay(warm_start=warm_start)
         else:
             self.delay = fixed_delay
             # Store result in dictionary (also for backwards-compatibility)
             self.fitresults["delay"] = self.delay
-        self._calibrate()
+        self._calibrate(warm_start=warm_start)
         self._normalize()
         self._extract_Qs(calc_errors=calc_errors)
 
@@ -97,31 +202,147 @@ class circuit:
             self.f_data, self.fr, self.Ql, self.Qc, self.phi
         )
 
-    def _fit_delay(self):
+    @classmethod
+    def autofit_batch(cls, f_data, z_data_raw, calc_errors=True,
+                      fixed_delay=None, fit_delay_max_iterations=5):
+        """
+        Vectorized version of autofit() for many traces measured on the same
+        frequency grid, e.g. all steps of a power sweep. Every step (circle
+        fit, phase fit, calibration and extraction of the quality factors) is
+        done for all traces at once with stacked numpy operations.
+
+        inputs:
+        - f_data: Frequencies of shape (n_points,) shared by all traces
+        - z_data_raw: Measured scattering data of shape (n_traces, n_points)
+        - calc_errors (opt.): Whether errors should be calculated
+        - fixed_delay (opt.): Known cable delay, either a single value or one
+                              value per trace
+        - fit_delay_max_iterations (opt.): See circuit.fit_delay_max_iterations
+        outputs:
+        - Structured array of shape (n_traces,) with dtype fitresult_dtype.
+          Values which could not be determined are NaN.
+        """
+        f_data = np.asarray(f_data, dtype=float)
+        z_data_raw = np.atleast_2d(np.asarray(z_data_raw, dtype=complex))
+        if z_data_raw.shape[-1] != len(f_data):
+            raise ValueError("frequency and data size do not match")
+        n_traces = len(z_data_raw)
+        results = np.full(n_traces, np.nan, dtype=fitresult_dtype)
+
+        if fixed_delay is None:
+            delay = cls._fit_delay_batch(
+                f_data, z_data_raw, fit_delay_max_iterations
+            )
+        else:
+            delay = np.broadcast_to(
+                np.asarray(fixed_delay, dtype=float), (n_traces,)
+            ).copy()
+
+        # Calibrate (cf. _calibrate())
+        z_data = z_data_raw * np.exp(2j*np.pi*delay[:, np.newaxis]*f_data)
+        xc, yc, r0 = cls._fit_circle_batch(z_data)
+        zc = xc + 1j*yc
+        fr, Ql, theta, delay_remaining = cls._fit_phase_batch(
+            f_data, z_data - zc[:, np.newaxis]
+        )
+        theta = cls._periodic_boundary(theta)
+        beta = cls._periodic_boundary(theta - np.pi)
+        offrespoint = zc + r0*np.cos(beta) + 1j*r0*np.sin(beta)
+        a = np.absolute(offrespoint)
+        alpha = np.angle(offrespoint)
+        phi = cls._periodic_boundary(beta - alpha)
+        r0 = r0 / a
+
+        # Extract quality factors (cf. _extract_Qs())
+        absQc = Ql / (cls.n_ports*r0)
+        Qc = absQc / np.cos(phi)
+        results["delay"] = delay
+        results["delay_remaining"] = delay_remaining
+        results["a"] = a
+        results["alpha"] = alpha
+        results["theta"] = theta
+        results["phi"] = phi
+        results["fr"] = fr
+        results["Ql"] = Ql
+        results["Qc"] = Qc
+        results["Qc_no_dia_corr"] = absQc
+        results["Qi"] = 1. / (1./Ql - 1./Qc)
+        results["Qi_no_dia_corr"] = 1. / (1./Ql - 1./absQc)
+
+        # Residuals of normalized data (cf. _normalize() and _get_residuals())
+        column = (slice(None), np.newaxis)
+        z_data_norm = z_data_raw / a[column]*np.exp(
+            1j*(-alpha[column] + 2.*np.pi*delay[column]*f_data)
+        )
+        residuals = z_data_norm - cls.Sij(
+            f_data, fr[column], Ql[column], Qc[column], phi[column]
+        )
+        if calc_errors:
+            chi_square, cov = cls._covariance(
+                f_data, residuals, fr[column], Ql[column], absQc[column],
+                phi[column]
+            )
+            failed = np.any(np.isnan(cov), axis=(-2, -1))
+            if np.any(failed):
+                logging.warning(
+                    f"Error calculation failed for {np.count_nonzero(failed)}"
+                    f" of {n_traces} traces!"
+                )
+            errors = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+            results["fr_err"] = errors[:, 0]
+            results["Ql_err"] = errors[:, 1]
+            results["absQc_err"] = errors[:, 2]
+            results["phi_err"] = errors[:, 3]
+            results["Qi_err"], results["Qi_no_dia_corr_err"] = cls._Qi_errors(
+                Ql, absQc, Qc, phi, cov
+            )
+        else:
+            chi_square = (1. / (len(f_data) - 4.)
+                          * np.sum(np.abs(residuals)**2, axis=-1))
+        results["chi_square"] = chi_square
+
+        return results
+
+    def _fit_delay(self, warm_start=None):
         """
         Finds the cable delay by repeatedly centering the "circle" and fitting
         the slope of the phase response.
+
+        inputs:
+        - warm_start (opt.): fitresults of a previous fit. Its delay is used as
+                             starting point, so usually the first iteration
+                             already finds no measurable correction.
         """
 
-        # Translate data to origin
-        xc, yc, r0 = self._fit_circle(self.z_data_raw)
-        z_data = self.z_data_raw - np.complex(xc, yc)
-        # Find first estimate of parameters
-        fr, Ql, theta, self.delay = self._fit_phase(z_data)
+        if warm_start is None:
+            # Translate data to origin
+            xc, yc, r0 = self._fit_circle(self.z_data_raw)
+            z_data = self.z_data_raw - complex(xc, yc)
+            # Find first estimate of parameters
+            fr, Ql, theta, self.delay = self._fit_phase(z_data)
 
-        # Do not overreact (see end of for loop)
-        self.delay *= 0.05
+            # Do not overreact (see end of for loop)
+            self.delay *= 0.05
+            single_stage = None
+        else:
+            fr, Ql, theta = warm_start["fr"], warm_start["Ql"], warm_start["theta"]
+            self.delay = warm_start["delay"]
+            single_stage = True
 
         # Iterate to improve result for delay
         for i in range(self.fit_delay_max_iterations):
             # Translate new best fit data to origin
             z_data = self.z_data_raw * np.exp(2j*np.pi*self.delay*self.f_data)
             xc, yc, r0 = self._fit_circle(z_data)
-            z_data -= np.complex(xc, yc)
+            z_data -= complex(xc, yc)
 
             # Find correction to current delay
-            guesses = (fr, Ql, 5e-11)
-            fr, Ql, theta, delay_corr = self._fit_phase(z_data, guesses)
+            # theta of the previous iteration is only a good guess when warm
+            # started, the cold fit finds it anew
+            guesses = (fr, Ql, 5e-11, theta) if warm_start is not None else (fr, Ql, 5e-11)
+            fr, Ql, theta, delay_corr = self._fit_phase(
+                z_data, guesses, single_stage=single_stage
+            )
 
             # Stop if correction would be smaller than "measurable"
             phase_fit = self.phase_centered(self.f_data, fr, Ql, theta, delay_corr)
@@ -153,21 +374,109 @@ class circuit:
         # Store result in dictionary (also for backwards-compatibility)
         self.fitresults["delay"] = self.delay
 
-    def _calibrate(self):
+    @classmethod
+    def _fit_delay_batch(cls, f_data, z_data_raw, max_iterations=5):
+        """
+        Vectorized version of _fit_delay() for a stack of traces z_data_raw with
+        shape (n_traces, n_points). Traces are only refit until their delay
+        converged.
+        outputs:
+        - delay: Array of shape (n_traces,)
+        """
+        n_traces = len(z_data_raw)
+        f_span = f_data[-1] - f_data[0]
+
+        # Translate data to origin
+        xc, yc, r0 = cls._fit_circle_batch(z_data_raw)
+        z_data = z_data_raw - (xc + 1j*yc)[:, np.newaxis]
+        # Find first estimate of parameters
+        fr, Ql, theta, delay = cls._fit_phase_batch(f_data, z_data)
+
+        # Do not overreact (see end of for loop)
+        delay *= 0.05
+
+        # Iterate to improve result for delay, only for traces not converged
+        active = np.ones(n_traces, dtype=bool)
+        for i in range(max_iterations):
+            idx = np.flatnonzero(active)
+            if len(idx) == 0:
+                break
+            # Translate new best fit data to origin
+            z_data = z_data_raw[idx] * np.exp(
+                2j*np.pi*delay[idx, np.newaxis]*f_data
+            )
+            xc, yc, r0 = cls._fit_circle_batch(z_data)
+            z_data -= (xc + 1j*yc)[:, np.newaxis]
+
+            # Find correction to current delay
+            guesses = (fr[idx], Ql[idx], 5e-11)
+            fr[idx], Ql[idx], theta, delay_corr = cls._fit_phase_batch(
+                f_data, z_data, guesses
+            )
+
+            # Stop if correction would be smaller than "measurable"
+            phase_fit = cls.phase_centered(
+                f_data, fr[idx, np.newaxis], Ql[idx, np.newaxis],
+                theta[:, np.newaxis], delay_corr[:, np.newaxis]
+            )
+            residuals = np.unwrap(np.angle(z_data), axis=-1) - phase_fit
+            converged = 2*np.pi*f_span*delay_corr <= np.std(residuals, axis=-1)
+            active[idx[converged]] = False
+
+            # Same (branch-free) update rules as in _fit_delay()
+            d = delay[idx]
+            different_sign = delay_corr*d < 0
+            d_new = np.select(
+                [
+                    different_sign & (np.abs(delay_corr) > np.abs(d)),
+                    different_sign,
+                    np.abs(delay_corr) >= 1e-8,
+                    np.abs(delay_corr) >= 1e-9,
+                ],
+                [
+                    0.5*d,
+                    d + 0.1*np.sign(delay_corr)*5e-11,
+                    d + np.minimum(delay_corr, d),
+                    1.1*d,
+                ],
+                default=d + delay_corr
+            )
+            delay[idx] = np.where(converged, d, d_new)
+
+        if np.any(active):
+            logging.warning(
+                f"Delay could not be fit properly for {np.count_nonzero(active)}"
+                f" of {n_traces} traces!"
+            )
+
+        return delay
+
+    def _calibrate(self, warm_start=None):
         """
         Finds the parameters for normalization of the scattering data. See
         Sij of port classes for explanation of parameters.
+
+        inputs:
+        - warm_start (opt.): fitresults of a previous fit used as guesses for
+                             the phase fit
         """
 
         # Correct for delay and translate circle to origin
         z_data = self.z_data_raw * np.exp(2j*np.pi*self.delay*self.f_data)
         xc, yc, self.r0 = self._fit_circle(z_data)
-        zc = np.complex(xc, yc)
+        zc = complex(xc, yc)
         z_data -= zc
 
         # Find off-resonant point by fitting offset phase
         # (centered circle corresponds to lossless resonator in reflection)
-        self.fr, self.Ql, theta, self.delay_remaining = self._fit_phase(z_data)
+        if warm_start is None:
+            self.fr, self.Ql, theta, self.delay_remaining = self._fit_phase(z_data)
+        else:
+            guesses = (warm_start["fr"], warm_start["Ql"],
+                       warm_start.get("delay_remaining", 0.), warm_start["theta"])
+            self.fr, self.Ql, theta, self.delay_remaining = self._fit_phase(
+                z_data, guesses, single_stage=True
+            )
         self.theta = self._periodic_boundary(theta)
         beta = self._periodic_boundary(theta - np.pi)
         offrespoint = zc + self.r0*np.cos(beta) + 1j*self.r0*np.sin(beta)
@@ -228,32 +537,8 @@ class circuit:
 
             if cov is not None:
                 fr_err, Ql_err, absQc_err, phi_err = np.sqrt(np.diag(cov))
-                # Calculate error of Qi with error propagation
-                # without diameter correction
-                dQl = 1. / ((1./self.Ql - 1./self.absQc) * self.Ql)**2
-                dabsQc = -1. / ((1./self.Ql - 1./self.absQc) * self.absQc)**2
-                Qi_no_dia_corr_err = np.sqrt(
-                    dQl**2*cov[1][1]
-                    + dabsQc**2*cov[2][2]
-                    + 2.*dQl*dabsQc*cov[1][2]
-                )
-                # with diameter correction
-                dQl = 1. / ((1./self.Ql - 1./self.Qc) * self.Ql)**2
-                dabsQc = -np.cos(self.phi) / (
-                        (1./self.Ql - 1./self.Qc) * self.absQc
-                )**2
-                dphi = -np.sin(self.phi) / (
-                        (1./self.Ql - 1./self.Qc)**2 * self.absQc
-                )
-                Qi_err = np.sqrt(
-                    dQl**2*cov[1][1]
-                    + dabsQc**2*cov[2][2]
-                    + dphi**2*cov[3][3]
-                    + 2*(
-                            dQl*dabsQc*cov[1][2]
-                            + dQl*dphi*cov[1][3]
-                            + dabsQc*dphi*cov[2][3]
-                    )
+                Qi_err, Qi_no_dia_corr_err = self._Qi_errors(
+                    self.Ql, self.absQc, self.Qc, self.phi, cov
                 )
                 self.fitresults.update({
                     "fr_err": fr_err,
@@ -270,7 +555,7 @@ class circuit:
             # Just calculate reduced chi square (4 fit parameters reduce degrees
             # of freedom)
             self.fitresults["chi_square"] = (1. / (len(self.f_data) - 4.)
-                                             * np.sum(np.abs(self._get_residuals_reflection)**2))
+                                             * np.sum(np.abs(self._get_residuals())**2))
 
     def _fit_circle(self, z_data, refine_results=False):
         """
@@ -278,56 +563,54 @@ class circuit:
         Probst: "Efficient and robust analysis of complex scattering data under
         noise in microwave resonators" (arXiv:1410.3365v2)
         """
+        xc, yc, r0 = self._fit_circle_batch(z_data[np.newaxis])
+        return xc[0], yc[0], r0[0]
+
+    # Inverse of the constraint matrix B of the algebraic circle fit, i.e. the
+    # constraint A^T B A = A1^2 + A2^2 - 4 A0 A3 = 1
+    _circle_constraint_inv = np.linalg.inv(np.array([
+        [0., 0., 0., -2.],
+        [0., 1., 0., 0.],
+        [0., 0., 1., 0.],
+        [-2., 0., 0., 0.]
+    ]))
 
-        # Normalize circle to deal with comparable numbers
-        x_norm = 0.5*(np.max(z_data.real) + np.min(z_data.real))
-        y_norm = 0.5*(np.max(z_data.imag) + np.min(z_data.imag))
-        z_data = z_data[:] - (x_norm + 1j*y_norm)
-        amp_norm = np.max(np.abs(z_data))
-        z_data = z_data / amp_norm
-
-        # Calculate matrix of moments
-        xi = z_data.real
-        xi_sqr = xi*xi
-        yi = z_data.imag
-        yi_sqr = yi*yi
-        zi = xi_sqr+yi_sqr
-        Nd = float(len(xi))
-        xi_sum = xi.sum()
-        yi_sum = yi.sum()
-        zi_sum = zi.sum()
-        xiyi_sum = (xi*yi).sum()
-        xizi_sum = (xi*zi).sum()
-        yizi_sum = (yi*zi).sum()
-        M =  np.array([
-            [(zi*zi).sum(), xizi_sum, yizi_sum, zi_sum],
-            [xizi_sum, xi_sqr.sum(), xiyi_sum, xi_sum],
-            [yizi_sum, xiyi_sum, yi_sqr.sum(), yi_sum],
-            [zi_sum, xi_sum, yi_sum, Nd]
-        ])
-
-        # Lets skip line breaking at 80 characters for a moment :D
-        a0 = ((M[2][0]*M[3][2]-M[2][2]*M[3][0])*M[1][1]-M[1][2]*M[2][0]*M[3][1]-M[1][0]*M[2][1]*M[3][2]+M[1][0]*M[2][2]*M[3][1]+M[1][2]*M[2][1]*M[3][0])*M[0][3]+(M[0][2]*M[2][3]*M[3][0]-M[0][2]*M[2][0]*M[3][3]+M[0][0]*M[2][2]*M[3][3]-M[0][0]*M[2][3]*M[3][2])*M[1][1]+(M[0][1]*M[1][3]*M[3][0]-M[0][1]*M[1][0]*M[3][3]-M[0][0]*M[1][3]*M[3][1])*M[2][2]+(-M[0][1]*M[1][2]*M[2][3]-M[0][2]*M[1][3]*M[2][1])*M[3][0]+((M[2][3]*M[3][1]-M[2][1]*M[3][3])*M[1][2]+M[2][1]*M[3][2]*M[1][3])*M[0][0]+(M[1][0]*M[2][3]*M[3][2]+M[2][0]*(M[1][2]*M[3][3]-M[1][3]*M[3][2]))*M[0][1]+((M[2][1]*M[3][3]-M[2][3]*M[3][1])*M[1][0]+M[1][3]*M[2][0]*M[3][1])*M[0][2]
-        a1 = (((M[3][0]-2.*M[2][2])*M[1][1]-M[1][0]*M[3][1]+M[2][2]*M[3][0]+2.*M[1][2]*M[2][1]-M[2][0]*M[3][2])*M[0][3]+(2.*M[2][0]*M[3][2]-M[0][0]*M[3][3]-2.*M[2][2]*M[3][0]+2.*M[0][2]*M[2][3])*M[1][1]+(-M[0][0]*M[3][3]+2.*M[0][1]*M[1][3]+2.*M[1][0]*M[3][1])*M[2][2]+(-M[0][1]*M[1][3]+2.*M[1][2]*M[2][1]-M[0][2]*M[2][3])*M[3][0]+(M[1][3]*M[3][1]+M[2][3]*M[3][2])*M[0][0]+(M[1][0]*M[3][3]-2.*M[1][2]*M[2][3])*M[0][1]+(M[2][0]*M[3][3]-2.*M[1][3]*M[2][1])*M[0][2]-2.*M[1][2]*M[2][0]*M[3][1]-2.*M[1][0]*M[2][1]*M[3][2])
-        a2 = ((2.*M[1][1]-M[3][0]+2.*M[2][2])*M[0][3]+(2.*M[3][0]-4.*M[2][2])*M[1][1]-2.*M[2][0]*M[3][2]+2.*M[2][2]*M[3][0]+M[0][0]*M[3][3]+4.*M[1][2]*M[2][1]-2.*M[0][1]*M[1][3]-2.*M[1][0]*M[3][1]-2.*M[0][2]*M[2][3])
-        a3 = (-2.*M[3][0]+4.*M[1][1]+4.*M[2][2]-2.*M[0][3])
-        a4 = -4.
-
-        def char_pol(x):
-            return a0 + a1*x + a2*x**2 + a3*x**3 + a4*x**4
-
-        def d_char_pol(x):
-            return a1 + 2*a2*x + 3*a3*x**2 + 4*a4*x**3
-
-        eta = spopt.newton(char_pol, 0., fprime=d_char_pol)
-
-        M[3][0] = M[3][0] + 2*eta
-        M[0][3] = M[0][3] + 2*eta
-        M[1][1] = M[1][1] - eta
-        M[2][2] = M[2][2] - eta
-
-        U,s,Vt = np.linalg.svd(M)
-        A_vec = Vt[np.argmin(s),:]
+    @classmethod
+    def _fit_circle_batch(cls, z_data):
+        """
+        Analytical circle fit (cf. _fit_circle()) of a stack of traces z_data
+        with shape (n_traces, n_points). All traces are fit at once.
+
+        The characteristic polynomial det(M - eta*B) of the matrix of moments M
+        and the constraint B is not expanded. Its roots are the eigenvalues of
+        B^-1 M and the eigenvectors are the null vectors of M - eta*B. Because
+        M is positive semidefinite and B has exactly one negative eigenvalue,
+        exactly one root is negative and the wanted smallest non-negative root
+        is the second smallest eigenvalue.
+        outputs:
+        - xc, yc, r0: Arrays of shape (n_traces,) with center and radius
+        """
+
+        # Normalize circles to deal with comparable numbers
+        x_min, x_max = np.min(z_data.real, axis=-1), np.max(z_data.real, axis=-1)
+        y_min, y_max = np.min(z_data.imag, axis=-1), np.max(z_data.imag, axis=-1)
+        x_norm = 0.5*(x_max + x_min)
+        y_norm = 0.5*(y_max + y_min)
+        # Max. distance to center of bounding box is bounded by its half
+        # diagonal which avoids another pass through the data
+        amp_norm = 0.5*np.hypot(x_max - x_min, y_max - y_min)
+        amp_norm[amp_norm == 0] = 1.
+
+        # Matrices of moments with shape (n_traces, 4, 4), averaged over points
+        if numba_enable:
+            M = _circle_moments_compiled(z_data, x_norm, y_norm, amp_norm)
+        else:
+            M = _circle_moments(z_data, x_norm, y_norm, amp_norm)
+
+        eta, A_vec = np.linalg.eig(np.matmul(cls._circle_constraint_inv, M))
+        eta = eta.real
+        second_smallest = np.argsort(eta, axis=-1)[:, 1]
+        A_vec = A_vec[np.arange(len(eta)), :, second_smallest].real.T
 
         xc = -A_vec[1]/(2.*A_vec[0])
         yc = -A_vec[2]/(2.*A_vec[0])
@@ -339,7 +622,7 @@ class circuit:
 
         return xc*amp_norm+x_norm, yc*amp_norm+y_norm, r0*amp_norm
 
-    def _fit_phase(self, z_data, guesses=None):
+    def _fit_phase(self, z_data, guesses=None, single_stage=None):
         """
         Fits the phase response of a strongly overcoupled (Qi >> Qc) resonator
         in reflection which corresponds to a circle centered around the origin
@@ -350,6 +633,9 @@ class circuit:
         - guesses (opt.): If not given, initial guesses for the fit parameters
                           will be determined. If given, should contain useful
                           guesses for fit parameters as a tuple (fr, Ql, delay)
+                          or (fr, Ql, delay, theta)
+        - single_stage (opt.): Fit all parameters at once if guesses are given.
+                               Defaults to phase_fit_single_stage.
         outputs:
         - fr: Resonance frequency
         - Ql: Loaded quality factor
@@ -377,57 +663,185 @@ class circuit:
             #phase_smooth = splrep(self.f_data, phase, k=5, s=100)
             #phase_derivative = splev(self.f_data, phase_smooth, der=1)
             phase_smooth = gaussian_filter1d(phase, 30)
-            phase_derivative = np.gradient(phase_smooth)
+            # Derivative with respect to frequency, not to the point index, as
+            # the points may be non-uniformly spaced
+            phase_derivative = self._frequency_derivative(phase_smooth, self.f_data)
             fr_guess = self.f_data[np.argmax(np.abs(phase_derivative))]
             Ql_guess = 2*fr_guess / (self.f_data[-1] - self.f_data[0])
             # Estimate delay from background slope of phase (substract roll-off)
             slope = phase[-1] - phase[0] + roll_off
             delay_guess = -slope / (2*np.pi*(self.f_data[-1]-self.f_data[0]))
         else:
-            fr_guess, Ql_guess, delay_guess = guesses
+            fr_guess, Ql_guess, delay_guess = guesses[:3]
         # This one seems stable and we do not need a manual guess for it
         theta_guess = 0.5*(np.mean(phase[:5]) + np.mean(phase[-5:]))
+        if guesses is not None and len(guesses) > 3:
+            # Given offset phase, shifted to the branch of the unwrapped data
+            theta_guess += self._periodic_boundary(guesses[3] - theta_guess)
+
+        params = np.array([fr_guess, Ql_guess, theta_guess, delay_guess])
+
+        def residuals(p, free):
+            # Shortest distance on circle, its square equals _phase_dist()**2
+            # but it is differentiable
+            params[free] = p
+            res = phase - self.phase_centered(self.f_data, *params)
+            return res - 2*np.pi*np.round(res / (2*np.pi))
+
+        def jacobian(p, free):
+            # Only derivatives of varied parameters, one row per parameter
+            params[free] = p
+            J = np.empty((len(free), len(self.f_data)))
+            for row, derivative in enumerate(self._phase_centered_derivatives(
+                    self.f_data, *params, free=free)):
+                np.negative(derivative, out=J[row])
+            return J
+
+        def fit_stage(free):
+            p_final, _, info, _, ier = spopt.leastsq(
+                residuals, params[free], args=(free,), Dfun=jacobian,
+                full_output=True, col_deriv=True
+            )
+            self.phase_fit_nfev += info["nfev"]
+            self.phase_fit_njev += info["njev"]
+            params[free] = p_final
+            return ier in (1, 2, 3, 4)
+
+        if single_stage is None:
+            single_stage = self.phase_fit_single_stage
+        if single_stage and guesses is not None:
+            # Good guesses: a single fit of all parameters is sufficient
+            guess = params.copy()
+            if fit_stage(list(self._phase_fit_stages[-1])):
+                return params
+            params[:] = guess
 
         # Fit model with less parameters first to improve stability of fit
+        for free in self._phase_fit_stages:
+            fit_stage(list(free))
 
-        def residuals_Ql(params):
-            Ql, = params
-            return residuals_full((fr_guess, Ql, theta_guess, delay_guess))
-        def residuals_fr_theta(params):
-            fr, theta = params
-            return residuals_full((fr, Ql_guess, theta, delay_guess))
-        # def residuals_Ql_delay(params):
-        # Ql, delay = params
-        # return residuals_full((fr_guess, Ql, theta_guess, delay))
-        def residuals_delay(params):
-            delay, = params
-            return residuals_full((fr_guess, Ql_guess, theta_guess, delay))
-        def residuals_fr_Ql(params):
-            fr, Ql = params
-            return residuals_full((fr, Ql, theta_guess, delay_guess))
-        # def residuals_fr(params):
-        # fr, = params
-        # return residuals_full((fr, Ql_guess, theta_guess, delay_guess))
-        def residuals_full(params):
-            return self._phase_dist(
-                phase - circuit.phase_centered(self.f_data, *params)
+        return params
+
+    # Parameters (indices into (fr, Ql, theta, delay)) varied in the consecutive
+    # stages of the phase fit. Fitting models with less parameters first
+    # improves the stability of the fit.
+    _phase_fit_stages = ((1,), (0, 2), (3,), (0, 1), (0, 1, 2, 3))
+
+    @classmethod
+    def _fit_phase_batch(cls, f_data, z_data, guesses=None):
+        """
+        Vectorized version of _fit_phase() for a stack of centered traces
+        z_data with shape (n_traces, n_points).
+        inputs:
+        - guesses (opt.): Tuple (fr, Ql, delay) of scalars or arrays of shape
+                          (n_traces,)
+        outputs:
+        - fr, Ql, theta, delay: Arrays of shape (n_traces,)
+        """
+        n_traces = len(z_data)
+        f_span = f_data[-1] - f_data[0]
+        phase = np.unwrap(np.angle(z_data), axis=-1)
+
+        # For centered circle roll-off should be close to 2pi. If not warn user.
+        phase_range = np.max(phase, axis=-1) - np.min(phase, axis=-1)
+        partial = phase_range <= 0.8*2*np.pi
+        if np.any(partial):
+            logging.warning(
+                f"{np.count_nonzero(partial)} of {n_traces} traces do not cover a"
+                " full circle. Increase the frequency span around the resonance?"
             )
+        roll_off = np.where(partial, phase_range, 2*np.pi)
 
-        p_final = spopt.leastsq(residuals_Ql, [Ql_guess])
-        Ql_guess, = p_final[0]
-        p_final = spopt.leastsq(residuals_fr_theta, [fr_guess, theta_guess])
-        fr_guess, theta_guess = p_final[0]
-        p_final = spopt.leastsq(residuals_delay, [delay_guess])
-        delay_guess, = p_final[0]
-        p_final = spopt.leastsq(residuals_fr_Ql, [fr_guess, Ql_guess])
-        fr_guess, Ql_guess = p_final[0]
-        # p_final = spopt.leastsq(residuals_fr, [fr_guess])
-        # fr_guess, = p_final[0]
-        # p_final = spopt.leastsq(residuals_Ql, [Ql_guess])
-        # Ql_guess, = p_final[0]
-        p_final = spopt.leastsq(residuals_full, [fr_guess, Ql_guess, theta_guess, delay_guess])
-
-        return p_final[0]
+        # Set useful starting parameters (cf. _fit_phase())
+        if guesses is None:
+            phase_smooth = gaussian_filter1d(phase, 30, axis=-1)
+            phase_derivative = cls._frequency_derivative(phase_smooth, f_data)
+            fr_guess = f_data[np.argmax(np.abs(phase_derivative), axis=-1)]
+            Ql_guess = 2*fr_guess / f_span
+            slope = phase[:, -1] - phase[:, 0] + roll_off
+            delay_guess = -slope / (2*np.pi*f_span)
+        else:
+            fr_guess, Ql_guess, delay_guess = (
+                np.broadcast_to(np.asarray(guess, dtype=float), (n_traces,))
+                for guess in guesses
+            )
+        theta_guess = 0.5*(np.mean(phase[:, :5], axis=-1)
+                           + np.mean(phase[:, -5:], axis=-1))
+
+        params = np.stack([fr_guess, Ql_guess, theta_guess, delay_guess], axis=-1)
+        for free in cls._phase_fit_stages:
+            params = cls._leastsq_phase_batch(f_data, phase, params, free)
+
+        return params.T
+
+    @classmethod
+    def _leastsq_phase_batch(cls, f_data, phase, params, free,
+                             max_iterations=200, tol=1.49012e-8):
+        """
+        Levenberg-Marquardt fit of phase_centered() to a stack of unwrapped
+        phases with shape (n_traces, n_points). Only the parameters with
+        indices in free are varied, the other ones are kept at their value in
+        params (shape (n_traces, 4)). Traces are dropped from the iteration as
+        soon as they converged.
+        """
+        free = list(free)
+        params = np.array(params, dtype=float)
+        n_traces = len(params)
+
+        def residuals(p, rows):
+            # Shortest distance on circle, its square equals _phase_dist()**2
+            res = phase[rows] - cls.phase_centered(f_data, *p.T[:, :, np.newaxis])
+            return res - 2*np.pi*np.round(res / (2*np.pi))
+
+        rows = np.arange(n_traces)
+        res = residuals(params, rows)
+        cost = np.sum(res*res, axis=-1)
+        damping = np.full(n_traces, 1e-3)
+        active = np.ones(n_traces, dtype=bool)
+        for _ in range(max_iterations):
+            idx = np.flatnonzero(active)
+            if len(idx) == 0:
+                break
+            p = params[idx]
+            J = cls._phase_centered_derivatives(
+                f_data, *p.T[:, :, np.newaxis], free=free
+            )
+            # Normal equations, columns scaled to unit length as the parameters
+            # differ by many orders of magnitude
+            JtJ = np.empty((len(idx), len(free), len(free)))
+            Jtr = np.empty((len(idx), len(free)))
+            for i in range(len(free)):
+                Jtr[:, i] = np.sum(J[i]*res[idx], axis=-1)
+                for j in range(i+1):
+                    JtJ[:, i, j] = JtJ[:, j, i] = np.sum(J[i]*J[j], axis=-1)
+            scale = np.sqrt(np.diagonal(JtJ, axis1=-2, axis2=-1))
+            scale = np.where(scale == 0, 1., scale)
+            JtJ /= scale[:, :, np.newaxis]*scale[:, np.newaxis, :]
+            JtJ += damping[idx, np.newaxis, np.newaxis]*np.eye(len(free))
+            step = np.linalg.solve(JtJ, (Jtr/scale)[..., np.newaxis])[..., 0]
+            step /= scale
+
+            p_new = p.copy()
+            p_new[:, free] += step
+            res_new = residuals(p_new, idx)
+            cost_new = np.sum(res_new*res_new, axis=-1)
+
+            improved = cost_new <= cost[idx]
+            converged = (
+                (cost[idx] - cost_new <= tol*cost[idx])
+                | np.all(np.abs(step) <= tol*(np.abs(p[:, free]) + tol), axis=-1)
+            )
+            accept = idx[improved]
+            params[accept] = p_new[improved]
+            res[accept] = res_new[improved]
+            cost[accept] = cost_new[improved]
+            damping[idx] = np.where(
+                improved, np.maximum(0.1*damping[idx], 1e-12), 10.*damping[idx]
+            )
+            active[idx[improved & converged]] = False
+            active[damping > 1e10] = False
+
+        return params
 
     @classmethod
     def phase_centered(cls, f, fr, Ql, theta, delay=0.):
@@ -445,13 +859,59 @@ class circuit:
         """
         return theta - 2*np.pi*delay*(f-fr) + 2.*np.arctan(2.*Ql*(1. - f/fr))
 
-    def _phase_dist(self, angle):
+    @classmethod
+    def phase_centered_jacobian(cls, f, fr, Ql, theta, delay=0.):
+        """
+        Derivatives of phase_centered() w.r.t. fr, Ql, theta and delay, stacked
+        along the last axis (shape (..., n_points, 4)).
+        """
+        return np.stack(np.broadcast_arrays(
+            *cls._phase_centered_derivatives(f, fr, Ql, theta, delay)
+        ), axis=-1)
+
+    @staticmethod
+    def _phase_centered_derivatives(f, fr, Ql, theta, delay=0.,
+                                    free=(0, 1, 2, 3)):
+        """
+        Derivatives of phase_centered() w.r.t. fr, Ql, theta and delay. Only
+        the derivatives w.r.t. the parameters with indices in free are
+        calculated, in this order.
+        """
+        f_rel = 1. - f/fr
+        if 0 in free or 1 in free:
+            darctan = 4. / (1. + 4.*Ql*Ql*f_rel*f_rel)
+        derivatives = []
+        for i in free:
+            if i == 0:
+                derivatives.append(2*np.pi*delay + darctan*Ql*(1. - f_rel)/fr)
+            elif i == 1:
+                derivatives.append(darctan*f_rel)
+            elif i == 2:
+                derivatives.append(np.ones_like(f_rel))
+            else:
+                derivatives.append(2*np.pi*fr*f_rel)
+        return derivatives
+
+    @staticmethod
+    def _frequency_derivative(y, f):
+        """
+        Derivative of y along the last axis with respect to the (possibly
+        non-uniformly spaced) frequencies f. Repeated frequencies (e.g. at
+        the boundaries of segments) are tolerated.
+        """
+        df = np.gradient(f)
+        df[df == 0] = np.inf
+        return np.gradient(y, axis=-1) / df
+
+    @staticmethod
+    def _phase_dist(angle):
         """
         Maps angle [-2pi, +2pi] to phase distance on circle [0, pi]
         """
         return np.pi - np.abs(np.pi - np.abs(angle))
 
-    def _periodic_boundary(self, angle):
+    @staticmethod
+    def _periodic_boundary(angle):
         """
         Maps arbitrary angle to interval [-np.pi, np.pi)
         """
@@ -469,7 +929,23 @@ class circuit:
         """
         Calculates reduced chi square and covariance matrix for fit.
         """
-        residuals = self._get_residuals()
+        chi_square, cov = self._covariance(
+            self.f_data, self._get_residuals(), self.fr, self.Ql, self.absQc,
+            self.phi
+        )
+        if np.any(np.isnan(cov)):
+            cov = None
+        return chi_square, cov
+
+    @classmethod
+    def _covariance(cls, f, residuals, fr, Ql, absQc, phi):
+        """
+        Calculates reduced chi square and covariance matrix from the residuals
+        of the normalized data. Works on single traces as well as on stacks of
+        traces with residuals of shape (n_traces, n_points) and parameters of
+        shape (n_traces, 1). Covariance matrices which cannot be calculated are
+        filled with NaN.
+        """
         chi = np.abs(residuals)
         # Unit vectors pointing in the correct directions for the derivative
         directions = residuals / chi
@@ -477,90 +953,134 @@ class circuit:
         conj_directions = np.conj(directions)
 
         # Construct transpose of Jacobian matrix
-        Jt = np.array([
-            np.real(self._dSij_dfr()*conj_directions),
-            np.real(self._dSij_dQl()*conj_directions),
-            np.real(self._dSij_dabsQc()*conj_directions),
-            np.real(self._dSij_dphi()*conj_directions)
-        ])
-        A = np.dot(Jt, np.transpose(Jt))
+        Jt = np.stack([
+            np.real(dSij*conj_directions)
+            for dSij in cls._dSij_dparams(f, fr, Ql, absQc, phi)
+        ], axis=-2)
+        A = np.matmul(Jt, np.swapaxes(Jt, -1, -2))
         # 4 fit parameters reduce degrees of freedom for reduced chi square
-        chi_square = 1./float(len(self.f_data)-4) * np.sum(chi**2)
+        chi_square = 1./float(np.shape(f)[-1]-4) * np.sum(chi**2, axis=-1)
         try:
-            cov = np.linalg.inv(A)*chi_square
-        except:
-            cov = None
-        return chi_square, cov
+            cov = np.linalg.inv(A)
+        except np.linalg.LinAlgError:
+            # Invert one by one to only lose the singular ones
+            cov = np.full(A.shape, np.nan)
+            for i in np.ndindex(A.shape[:-2]):
+                try:
+                    cov[i] = np.linalg.inv(A[i])
+                except np.linalg.LinAlgError:
+                    pass
+        return chi_square, cov*np.asarray(chi_square)[..., np.newaxis, np.newaxis]
 
-    def _dSij_dfr(self):
+    @classmethod
+    def _dSij_dparams(cls, f, fr, Ql, absQc, phi):
         """
-        Derivative of Sij w.r.t. fr
+        Derivatives of Sij w.r.t. fr, Ql, absQc and phi
         """
-        return -4j*self.Ql**2*np.exp(1j*self.phi)*self.f_data / (
-                self.n_ports * self.absQc*(self.fr+2j*self.Ql*(self.f_data-self.fr))**2
+        denominator = 1.+2j*Ql*(f/fr-1)
+        dfr = -4j*Ql**2*np.exp(1j*phi)*f / (
+                cls.n_ports * absQc*(fr+2j*Ql*(f-fr))**2
         )
-
-    def _dSij_dQl(self):
-        """
-        Derivative of Sij w.r.t. Ql
-        """
-        return -2.*np.exp(1j*self.phi) / (
-                self.n_ports * self.absQc*(1.+2j*self.Ql*(self.f_data/self.fr-1))**2
+        dQl = -2.*np.exp(1j*phi) / (
+                cls.n_ports * absQc*denominator**2
         )
-
-    def _dSij_dabsQc(self):
-        """
-        Derivative of Sij w.r.t. absQc
-        """
-        return 2.*self.Ql*np.exp(1j*self.phi) / (
-                self.n_ports * self.absQc**2 * (1.+2j*self.Ql*(self.f_data/self.fr-1))
+        dabsQc = 2.*Ql*np.exp(1j*phi) / (
+                cls.n_ports * absQc**2 * denominator
+        )
+        dphi = -2j*Ql*np.exp(1j*phi) / (
+                cls.n_ports * absQc * denominator
         )
+        return dfr, dQl, dabsQc, dphi
 
-    def _dSij_dphi(self):
+    @staticmethod
+    def _Qi_errors(Ql, absQc, Qc, phi, cov):
         """
-        Derivative of Sij w.r.t. phi
+        Calculates errors of Qi with and without diameter correction by error
+        propagation from covariance matrix cov (shape (..., 4, 4)) of fr, Ql,
+        absQc and phi.
         """
-        return -2j*self.Ql*np.exp(1j*self.phi) / (
-                self.n_ports * self.absQc * (1.+2j*self.Ql*(self.f_data/self.fr-1))
+        # without diameter correction
+        dQl = 1. / ((1./Ql - 1./absQc) * Ql)**2
+        dabsQc = -1. / ((1./Ql - 1./absQc) * absQc)**2
+        Qi_no_dia_corr_err = np.sqrt(
+            dQl**2*cov[..., 1, 1]
+            + dabsQc**2*cov[..., 2, 2]
+            + 2.*dQl*dabsQc*cov[..., 1, 2]
         )
+        # with diameter correction
+        dQl = 1. / ((1./Ql - 1./Qc) * Ql)**2
+        dabsQc = -np.cos(phi) / (
+                (1./Ql - 1./Qc) * absQc
+        )**2
+        dphi = -np.sin(phi) / (
+                (1./Ql - 1./Qc)**2 * absQc
+        )
+        Qi_err = np.sqrt(
+            dQl**2*cov[..., 1, 1]
+            + dabsQc**2*cov[..., 2, 2]
+            + dphi**2*cov[..., 3, 3]
+            + 2*(
+                    dQl*dabsQc*cov[..., 1, 2]
+                    + dQl*dphi*cov[..., 1, 3]
+                    + dabsQc*dphi*cov[..., 2, 3]
+            )
+        )
+        return Qi_err, Qi_no_dia_corr_err
 
     """
     Functions for plotting results
     """
-    def plotall(self, file_path=None):
+    def plotall(self, file_path=None, figure=None):
+        """
+        Plot the data and the fit in the complex plane, magnitude and phase
+        together with the fit results.
+
+        inputs:
+        - file_path (opt.): File the plot is saved to. If not given, the plot
+                            is shown.
+        - figure (opt.): matplotlib Figure to draw on, e.g. with an Agg canvas
+                         outside of the main thread. It is only saved to
+                         file_path, pyplot is not used at all. By default the
+                         current pyplot figure.
+        """
         if not plot_enable:
             raise ImportError("matplotlib not found")
         real = self.z_data_raw.real
         imag = self.z_data_raw.imag
         real2 = self.z_data_sim.real
         imag2 = self.z_data_sim.imag
-        plt.subplot(221, aspect="equal")
-        plt.axvline(0, c="k", ls="--", lw=1)
-        plt.axhline(0, c="k", ls="--", lw=1)
-        plt.plot(real,imag,label='rawdata')
-        plt.plot(real2,imag2,label='fit')
-        plt.xlabel('Re(S21)')
-        plt.ylabel('Im(S21)')
-        plt.legend()
-        plt.subplot(222)
-        plt.plot(self.f_data*1e-9,np.absolute(self.z_data_raw),label='rawdata')
-        plt.plot(self.f_data*1e-9,np.absolute(self.z_data_sim),label='fit')
-        plt.xlabel('f (GHz)')
-        plt.ylabel('|S21|')
-        plt.legend()
-        plt.subplot(223)
-        plt.plot(self.f_data*1e-9,np.angle(self.z_data_raw),label='rawdata')
-        plt.plot(self.f_data*1e-9,np.angle(self.z_data_sim),label='fit')
-        plt.xlabel('f (GHz)')
-        plt.ylabel('arg(|S21|)')
-        plt.legend()
-        ax = plt.subplot(224)
+        fig = plt.gcf() if figure is None else figure
+        ax = fig.add_subplot(221, aspect="equal")
+        ax.axvline(0, c="k", ls="--", lw=1)
+        ax.axhline(0, c="k", ls="--", lw=1)
+        ax.plot(real,imag,label='rawdata')
+        ax.plot(real2,imag2,label='fit')
+        ax.set_xlabel('Re(S21)')
+        ax.set_ylabel('Im(S21)')
+        ax.legend()
+        ax = fig.add_subplot(222)
+        ax.plot(self.f_data*1e-9,np.absolute(self.z_data_raw),label='rawdata')
+        ax.plot(self.f_data*1e-9,np.absolute(self.z_data_sim),label='fit')
+        ax.set_xlabel('f (GHz)')
+        ax.set_ylabel('|S21|')
+        ax.legend()
+        ax = fig.add_subplot(223)
+        ax.plot(self.f_data*1e-9,np.angle(self.z_data_raw),label='rawdata')
+        ax.plot(self.f_data*1e-9,np.angle(self.z_data_sim),label='fit')
+        ax.set_xlabel('f (GHz)')
+        ax.set_ylabel('arg(|S21|)')
+        ax.legend()
+        ax = fig.add_subplot(224)
         ax.axis([0, 10, 0, 10])
         ax.text(1, 9, "fit params:")
         i = 7.5
         for key in ["fr", "Ql", "Qc", "Qi", "Qi_err"]:
             ax.text(1, i, f"{key}: {self.fitresults[key]}", fontsize=10)
             i -= 1.5
+        if figure is not None:
+            if file_path is not None:
+                figure.savefig(file_path)
+            return
         if file_path is not None:
             plt.savefig(file_path)
         else:
@@ -615,13 +1135,25 @@ class circuit:
     Functions for saving
     """
 
-    def save_fitresults(self, path):
-        # save tab separated data
-        with open(path + ".fit", "w+") as handle:
-            lines = []
-            for key in self.fitresults:
-                lines.append(str(key) + "\t" + str(self.fitresults[key]) + "\n")
-            handle.writelines(lines)
+    def save_fitresults(self, path, catalog=None, **metadata):
+        """
+        Save the fit results as tab separated file and/or into a fit catalog.
+
+        inputs:
+        - path: Path of the file without suffix, None for no file
+        - catalog (opt.): FitCatalog the results are added to
+        - metadata (opt.): chip, resonator, power and attenuation for the
+                           catalog, see FitCatalog.add
+        """
+        if path is not None:
+            # save tab separated data
+            with open(path + ".fit", "w+") as handle:
+                lines = []
+                for key in self.fitresults:
+                    lines.append(str(key) + "\t" + str(self.fitresults[key]) + "\n")
+                handle.writelines(lines)
+        if catalog is not None:
+            catalog.add(self.fitresults, path=path, **metadata)
 
 class reflection_port(circuit):
     """
@@ -0,0 +1,168 @@
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+import json
+import logging
+import os
+from PyLab.Measurement import Measurement
+from PyLab.CircleFit import notch_port
+
+
+"""
+persistent store for the cable delay (and background amplitude) of a measurement setup. The delay is a property of the
+wiring, not of the resonator, so once it is known for a setup the circle fits can skip the delay search.
+"""
+
+
+class DelayCalibration:
+
+    def __init__(self, path=r"D:\Measurements\Resonators\delay_calibration.json", max_gap=0.5e9,
+                 drift_tolerance=0.05):
+        """
+        Open (or create) a delay calibration store
+
+        :param path: path of the JSON file holding the calibration points
+        :param max_gap: maximum distance in Hz to the closest calibration point for which a delay is returned
+        :param drift_tolerance: phase in rad which the remaining delay may accumulate over the span of a fit before the
+                                calibration is considered outdated
+        """
+        self._path = Path(path)
+        self._max_gap = max_gap
+        self._drift_tolerance = drift_tolerance
+
+        self._points = {}
+        if self._path.exists():
+            with open(self._path) as handle:
+                self._points = json.load(handle)
+
+    @staticmethod
+    def get_key(measurement: Measurement):
+        """
+        Get the key of the setup a measurement belongs to
+
+        :param measurement: a Measurement object
+        :return: key built from operator, chip and line configuration
+        """
+        return f"{measurement.get_operator()}|{measurement.get_chip()}|{measurement.get_line()}"
+
+    def calibrate(self, measurement: Measurement, chunk_width=50e6):
+        """
+        Calibrate the delay from a wide-span reference measurement. The slope of the unwrapped phase is evaluated in
+        chunks, the median of the local slopes ignores the phase roll-off of resonances within a chunk. The point
+        spacing must be small enough to unwrap the background phase, i.e. well below 1/(2*delay).
+
+        :param measurement: measured wide-span Measurement object
+        :param chunk_width: frequency width of the chunks in Hz
+        :return: frequencies and delays of the new calibration points
+        """
+        frequencies = np.asarray(measurement.get_frequencies(), dtype=float)
+        data = np.asarray(measurement.get_data())
+        if len(frequencies) != len(data):
+            raise ValueError("frequency and data size do not match")
+
+        slope = np.gradient(np.unwrap(np.angle(data)), frequencies)
+        n_chunks = max(int((frequencies[-1] - frequencies[0]) / chunk_width), 1)
+
+        # points of the calibrated band are replaced
+        self._remove_points(measurement, frequencies[0], frequencies[-1])
+        f_points = []
+        delays = []
+        for chunk in np.array_split(np.arange(len(frequencies)), n_chunks):
+            f_points.append(np.mean(frequencies[chunk]))
+            delays.append(-np.median(slope[chunk]) / (2*np.pi))
+            self._add_point(measurement, f_points[-1], delays[-1], np.median(np.abs(data[chunk])))
+        self.save()
+
+        return np.array(f_points), np.array(delays)
+
+    def get_delay(self, measurement: Measurement):
+        """
+        Get the delay for a measurement by linear interpolation between the calibration points of its setup
+
+        :param measurement: a Measurement object
+        :return: the delay in s or None, if there is no calibration point close enough
+        """
+        return self._interpolate(measurement, "delay")
+
+    def get_background(self, measurement: Measurement):
+        """
+        Get the off-resonant amplitude for a measurement by linear interpolation between the calibration points
+
+        :param measurement: a Measurement object
+        :return: the amplitude or None, if there is no calibration point close enough
+        """
+        return self._interpolate(measurement, "a")
+
+    def add(self, measurement: Measurement, fit):
+        """
+        Add the result of a circle fit with free delay as calibration point at the resonance frequency
+
+        :param measurement: the fitted Measurement object
+        :param fit: the fit object (or its fitresults)
+        """
+        fitresults = fit if isinstance(fit, dict) else fit.fitresults
+        frequencies = measurement.get_frequencies()
+        self._remove_points(measurement, frequencies[0], frequencies[-1])
+        self._add_point(measurement, fitresults["fr"], fitresults["delay"], fitresults.get("a", np.nan))
+        self.save()
+
+    def autofit(self, measurement: Measurement, port=notch_port, **kwargs):
+        """
+        Fit a measurement with the calibrated delay. If there is no calibration point close to the measurement or the
+        remaining delay of the fit shows a drift of the setup, the delay is fit and the calibration is refreshed.
+
+        :param measurement: the measured Measurement object
+        :param port: circle fit class, notch_port by default
+        :param kwargs: further arguments for autofit()
+        :return: the fit object
+        """
+        frequencies = np.asarray(measurement.get_frequencies(), dtype=float)
+        fit = port(frequencies, measurement.get_data())
+
+        delay = self.get_delay(measurement)
+        if delay is not None:
+            fit.autofit(fixed_delay=delay, **kwargs)
+            drift = 2*np.pi*(frequencies[-1] - frequencies[0])*abs(fit.fitresults["delay_remaining"])
+            if drift <= self._drift_tolerance:
+                return fit
+            logging.info(f"Delay calibration drifted ({drift:.3f} rad over span), refitting the delay.")
+            fit = port(frequencies, measurement.get_data())
+
+        fit.autofit(**kwargs)
+        self.add(measurement, fit)
+        return fit
+
+    def save(self):
+        """
+        Write the calibration points to disk (atomically, via a temporary file)
+        """
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_name(self._path.name + ".tmp")
+        with open(tmp_path, "w") as handle:
+            json.dump(self._points, handle, indent=1)
+        os.replace(tmp_path, self._path)
+
+    # Utility methods
+
+    def _add_point(self, measurement, frequency, delay, amplitude):
+        points = self._points.setdefault(self.get_key(measurement), [])
+        points.append({"f": float(frequency), "delay": float(delay), "a": float(amplitude),
+                       "time": datetime.now().isoformat(timespec="seconds")})
+        points.sort(key=lambda point: point["f"])
+
+    def _remove_points(self, measurement, f_start, f_end):
+        key = self.get_key(measurement)
+        self._points[key] = [point for point in self._points.get(key, []) if not f_start <= point["f"] <= f_end]
+
+    def _interpolate(self, measurement, quantity):
+        points = [point for point in self._points.get(self.get_key(measurement), [])
+                  if np.isfinite(point[quantity])]
+        if len(points) == 0:
+            return None
+
+        frequencies = np.asarray(measurement.get_frequencies(), dtype=float)
+        f_center = 0.5*(frequencies[0] + frequencies[-1])
+        f_points = np.array([point["f"] for point in points])
+        if np.min(np.abs(f_points - f_center)) > self._max_gap:
+            return None
+        return float(np.interp(f_center, f_points, [point[quantity] for point in points]))
@@ -0,0 +1,209 @@
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import numbers
+import os
+import re
+import sqlite3
+
+
+"""
+catalog of fit results in an SQLite file, indexed by chip, resonator, power, attenuation and time. Each fit result key is
+a column, so any set of keys is read in a single query.
+"""
+
+
+# columns describing a fit, all other columns are fit results
+COLUMNS = {"chip": "TEXT", "resonator": "TEXT", "power": "REAL", "attenuation": "REAL", "time": "TEXT",
+           "directory": "TEXT", "path": "TEXT UNIQUE"}
+
+
+class FitCatalog:
+
+    def __init__(self, path):
+        """
+        Open a fit catalog, it is created if it does not exist. Several processes can write to the same catalog.
+
+        :param path: path of the SQLite file, ":memory:" for a temporary catalog
+        """
+        self.path = str(path)
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # transactions are started explicitly, see _transaction()
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        if self.path != ":memory:":
+            # readers do not block the writer
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+        with self._transaction():
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS fits (id INTEGER PRIMARY KEY, {columns})")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fits_resonator ON fits (chip, resonator, power)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fits_attenuation ON fits (attenuation)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fits_time ON fits (time)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fits_directory ON fits (directory)")
+
+    def add(self, fitresults, chip="", resonator="", power=np.nan, attenuation=0., time=None, path=None,
+            directory=None):
+        """
+        Add the results of a fit. A fit with the same path replaces the previous one.
+
+        :param fitresults: dictionary of fit results, e.g. fitresults of a circle fit
+        :param chip: name of the chip
+        :param resonator: name or number of the resonator
+        :param power: power of the VNA in dBm
+        :param attenuation: attenuation of the input line in dB (negative), the power at the chip is power + attenuation
+        :param time: time of the fit as ISO string, by default now
+        :param path: path of the fit results file without suffix, if any
+        :param directory: directory of the measurement for get(directories=...), by default the directory of path. A fit
+                          without path and directory is not found by directories.
+        :return: id of the fit in the catalog
+        """
+        time = datetime.now().isoformat(timespec="seconds") if time is None else time
+        if directory is None and path is not None:
+            directory = Path(path).parent
+        row = {"chip": chip, "resonator": str(resonator), "power": float(power), "attenuation": float(attenuation),
+               "time": time, "directory": str(Path(directory)) if directory is not None else None,
+               "path": str(path) if path is not None else None}
+        row.update({key: float(value) for key, value in fitresults.items()
+                    if isinstance(value, numbers.Real) and key not in COLUMNS and key != "id"})
+        with self._transaction():
+            self._add_columns(row)
+            names = ", ".join(f'"{key}"' for key in row)
+            cursor = self._connection.execute(f"INSERT OR REPLACE INTO fits ({names}) VALUES "
+                                              f"({', '.join('?'*len(row))})", list(row.values()))
+        return cursor.lastrowid
+
+    def get(self, keys, chip=None, resonator=None, attenuation=None, directories=None, min_power=None,
+            max_power=None):
+        """
+        Read fit results with a single query, e.g. get(["Qi", "Qi_err"], chip="W5-32", resonator=3)
+
+        :param keys: fit result keys
+        :param chip: only fits of this chip
+        :param resonator: only fits of this resonator
+        :param attenuation: only fits with this attenuation
+        :param directories: only fits saved in these directories, see the directory of add(). Fits added without path
+                            or directory (e.g. of a CampaignStore) are not returned.
+        :param min_power: minimum power at the chip (power + attenuation) in dBm
+        :param max_power: maximum power at the chip in dBm
+        :return: dictionary of np arrays sorted by the power at the chip: the requested keys (NaN if a fit lacks a key),
+                 chip_power, power, attenuation, resonator, chip, time and path
+        """
+        conditions = []
+        arguments = []
+        for column, value in [("chip", chip), ("resonator", resonator), ("attenuation", attenuation)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                arguments.append(str(value) if column == "resonator" else value)
+        if directories is not None:
+            directories = [str(Path(directory)) for directory in directories]
+            conditions.append(f"directory IN ({', '.join('?'*len(directories))})")
+            arguments += directories
+        if min_power is not None:
+            conditions.append("power + attenuation >= ?")
+            arguments.append(min_power)
+        if max_power is not None:
+            conditions.append("power + attenuation <= ?")
+            arguments.append(max_power)
+
+        known = self._columns()
+        selected = [f'"{key}"' if key in known else "NULL" for key in keys]
+        query = (f"SELECT power + attenuation, power, attenuation, resonator, chip, time, path, {', '.join(selected)} "
+                 f"FROM fits{' WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+                 f"ORDER BY power + attenuation, time")
+        rows = self._connection.execute(query, arguments).fetchall()
+
+        names = ["chip_power", "power", "attenuation", "resonator", "chip", "time", "path"]
+        columns = list(zip(*rows)) if len(rows) > 0 else [()]*(len(names) + len(keys))
+        result = {name: np.array(column) for name, column in zip(names, columns)}
+        for name in ["chip_power", "power", "attenuation"]:
+            result[name] = result[name].astype(float)
+        for key, column in zip(keys, columns[len(names):]):
+            result[key] = np.array([np.nan if value is None else value for value in column], dtype=float)
+        return result
+
+    def rebuild(self, directories, chip="", attenuation=-66):
+        """
+        Add the legacy .fit files of directories (not their sub directories) to the catalog. The power and attenuation
+        are parsed from the names like in the old DataAnalysis.get_fit_data, the resonator from a "Res<number>" folder.
+        Files already in the catalog are replaced, so the catalog can be rebuilt at any time.
+
+        :param directories: directories containing .fit files
+        :param chip: name of the chip of the fits
+        :param attenuation: attenuation used if the directory name does not contain one
+        :return: number of fits added
+        """
+        count = 0
+        for directory in directories:
+            directory = str(directory)
+            match = re.search(r'((-)?\d+)dBm', directory)
+            directory_attenuation = int(match.group(1)) if match else attenuation
+            match = re.search(r'Res(\d+)', directory)
+            resonator = match.group(1) if match else ""
+            for filename in sorted(os.listdir(directory)):
+                match = re.search(r'_((-)?\d+)dBm', filename)
+                if not filename.endswith(".fit") or not match:
+                    continue
+                path = Path(directory)/filename
+                try:
+                    fitresults = _read_fit_file(path)
+                except (ValueError, IndexError):
+                    logging.warning(f"Skipping unreadable fit file {path}.")
+                    continue
+                time = datetime.fromtimestamp(path.stat().st_mtime).isoformat(timespec="seconds")
+                self.add(fitresults, chip, resonator, int(match.group(1)), directory_attenuation, time,
+                         path.with_suffix(""))
+                count += 1
+        return count
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    # Utility methods
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction holding the database lock from the start, so that another process can not add the same
+        column between the check and the change of the table
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _columns(self):
+        return {row[1] for row in self._connection.execute("PRAGMA table_info(fits)")}
+
+    def _add_columns(self, row):
+        """
+        Add a column for each new fit result key
+        """
+        known = self._columns()
+        for key in row:
+            if key not in known:
+                if '"' in key:
+                    raise ValueError(f"invalid fit result key {key}")
+                self._connection.execute(f'ALTER TABLE fits ADD COLUMN "{key}" REAL')
+
+
+def _read_fit_file(path):
+    """
+    Read a tab separated fit results file written by circuit.save_fitresults()
+    """
+    fitresults = {}
+    with open(path) as handle:
+        for line in handle:
+            if line.strip() == "":
+                continue
+            key, value = line.rstrip("\n").split("\t")[:2]
+            fitresults[key] = float(value)
+    return fitresults
@@ -0,0 +1,116 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+import numpy as np
+from PyLab.Measurement import Measurement
+from PyLab.CircleFit import notch_port
+from PyLab.FitCatalog import FitCatalog
+
+
+"""
+pool of worker processes fitting and plotting finished measurements while the next sweep is running
+"""
+
+
+def _init_worker():
+    """
+    Use a non-interactive matplotlib backend in the workers, plots are only saved to files
+    """
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+    except ImportError:
+        pass
+
+
+def _fit(port, frequencies, data, fit_path, plot_path, warm_start, catalog, catalog_info, autofit_kwargs):
+    """
+    Fit a single trace, save the fit results and the plot (runs in a worker process)
+
+    :return: the fit results
+    """
+    fit = port(frequencies, data)
+    fit.autofit(warm_start=warm_start, **autofit_kwargs)
+    if catalog is not None:
+        # each worker opens the catalog itself, a connection can not be passed between processes
+        catalog = FitCatalog(catalog)
+        try:
+            fit.save_fitresults(fit_path, catalog, **catalog_info)
+        finally:
+            catalog.close()
+    elif fit_path is not None:
+        fit.save_fitresults(fit_path)
+    if plot_path is not None:
+        fit.plotall(plot_path)
+    return fit.fitresults
+
+
+class FitPipeline:
+
+    def __init__(self, processes=2, port=notch_port, catalog=None):
+        """
+        Start the worker processes. Scripts using the pipeline need an if __name__ == "__main__" guard, as the workers
+        import the main module on Windows.
+
+        :param processes: number of worker processes
+        :param port: circle fit class, notch_port by default
+        :param catalog: path of a FitCatalog file the fit results are added to, None for no catalog
+        """
+        self._port = port
+        self._catalog = None if catalog is None else str(catalog)
+        self._executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+        self._futures = []
+
+    def submit(self, measurement: Measurement, fit_path=None, plot_path=None, warm_start=None, catalog_info=None,
+               **autofit_kwargs):
+        """
+        Hand a finished measurement over to the workers, returns immediately
+
+        :param measurement: the measured Measurement object
+        :param fit_path: path for save_fitresults(), without suffix - or None, if the results shouldn't be saved
+        :param plot_path: path of the plot, e.g. a pdf - or None, if nothing should be plotted
+        :param warm_start: fit results of a previous fit of the same resonator, or the Future of a previous submit().
+                           A Future is only used if it is already finished, the acquisition never waits for it.
+        :param catalog_info: chip, resonator, power and attenuation of the fit for the catalog, see FitCatalog.add()
+        :param autofit_kwargs: further arguments for autofit()
+        :return: a Future resolving to the fit results
+        """
+        if isinstance(warm_start, Future):
+            finished = warm_start.done() and not warm_start.cancelled() and warm_start.exception() is None
+            warm_start = warm_start.result() if finished else None
+
+        future = self._executor.submit(_fit, self._port, np.asarray(measurement.get_frequencies()),
+                                       np.asarray(measurement.get_data()), fit_path, plot_path, warm_start,
+                                       self._catalog, catalog_info or {}, autofit_kwargs)
+        self._futures.append(future)
+        return future
+
+    def results(self):
+        """
+        Generator over the fit results in the order of submission, waits for unfinished fits
+
+        :return: fit results of each submitted measurement, or the exception raised during its fit
+        """
+        for future in self._futures:
+            exception = future.exception()
+            yield future.result() if exception is None else exception
+
+    def pending(self):
+        """
+        Get the number of fits that are not finished yet
+
+        :return: the number of queued or running fits
+        """
+        return sum(not future.done() for future in self._futures)
+
+    def close(self, wait=True):
+        """
+        Shut down the workers
+
+        :param wait: if true, wait for all submitted fits to finish. Otherwise queued fits are cancelled.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,6 +1,10 @@
 import numpy as np
 from pathlib import Path
-import pickle
+from datetime import datetime
+import json
+import os
+import threading
+from PyLab.SCPITools import get_segments
 
 
 """
@@ -10,7 +14,7 @@ class for keeping measurement info and data at a single place
 
 class Measurement:
 
-    def __init__(self, operator, chip, bandwidth, power, frequencies, averages=1, sub_folder="", comment="", measurement_type='S21'):
+    def __init__(self, operator, chip, bandwidth, power, frequencies, averages=1, sub_folder="", comment="", measurement_type='S21', line=""):
         """
         Measurement initialization
 
@@ -21,6 +25,7 @@ class Measurement:
         :param frequencies: 1D array containing the probe frequencies
         :param averages: amount of averages that will be used
         :param measurement_type: scattering parameter that will be used for the measurement. 'S21' by default
+        :param line: name of the line configuration (cabling, attenuators, amplifiers), used e.g. for the delay calibration
         """
         self._operator = operator
         self._chip = chip
@@ -36,6 +41,7 @@ class Measurement:
         self._averages = averages
         self._measurement_type = measurement_type
         self._comment = comment
+        self._line = line
 
     # getters and setters to make parameters somewhat "constant"
 
@@ -47,6 +53,15 @@ class Measurement:
         """
         self._data = data
 
+    def set_frequencies(self, frequencies):
+        """
+        Replace the probe frequencies, e.g. by a grid adapted to the resonance. Must be set before the measurement.
+
+        :param frequencies: 1D array containing the probe frequencies
+        """
+        self._frequencies = frequencies
+        self._data = []
+
     def get_operator(self):
         """
         Get the operator of this measurement
@@ -95,6 +110,14 @@ class Measurement:
         """
         return self._measurement_type
 
+    def get_line(self):
+        """
+        Get the name of the line configuration
+
+        :return: the line configuration
+        """
+        return self._line
+
     def get_frequencies(self):
         """
         Get a 1D array containing the probed frequencies
@@ -114,11 +137,16 @@ class Measurement:
     # Utility methods
 
     # base_path=r"C:\Users\di67piz\Documents\Measurements\Results"
-    def save(self, base_path=r"D:\Measurements\Resonators"):
+    def save(self, base_path=r"D:\Measurements\Resonators", txt=False):
         """
-        Save the measurement data as 1. a raw txt file containing the frequency-data pairs and 2. a pickle object
+        Save the measurement as 1. a .npy file of the complex data (contiguous float64 pairs, can be loaded as memory map)
+        and 2. a .json file with all settings. The frequencies are stored as start/stop/nop of their uniform segments,
+        only an irregular grid gets its own _frequencies.npy file. Repeated measurements get the next version (_v2, _v3,
+        ...), which is safe for concurrent processes saving to the same directory. Each file is written under a
+        temporary name and renamed when complete.
 
         :param base_path: base path, not containing the operator or chip name
+        :param txt: if true, the data is additionally exported to the legacy tab separated txt file, see save_txt()
         :return: the path to the result data, without suffix
         """
 
@@ -134,33 +162,223 @@ class Measurement:
         name = f"measurement_{f_start/1e9:.2f}-{f_end/1e9:.2f}GHz_nop{nop}_bw{bw}_{power}dBm" + (f"_{avg}avgs" if avg > 1 else "")
 
         # path = f"{base_path}\\{self._operator}\\{self._chip}\\{name}"
-        path = f"{base_path}/{self._operator}/{self._chip}/{self._sub_folder}{name}"
-
+        directory = Path(f"{base_path}/{self._operator}/{self._chip}/{self._sub_folder}")
+        directory.mkdir(parents=True, exist_ok=True)
 
         # do not overwrite measurement data, rather save as a higher version number
-        i = 1
-        while True:
-            if not Path(path + ".pickle").exists():
-                # print(f"Path {path}.pickle does not exist.")
-                Path(f"{base_path}/{self._operator}/{self._chip}/{self._sub_folder}").mkdir(parents=True, exist_ok=True)
-                break
-            else:
-                # print(f"Path {path}.pickle does already exist. Trying v{i+1}.")
-                i += 1
-                path = f"{base_path}/{self._operator}/{self._chip}/{self._sub_folder}{name}_v{i}"
+        path = _allocate_path(directory, name)
+
+        _write_atomic(f"{path}.npy", lambda handle: np.save(handle, np.ascontiguousarray(self._data, dtype=np.complex128)))
+
+        segments = encode_frequencies(self._frequencies)
+        if segments is not None:
+            frequency_info = {"segments": segments}
+        else:
+            _write_atomic(f"{path}_frequencies.npy",
+                          lambda handle: np.save(handle, np.asarray(self._frequencies, dtype=float)))
+            frequency_info = {"file": f"{Path(path).name}_frequencies.npy"}
+
+        # the settings file is written last, it marks the measurement as complete
+        # settings may be numpy scalars (e.g. from np.arange power sweeps)
+        settings = json.dumps(dict(self.to_dict(), frequencies=frequency_info,
+                                   time=datetime.now().isoformat(timespec="seconds")),
+                              indent=1, default=lambda value: value.item())
+        _write_atomic(f"{path}.json", lambda handle: handle.write(settings.encode()))
+
+        if txt:
+            self.save_txt(path)
+
+        return path  # return path, without suffix
 
-        # save object with pickle
-        with open(f"{path}.pickle", "wb") as handle:
-            pickle.dump(self._data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    def save_txt(self, path):
+        """
+        Export the measurement data as tab separated txt file of frequency-data pairs (legacy format)
 
-        # save tab separated data manually
+        :param path: path of the file, without suffix
+        """
         with open(f"{path}.txt", "w+") as handle:
             lines = []
             if self._comment != "":
                 for comment in self._comment.splitlines():
                     lines.append(f"# {comment}\n")
-            for j in range(len(self._frequencies)):
-                lines.append(str(self._frequencies[j]) + "\t" + str(self._data[j]) + "\n")
+            lines += [f"{frequency}\t{value}\n" for frequency, value in zip(self._frequencies, self._data)]
             handle.writelines(lines)
 
-        return path  # return path, without suffix
+    @classmethod
+    def load(cls, path, mmap=True, info=None):
+        """
+        Load a measurement saved by save()
+
+        :param path: path to the result data, without suffix
+        :param mmap: if true, the data (and an irregular frequency grid) is a read-only memory map of the file, it is only
+                     read from disk when accessed
+        :param info: settings dictionary of the measurement if already read, see read_info()
+        :return: the Measurement object
+        """
+        info = cls.read_info(path) if info is None else info
+        mmap_mode = "r" if mmap else None
+        if "file" in info["frequencies"]:
+            frequencies = np.load(Path(path).parent/info["frequencies"]["file"], mmap_mode=mmap_mode)
+        else:
+            frequencies = decode_frequencies(info["frequencies"]["segments"])
+        return cls.from_dict(info, frequencies, np.load(f"{path}.npy", mmap_mode=mmap_mode))
+
+    @staticmethod
+    def read_info(path):
+        """
+        Read only the settings of a measurement saved by save(), without touching the data
+
+        :param path: path to the result data, without suffix
+        :return: dictionary of the settings, see to_dict(), with the frequency description and the time of the
+                 measurement
+        """
+        with open(f"{path}.json") as handle:
+            return json.load(handle)
+
+    def to_dict(self):
+        """
+        Get the settings of the measurement (without frequencies and data) as a JSON compatible dictionary
+
+        :return: dictionary of the settings
+        """
+        return {"operator": self._operator, "chip": self._chip, "sub_folder": self._sub_folder.rstrip("/"),
+                "bandwidth": self._bandwidth, "power": self._power, "averages": self._averages,
+                "measurement_type": self._measurement_type, "comment": self._comment, "line": self._line}
+
+    @classmethod
+    def from_dict(cls, info, frequencies, data=None):
+        """
+        Create a Measurement object from its settings
+
+        :param info: dictionary of the settings, see to_dict()
+        :param frequencies: 1D array containing the probe frequencies
+        :param data: 1D array containing the measurement data, None if not measured yet
+        :return: the Measurement object
+        """
+        measurement = cls(info["operator"], info["chip"], info["bandwidth"], info["power"], frequencies,
+                          info["averages"], info["sub_folder"], info["comment"], info["measurement_type"], info["line"])
+        if data is not None:
+            measurement.set_data(data)
+        return measurement
+
+
+def encode_frequencies(frequencies, max_segments=100):
+    """
+    Describe a frequency grid compactly by its uniform segments
+
+    :param frequencies: ascending frequencies in Hz
+    :param max_segments: maximum number of segments
+    :return: list of [start, stop, nop] lists, or None if the grid is not made of few uniform segments
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    segments = [[float(start), float(stop), int(nop)] for start, stop, nop in get_segments(frequencies)]
+    # the segments must reproduce the grid to float precision
+    if len(segments) > max_segments or not np.allclose(decode_frequencies(segments), frequencies, rtol=1e-14, atol=0):
+        return None
+    return segments
+
+
+def decode_frequencies(segments):
+    """
+    Get the frequency grid described by encode_frequencies()
+
+    :param segments: list of (start, stop, nop)
+    :return: 1D array of the frequencies
+    """
+    return np.concatenate([np.linspace(start, stop, nop) for start, stop, nop in segments])
+
+
+def _allocate_path(directory, name):
+    """
+    Reserve the next free version of a file name by exclusive creation of its data file, so that concurrent processes
+    never get the same version. The last version is kept in a hidden counter file next to the data, the first try
+    therefore succeeds however many versions exist.
+
+    :param directory: directory of the measurement (Path)
+    :param name: file name without version and suffix
+    :return: the path without suffix, e.g. directory/name_v3
+    """
+    counter = directory/f".{name}.version"
+    try:
+        version = int(counter.read_text()) + 1
+    except (FileNotFoundError, ValueError):
+        version = 1
+    while True:
+        path = directory/(name if version == 1 else f"{name}_v{version}")
+        # measurements saved before the .npy format are marked by their .pickle file
+        if not Path(f"{path}.pickle").exists():
+            try:
+                open(f"{path}.npy", "x").close()
+                break
+            except FileExistsError:
+                pass
+        version += 1
+    # a lost update (concurrent writer) only costs a few more tries next time
+    _write_atomic(counter, lambda handle: handle.write(str(version).encode()))
+    return str(path)
+
+
+def _write_atomic(path, write):
+    """
+    Write a file under a temporary name and rename it when complete, so that a reader or a crash never sees a partial
+    file
+
+    :param path: path of the file
+    :param write: function writing the content to the binary file handle it gets
+    """
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, "wb") as handle:
+            write(handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def merge_measurements(measurements):
+    """
+    Combine measurements with the same settings but separate frequency windows (e.g. around a number of resonances) into
+    a single measurement, so that all windows are measured in one segmented sweep. See split_data().
+
+    :param measurements: list of Measurement objects with equal bandwidth, power, averages and measurement type
+    :return: the combined Measurement object, its frequencies are the ones of all windows in ascending order
+    """
+    if len(measurements) == 0:
+        raise ValueError("no measurements to merge")
+    first = measurements[0]
+    for measurement in measurements[1:]:
+        if (measurement.get_bandwidth(), measurement.get_power(), measurement.get_averages(),
+                measurement.get_measurement_type()) != (first.get_bandwidth(), first.get_power(),
+                                                        first.get_averages(), first.get_measurement_type()):
+            raise ValueError("measurements in one sweep need the same bandwidth, power, averages and measurement type")
+
+    ordered = sorted(measurements, key=lambda measurement: measurement.get_frequencies()[0])
+    for previous, measurement in zip(ordered[:-1], ordered[1:]):
+        if measurement.get_frequencies()[0] <= previous.get_frequencies()[-1]:
+            raise ValueError(f"frequency windows starting at {previous.get_frequencies()[0]} Hz and "
+                             f"{measurement.get_frequencies()[0]} Hz overlap")
+
+    frequencies = np.concatenate([np.asarray(measurement.get_frequencies(), dtype=float) for measurement in ordered])
+    return Measurement(first.get_operator(), first.get_chip(), first.get_bandwidth(), first.get_power(), frequencies,
+                       first.get_averages(), measurement_type=first.get_measurement_type(), line=first.get_line())
+
+
+def split_data(merged, measurements):
+    """
+    Hand the data of a merged measurement back to the measurements it was combined from
+
+    :param merged: the Measurement object returned by merge_measurements(), with data
+    :param measurements: the list of Measurement objects passed to merge_measurements()
+    """
+    frequencies = np.asarray(merged.get_frequencies())
+    data = np.asarray(merged.get_data())
+    if len(data) != len(frequencies):
+        raise ValueError("frequency and data size do not match")
+    for measurement in measurements:
+        window = np.asarray(measurement.get_frequencies(), dtype=float)
+        start = np.searchsorted(frequencies, window[0])
+        measurement.set_data(data[start:start + len(window)])
@@ -0,0 +1,114 @@
+import numpy as np
+from pathlib import Path
+import json
+import logging
+from PyLab.Measurement import Measurement
+
+
+"""
+lazy access to the measurements saved by Measurement.save() in a directory tree: only the small settings files are read
+up front, the data of a trace is memory mapped when the trace is accessed. Browsing and filtering thousands of traces
+therefore costs neither the time nor the memory of loading them.
+"""
+
+
+class MeasurementDataset:
+
+    def __init__(self, directory, recursive=True, mmap=True):
+        """
+        Collect the settings of all saved measurements of a directory
+
+        :param directory: directory of the measurements, e.g. r"D:\\Measurements\\Resonators\\operator\\chip"
+        :param recursive: if true, the sub folders are searched as well
+        :param mmap: if true, the data of a trace is a read-only memory map, see Measurement.load()
+        """
+        self.directory = Path(directory)
+        self.mmap = mmap
+        self._headers = []
+        for json_path in sorted(self.directory.rglob("*.json") if recursive else self.directory.glob("*.json")):
+            path = json_path.with_suffix("")
+            # other json files (e.g. stitched spectra) and measurements still being written are skipped
+            if not Path(f"{path}.npy").exists():
+                continue
+            try:
+                info = Measurement.read_info(path)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                logging.warning(f"Skipping unreadable settings file {json_path}.")
+                continue
+            if not isinstance(info, dict) or "frequencies" not in info or "measurement_type" not in info:
+                continue
+            info["path"] = str(path)
+            self._headers.append(info)
+
+    @classmethod
+    def from_headers(cls, directory, headers, mmap=True):
+        """
+        Create a dataset from settings already read, e.g. by select()
+
+        :param directory: common directory of the measurements
+        :param headers: list of settings dictionaries including the path of the measurement
+        :param mmap: if true, the data of a trace is a read-only memory map
+        :return: the MeasurementDataset object
+        """
+        dataset = cls.__new__(cls)
+        dataset.directory = Path(directory)
+        dataset.mmap = mmap
+        dataset._headers = list(headers)
+        return dataset
+
+    def get_header(self, i):
+        """
+        Get the settings of a measurement without loading it
+
+        :param i: number of the measurement in the dataset
+        :return: dictionary of the settings, see Measurement.read_info(), and the path of the measurement
+        """
+        return self._headers[i]
+
+    def get_path(self, i):
+        """
+        :param i: number of the measurement in the dataset
+        :return: path to the result data of the measurement, without suffix
+        """
+        return self._headers[i]["path"]
+
+    def select(self, **conditions):
+        """
+        Filter the measurements by their settings, e.g. select(power=-20, sub_folder="Res3")
+
+        :param conditions: required values of the settings
+        :return: a MeasurementDataset of the matching measurements, no data is read
+        """
+        return self.from_headers(self.directory, [header for header in self._headers
+                                                  if all(header.get(key) == value
+                                                         for key, value in conditions.items())], self.mmap)
+
+    def table(self, *keys):
+        """
+        Get settings of all measurements as arrays, e.g. table("power", "bandwidth")
+
+        :param keys: names of the settings (missing values are NaN)
+        :return: dictionary of np arrays
+        """
+        return {key: np.array([header.get(key, np.nan) for header in self._headers]) for key in keys}
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __getitem__(self, i):
+        """
+        Load a measurement, its data is only read from disk when accessed (if mmap)
+
+        :param i: number of the measurement in the dataset
+        :return: the Measurement object
+        """
+        header = self._headers[i]
+        return Measurement.load(header["path"], self.mmap, header)
+
+    def __iter__(self):
+        """
+        Iterate over the measurements, only the current one is mapped, e.g.
+        for measurement in dataset: notch_port(measurement.get_frequencies(), measurement.get_data()).autofit()
+        """
+        for i in range(len(self._headers)):
+            yield self[i]
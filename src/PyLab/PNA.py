@@ -1,7 +1,11 @@
 import pyvisa
 import numpy as np
 import time
+import logging
+from contextlib import contextmanager
 from datetime import datetime
+from PyLab.SCPITools import query_complex_data, BINARY_FORMATS, get_completion, run_sweeps, InstrumentState, \
+    CommandBatch
 
 class PNA():
     '''
@@ -9,11 +13,15 @@ class PNA():
     NB 08/2021
     '''
 
-    def __init__(self, address, sweep_mode='LIN', channel_index=1):
+    def __init__(self, address, sweep_mode='LIN', channel_index=1, data_format='REAL,64', completion='poll'):
 
         self._address = address
         self._visainstrument = pyvisa.ResourceManager().open_resource(self._address, timeout=5000)
         self._ci = channel_index
+        if self._address.upper().endswith('::SOCKET'):
+            # raw sockets (e.g. SimSCPIServer) have no end-of-message indicator
+            self._visainstrument.read_termination = '\n'
+            self._visainstrument.write_termination = '\n'
 
         #default init values
         self.power = -20
@@ -22,6 +30,14 @@ class PNA():
         self.sweep_mode = sweep_mode
         self.frequencies = np.linspace(4e9, 6e9, 1001)
         self.fixed_frequency = 5e9
+        # format for the transfer of the measured data, set in the instrument before the first transfer
+        self.data_format = data_format
+        # strategy for detecting the end of a sweep, see SCPITools
+        self.completion = get_completion(completion)
+        # last confirmed settings, unchanged settings are not sent again (see SCPITools.InstrumentState)
+        self.state = InstrumentState()
+        # commands written within batch() are collected and sent together
+        self._batch = CommandBatch(self._visainstrument)
 
     def query(self, cmd: str):
         """
@@ -29,6 +45,8 @@ class PNA():
         :param cmd: SCPI command
         :return: evaluation of the SCPI command
         """
+        # commands of a running batch must be processed before the answer is meaningful
+        self._batch.flush()
         return self._visainstrument.query(cmd)
 
     def write(self, cmd: str):
@@ -37,14 +55,62 @@ class PNA():
         :param cmd: SCPI command
         """
         # write a SCPI command
-        self._visainstrument.write(cmd)
+        if self._batch.active:
+            self._batch.add(cmd)
+        else:
+            self._visainstrument.write(cmd)
+
+    @contextmanager
+    def batch(self):
+        """
+        Context for collecting the written commands, which are sent as one message with a single final *OPC? when the
+        context ends. The error queue is checked once afterwards, errors raise a RuntimeError. Queries within the
+        context send the commands collected so far.
+        """
+        try:
+            with self._batch:
+                yield self._batch
+        except Exception:
+            # it is unknown which of the collected settings were applied
+            self.state.invalidate()
+            raise
+
+    def set(self, key: str, value, cmd: str):
+        """
+        Write a SCPI command applying a setting, unless the setting already has this value
+        :param key: name of the setting
+        :param value: new value of the setting
+        :param cmd: SCPI command
+        :return: True if the command was sent, False if it was skipped
+        """
+        return self.state.set(key, value, self.write, cmd)
+
+    def invalidate(self):
+        """
+        Forget the known settings, so that all of them are sent again. Use this after changing settings at the
+        instrument or via write().
+        """
+        self.state.invalidate()
+
+    def resync(self):
+        """
+        Read the settings back from the instrument into the known settings. Settings that are not read back are
+        forgotten and sent again.
+        """
+        self.state.invalidate()
+        self.state.confirm('power', self.get_power())
+        self.state.confirm('bandwidth', self.get_bandwidth())
+        self.state.confirm('points', self.get_nop())
+        self.state.confirm('start', self.get_start_freqency())
+        self.state.confirm('stop', self.get_stop_freqency())
 
     def wait(self):
         """
         Sends an OPC query to block the pipeline until the operacion is complete
         :return: 1 as soon as the operation is complete
         """
-        return self._visainstrument.query('*OPC?')
+        # the final *OPC? of the pending batch commands does the job
+        return self._batch.flush() or self._visainstrument.query('*OPC?')
 
 
     def set_rf_on(self):
@@ -69,9 +135,33 @@ class PNA():
         :param nop: number of points
         """
         self.frequencies = np.linspace(start, stop, nop)
-        self.write(f':SENSe{self._ci}:SWEep:POINts {len(self.frequencies)}')
-        self.write(f':SENSe{self._ci}:FREQuency:STARt {self.frequencies[0]:.3f}')
-        self.write(f':SENSe{self._ci}:FREQuency:STOP {self.frequencies[-1]:.3f}')
+        self.set('sweep_type', 'LIN', f"SENSe{self._ci}:SWEep:TYPE LIN")
+        self.set('points', len(self.frequencies), f':SENSe{self._ci}:SWEep:POINts {len(self.frequencies)}')
+        self.set('start', self.frequencies[0], f':SENSe{self._ci}:FREQuency:STARt {self.frequencies[0]:.3f}')
+        self.set('stop', self.frequencies[-1], f':SENSe{self._ci}:FREQuency:STOP {self.frequencies[-1]:.3f}')
+
+    def set_segments(self, segments: list):
+        """
+        Set a segmented sweep, e.g. for a non-uniform frequency grid (see SCPITools.get_segments). All segments use the
+        power and the IF bandwidth of the channel.
+        :param segments: list of (start, stop, nop) tuples with frequencies in Hz, ascending and not overlapping
+        """
+        segments = [(float(start), float(stop), int(nop)) for start, stop, nop in segments]
+        self.frequencies = np.concatenate([np.linspace(start, stop, nop) for start, stop, nop in segments])
+        if self.state.get('segments') != segments:
+            self.state.invalidate('segments')
+            with self.batch():
+                self.write(f"SENSe{self._ci}:SEGMent:DELete:ALL")
+                self.write(f"SENSe{self._ci}:SEGMent:BWIDth:CONTrol OFF")
+                self.write(f"SENSe{self._ci}:SEGMent:POWer:CONTrol OFF")
+                for i, (start, stop, nop) in enumerate(segments, 1):
+                    self.write(f"SENSe{self._ci}:SEGMent{i}:ADD")
+                    self.write(f"SENSe{self._ci}:SEGMent{i}:FREQuency:STARt {start:.3f}")
+                    self.write(f"SENSe{self._ci}:SEGMent{i}:FREQuency:STOP {stop:.3f}")
+                    self.write(f"SENSe{self._ci}:SEGMent{i}:SWEep:POINts {nop}")
+                    self.write(f"SENSe{self._ci}:SEGMent{i}:STATe ON")
+            self.state.confirm('segments', segments)
+        self.set('sweep_type', 'SEGMENT', f"SENSe{self._ci}:SWEep:TYPE SEGMent")
 
     def set_frequency_center(self, center: float, span: float, nop: int):
         """
@@ -88,7 +178,7 @@ class PNA():
         :param fixed_frequency: fixed frequency in Hz
         """
         self.fixed_frequency = fixed_frequency
-        self.write(f':SENSe{self._ci}:FREQuency:CW {self.fixed_frequency:.3f}')
+        self.set('cw_frequency', self.fixed_frequency, f':SENSe{self._ci}:FREQuency:CW {self.fixed_frequency:.3f}')
 
     def set_power(self, power: float):
         """
@@ -96,7 +186,7 @@ class PNA():
         :param power: power in dBm
         """
         self.power = power
-        self.write(f':SOURce{self._ci}:POWer {self.power}')
+        self.set('power', self.power, f':SOURce{self._ci}:POWer {self.power}')
 
     def set_bandwidth(self, bandwidth: int):
         """
@@ -104,7 +194,7 @@ class PNA():
         :param bandwidth: bandwidth in Hz
         """
         self.bandwidth = bandwidth
-        self.write(f'SENSe{self._ci}:BANDwidth:RESolution {self.bandwidth}')
+        self.set('bandwidth', self.bandwidth, f'SENSe{self._ci}:BANDwidth:RESolution {self.bandwidth}')
 
     def set_sweep_mode(self, mode: str):
         """
@@ -113,10 +203,18 @@ class PNA():
         """
         if mode.upper() in ["LIN", "POINT"]:
             self.sweep_mode = mode
-            self.write(f"SENSe{self._ci}:SWEep:TYPE {self.sweep_mode}")
+            self.set('sweep_type', self.sweep_mode.upper(), f"SENSe{self._ci}:SWEep:TYPE {self.sweep_mode}")
         else:
             ValueError("Sweep mode must be LIN (default) or POINt (fixed/cw frequency).")
 
+    def set_completion(self, completion):
+        """
+        Set the strategy for detecting the end of a sweep
+        :param completion: poll (adaptive polling of *ESR?), opc (single blocking *OPC?), srq (service request) or a
+                           strategy object from SCPITools
+        """
+        self.completion = get_completion(completion)
+
     def set_averages(self, averages: int):
         """
         Set the amount of sweep averages
@@ -124,11 +222,11 @@ class PNA():
         """
         if averages == 0 or averages == 1:
             self.averages = 1
-            self.write(f'SENSe{self._ci}:AVERage:STATe OFF')
+            self.set('average_state', 'OFF', f'SENSe{self._ci}:AVERage:STATe OFF')
         else:
             self.averages = averages
-            self.write(f'SENSe{self._ci}:AVERage:STATe ON')
-            self.write(f'SENSe{self._ci}:AVERage:COUNt {self.averages}')
+            self.set('average_state', 'ON', f'SENSe{self._ci}:AVERage:STATe ON')
+            self.set('average_count', self.averages, f'SENSe{self._ci}:AVERage:COUNt {self.averages}')
 
     def set_average_mode(self, mode: str):
         """
@@ -136,7 +234,7 @@ class PNA():
         :param mode: Either POINt for averaging each point x times, or SWEep for sweeping x times
         """
         if mode.upper() in ["POINT", "SWEEP"]:
-            self.write(f"SENSe{self._ci}:AVERage:MODE {mode}")
+            self.set('average_mode', mode.upper(), f"SENSe{self._ci}:AVERage:MODE {mode}")
         else:
             ValueError('Average mode must be POINt (averaging each point x times) or SWEep (sweeping x times).')
 
@@ -146,38 +244,52 @@ class PNA():
         :return: dictionary containing the measured S parameter data
         """
         # doing the dirty timeout way to make sure measurement runs fine
-        self.write("INIT:CONT OFF")
+        self.set('continuous', 'OFF', "INIT:CONT OFF")
         old_timeout = self._visainstrument.timeout
         full_time = self.get_sweep_time()
         now = datetime.now()
         dt_string = now.strftime("%H:%M")
-        print(f"current time: {dt_string} - sweep time: {int(np.floor(full_time/3600)):02d}:{int(np.floor((full_time%3600)/60)):02d}:{int(full_time%60):02d} h:m:s")
+        logging.info(f"current time: {dt_string} - sweep time: {int(np.floor(full_time/3600)):02d}:{int(np.floor((full_time%3600)/60)):02d}:{int(full_time%60):02d} h:m:s")
         self._visainstrument.timeout = full_time*1000 + 5000
 
-        for i in range(self.averages):
-            # Clear status, initiate measurement
-            self.wait()
-            self.write("*CLS;INIT:IMM;*OPC")
-            # Check first bit in the event status register for OPC
-            while not (int(self.query("*ESR?")) & 1):
-                time.sleep(0.002)
-
-        time.sleep(0.2)
-        self.wait()
-        self._visainstrument.timeout = old_timeout
+        # run the sweeps (one per average), the sweep time query above already waited for the settings
+        try:
+            run_sweeps(self._visainstrument, self.completion, full_time/self.averages, self.averages)
+        finally:
+            self._visainstrument.timeout = old_timeout
         return {'S-parameter': self.get_data()}
 
+    def set_data_format(self, data_format: str):
+        """
+        Set the format for the transfer of the measured data
+        :param data_format: REAL,64 or REAL,32 for binary transfer, ASCII for text
+        """
+        if data_format in BINARY_FORMATS:
+            # little-endian byte order, i.e. no byte swapping on the PC
+            self.set('data_format', data_format, f'FORMat:BORDer SWAPped;:FORMat {data_format}')
+        elif data_format == 'ASCII':
+            self.set('data_format', data_format, 'FORMat ASCii,0')
+        else:
+            raise ValueError("Data format must be REAL,64 (default), REAL,32 or ASCII.")
+        self.data_format = data_format
+
     def get_data(self):
         """
-        Get the measured complex data
+        Get the measured complex data. Uses binary transfer unless data_format is ASCII, falls back to ASCII if the
+        binary transfer fails.
         :return: complex-valued np array
         """
         # data = self.query(r'CALCulate:DATA? SDATa')
-        data = self._visainstrument.query_ascii_values("CALCulate:DATA? SDATa")
-        data_size = np.size(data)
-        datareal = np.array(data[0:data_size:2])
-        dataimag = np.array(data[1:data_size:2])
-        return datareal + 1j * dataimag
+        self.set_data_format(self.data_format)
+        self._batch.flush()
+        if self.data_format in BINARY_FORMATS:
+            try:
+                return query_complex_data(self._visainstrument, "CALCulate:DATA? SDATa", self.data_format)
+            except (pyvisa.errors.VisaIOError, ValueError) as error:
+                logging.warning(f"Binary data transfer failed ({error}), falling back to ASCII.")
+                self._visainstrument.clear()
+                self.set_data_format('ASCII')
+        return query_complex_data(self._visainstrument, "CALCulate:DATA? SDATa")
 
     def get_sweep_time(self):
         """
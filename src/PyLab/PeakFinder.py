@@ -1,51 +1,127 @@
 import numpy as np
+from scipy import signal
+import warnings
 
-def find_peaks(f_data, s21_data, num_peaks):
+
+"""
+search of resonances in wideband spectra. The spectrum is corrected for the cable delay and normalized to a running
+baseline, so that ripple of the background does not count as a resonance. All steps are vectorized, the search scales
+to stitched spectra with millions of points.
+"""
+
+
+def find_peaks(f_data, s21_data, num_peaks=None, q_l=1e5, **kwargs):
     """
     Find resonator peaks (or dips)
-    :param f_data: the corresponding frecuencies
-    :param delay_data: the data as delay (derivative)
-    :param num_peaks: the number of peaks that will be marked
-    :return: a list containing the frequencies of the peaks
+    :param f_data: the corresponding frequencies
+    :param s21_data: the complex-valued data
+    :param num_peaks: the maximum number of peaks, the most prominent ones are returned. None for all significant peaks
+    :param q_l: expected loaded quality factor, sets the scale of the search
+    :param kwargs: further parameters of get_peaks()
+    :return: a list containing the frequencies of the peaks, ascending
     """
-    threshold = 100  # threshold value as number of points (in both directions)
+    return list(get_peaks(f_data, s21_data, num_peaks, q_l, **kwargs)["fr"])
 
-    # delay_data = []
-    delay_data = np.diff(s21_data)
-    delay_data = np.append(delay_data, 0)
 
-    peak_pos = []
+def get_peaks(f_data, s21_data, num_peaks=None, q_l=1e5, min_distance=5, baseline_linewidths=20, threshold=10,
+              delay=None):
+    """
+    Find resonances and estimate their parameters. The peaks are searched in |S21/baseline - 1|, which a notch
+    resonator turns into a Lorentzian peak of height Ql/|Qc|.
+    :param f_data: the frequencies in Hz, ascending (the spacing does not need to be uniform)
+    :param s21_data: the complex-valued data
+    :param num_peaks: the maximum number of peaks, the most prominent ones are returned. None for all significant peaks
+    :param q_l: expected loaded quality factor, sets the scale of the search
+    :param min_distance: minimum distance of two peaks in linewidths f/q_l
+    :param baseline_linewidths: length of the blocks of the running median baseline in linewidths, must be well above
+                                the width of a resonance and well below the period of the background ripple
+    :param threshold: minimum prominence of a peak in units of the noise of the normalized spectrum (the largest noise
+                      peaks of a million-point spectrum reach about 6)
+    :param delay: cable delay in s, estimated from the phase slope if None
+    :return: dictionary of np arrays sorted by frequency: fr (resonance frequency), Ql (loaded quality factor from the
+             width of the peak, a lower bound if the peak is not resolved), depth (height of the peak, about Ql/|Qc|),
+             prominence (in units of the noise) and index (position in the data)
+    """
+    f_data = np.asarray(f_data, dtype=float)
+    s21_data = np.asarray(s21_data, dtype=complex)
+    spacing = np.median(np.diff(f_data))
+    linewidth = np.median(f_data)/q_l
 
-    for _ in range(num_peaks):
-        max_val = -1
-        max_pos = 0
+    deviation = _normalize(f_data, s21_data, delay, max(int(baseline_linewidths*linewidth/spacing), 5))
 
+    noise = _noise(deviation)
+    index, properties = signal.find_peaks(deviation, prominence=threshold*noise,
+                                          distance=max(int(min_distance*linewidth/spacing), 1))
+    prominence = properties["prominences"]/noise
+    if num_peaks is not None and len(index) > num_peaks:
+        strongest = np.sort(np.argsort(prominence)[::-1][:num_peaks])
+        index, prominence = index[strongest], prominence[strongest]
 
-        for i in range(len(delay_data)):
+    # sub-point position of the peak from a parabola through the neighbouring points
+    inner = np.clip(index, 1, len(deviation) - 2)
+    left, center, right = deviation[inner - 1], deviation[inner], deviation[inner + 1]
+    curvature = left - 2*center + right
+    shift = np.divide(0.5*(left - right), curvature, out=np.zeros(len(inner)), where=curvature < 0)
+    fr = np.interp(inner + np.clip(shift, -0.5, 0.5), np.arange(len(f_data)), f_data)
 
-            delay = delay_data[i]
+    # the amplitude of a Lorentzian drops to half at sqrt(3) linewidths (full width)
+    widths, width_height, left_ips, right_ips = signal.peak_widths(deviation, index, rel_height=0.5)
+    fwhm = np.interp(right_ips, np.arange(len(f_data)), f_data) - np.interp(left_ips, np.arange(len(f_data)), f_data)
+    fwhm = np.maximum(fwhm, spacing)
 
-            # skip points in the vicinity of other peaks
-            skip = False
-            for peak in peak_pos:
-                if abs(i-peak) < threshold:
-                    skip = True
-                    break
+    return {"fr": fr, "Ql": np.sqrt(3)*fr/fwhm, "depth": deviation[index], "prominence": prominence, "index": index}
 
-            if skip:
-                continue
 
-            if abs(delay) > max_val:
-                max_val = abs(delay)
-                max_pos = i
+# Utility methods
 
-        peak_pos.append(max_pos)
+def _normalize(f_data, s21_data, delay, block):
+    """
+    Get |S21/baseline - 1| of the delay corrected data, with the baseline as median of blocks of points
+    """
+    if delay is None:
+        delay = -np.polyfit(f_data, np.unwrap(np.angle(s21_data)), 1)[0]/(2*np.pi)
+    z_data = s21_data*np.exp(2j*np.pi*f_data*delay)
 
-    frequencies = []
-    for i in peak_pos:
-        frequencies.append(f_data[i])
+    # the complex baseline only works if the phase is (nearly) flat within a block after the delay correction,
+    # otherwise (delay not resolved by the frequency spacing) the magnitude is used
+    n_blocks = max(len(z_data)//block, 1)
+    blocks = z_data[:n_blocks*block].reshape(n_blocks, -1)
+    if np.median(np.abs(np.mean(blocks, axis=1))/np.mean(np.abs(blocks), axis=1)) < 0.9:
+        z_data = np.abs(z_data)
 
-    frequencies.sort()
+    deviation = np.abs(z_data/_baseline(f_data, z_data, block) - 1)
+    # the tails of a resonance pull the median of the neighbouring blocks, a second pass leaves out the points that are
+    # clearly off the baseline
+    mask = deviation > 3*_noise(deviation)
+    return np.abs(z_data/_baseline(f_data, z_data, block, mask) - 1)
 
-    return frequencies  # old sorting was by highest derivative, not by frequency
 
+def _baseline(f_data, z_data, block, mask=None):
+    """
+    Get the median of blocks of points, interpolated to all frequencies. Masked points are left out.
+    """
+    n_blocks = max(len(z_data)//block, 1)
+    centers = np.mean(f_data[:n_blocks*block].reshape(n_blocks, -1), axis=1)
+    parts = [z_data.real, z_data.imag] if np.iscomplexobj(z_data) else [z_data]
+    medians = []
+    for part in parts:
+        part = part[:n_blocks*block].astype(float)
+        if mask is not None:
+            part[mask[:n_blocks*block]] = np.nan
+        with warnings.catch_warnings():
+            # blocks with all points masked give NaN and are left out
+            warnings.simplefilter("ignore", RuntimeWarning)
+            medians.append(np.nanmedian(part.reshape(n_blocks, -1), axis=1))
+    valid = np.all(np.isfinite(medians), axis=0)
+    if not np.any(valid):
+        return _baseline(f_data, z_data, block)
+    baseline = [np.interp(f_data, centers[valid], median[valid]) for median in medians]
+    return baseline[0] + 1j*baseline[1] if len(baseline) == 2 else baseline[0]
+
+
+def _noise(deviation):
+    """
+    Get a robust estimate of the noise, the resonances are a small fraction of the points
+    """
+    noise = 1.4826*np.median(np.abs(deviation - np.median(deviation)))
+    return noise if noise > 0 else np.finfo(float).eps
@@ -1,25 +1,35 @@
 import pyvisa
 import numpy
 import time
+import logging
+from contextlib import contextmanager
 from typing import AnyStr
+from PyLab.SCPITools import query_complex_data, BINARY_FORMATS, get_completion, run_sweeps, InstrumentState, \
+    CommandBatch
 
 class RSVNA():
     '''
     This is the python driver for Rohde&Schwarz vector network analyzers (written specifically for ZVA26 connected via TCP/IP address)
     '''
 
-    def __init__(self, name, address, sweep_mode = 'LIN', channel_index=1,start_freq = 4e9, stop_freq =6e9, fixed_cw_frequency = 6e9):
+    def __init__(self, name, address, sweep_mode = 'LIN', channel_index=1,start_freq = 4e9, stop_freq =6e9, fixed_cw_frequency = 6e9, data_format='REAL,64', completion='poll'):
         '''
         Initializes
         Input:
             name (string)	: name of the instrument
             address (string) : TCP/IP address like 'TCPIP0::ZVA24-26-100428::inst0::INSTR'
+            data_format (string) : REAL,64 | REAL,32 for binary data transfer, ASCII for text
+            completion (string) : poll | opc | srq, strategy for detecting the end of a sweep (see SCPITools)
         '''
 
 
         self._address = address
         self._visainstrument = pyvisa.ResourceManager().open_resource(self._address, timeout=5000)
         self._ci = channel_index
+        if self._address.upper().endswith('::SOCKET'):
+            # raw sockets (e.g. SimSCPIServer) have no end-of-message indicator
+            self._visainstrument.read_termination = '\n'
+            self._visainstrument.write_termination = '\n'
 
 
         #measurement parameters default values
@@ -36,6 +46,13 @@ class RSVNA():
         self.frequencies = numpy.linspace(self.start_freq, self.stop_freq, self.nop)
         self._zerospan= False
         self.fixed_cw_frequency = fixed_cw_frequency
+        self.segments = []
+        self.data_format = data_format
+        self.completion = get_completion(completion)
+        # last confirmed settings, unchanged settings are not sent again
+        self.state = InstrumentState()
+        # commands written within batch() are collected and sent together
+        self._batch = CommandBatch(self._visainstrument)
 
         # self.stop_frequencies =
 
@@ -43,9 +60,9 @@ class RSVNA():
     def set_sweep_mode(self,mode):
         self.sweep_mode = mode
         if (self.sweep_mode == 'CW'):
-            self.write('SENS%i:SWE:TYPE %s' % (self._ci, "POINt"))
+            self.set('sweep_type', "POINt", 'SENS%i:SWE:TYPE %s' % (self._ci, "POINt"))
         elif (self.sweep_mode == 'LIN'):
-            self.write('SENS%i:SWE:TYPE %s' % (self._ci, "LIN"))
+            self.set('sweep_type', "LIN", 'SENS%i:SWE:TYPE %s' % (self._ci, "LIN"))
 
         return print("setting sweep mode to %s"%self.sweep_mode)
     def get_all(self):
@@ -68,25 +85,83 @@ class RSVNA():
 
     def query(self, cmd):
         # Just ask it .ask doesn't support tcp\ip
+        # commands of a running batch are sent first
+        self._batch.flush()
         return self._visainstrument.query(cmd)
 
     def write(self, cmd):
         # I want just write it
+        if self._batch.active:
+            return self._batch.add(cmd)
         return self._visainstrument.write(cmd)
 
+    @contextmanager
+    def batch(self):
+        '''
+        Collect the written commands and send them as one message with a single *OPC? at the end of the context.
+        The error queue is checked once afterwards (RuntimeError on errors). Queries within the context send the
+        commands collected so far.
+        '''
+        try:
+            with self._batch:
+                yield self._batch
+        except Exception:
+            # it is unknown which of the collected settings were applied
+            self.state.invalidate()
+            raise
+
+    def set(self, key, value, cmd):
+        '''
+        Write a setting, unless the instrument already has this value
+        Input:
+            key (string) : name of the setting
+            value : new value of the setting
+            cmd (string) : SCPI command applying the setting
+        Output:
+            True if the command was sent, False if it was skipped
+        '''
+        return self.state.set(key, value, self.write, cmd)
+
+    def invalidate(self):
+        '''
+        Forget the known settings, all of them are sent again. Needed after changing settings at the instrument or
+        via write().
+        '''
+        self.state.invalidate()
+
+    def resync(self):
+        '''
+        Read the settings back from the instrument. Settings that are not read back are forgotten and sent again.
+        '''
+        self.state.invalidate()
+        self.state.confirm('power', self.__get_power())
+        self.state.confirm('bandwidth', self.__get_bandwidth())
+        self.state.confirm('nop', self.__get_nop())
+        self.state.confirm('start', self.__get_startfreq())
+        self.state.confirm('stop', self.__get_stopfreq())
+        self.bw = self.state.get('bandwidth')
+
     def wait(self):
-        return self._visainstrument.query('*OPC?')
+        # the final *OPC? of the pending batch commands does the job
+        return self._batch.flush() or self._visainstrument.query('*OPC?')
 
     def get_data(self,values = None):
         '''
         This function gives the data only when the measurement already was performed
         :return:
         '''
-        data = self._visainstrument.query_ascii_values("CALCulate:DATA? SDATA")
-        data_size = numpy.size(data)
-        datareal = numpy.array(data[0:data_size:2])
-        dataimag = numpy.array(data[1:data_size:2])
-        data_complex = datareal + 1j * dataimag
+        self.set_data_format(self.data_format)
+        self._batch.flush()
+        data_complex = None
+        if self.data_format in BINARY_FORMATS:
+            try:
+                data_complex = query_complex_data(self._visainstrument, "CALCulate:DATA? SDATA", self.data_format)
+            except (pyvisa.errors.VisaIOError, ValueError) as error:
+                logging.warning("Binary data transfer failed (%s), falling back to ASCII." % error)
+                self._visainstrument.clear()
+                self.set_data_format('ASCII')
+        if data_complex is None:
+            data_complex = query_complex_data(self._visainstrument, "CALCulate:DATA? SDATA")
         if values is None:
             S_params = data_complex
         elif values == 'dB':
@@ -95,6 +170,22 @@ class RSVNA():
             S_params = -numpy.unwrap(numpy.angle(data_complex))
         return S_params
 
+    def set_data_format(self, data_format):
+        '''
+        Set the format of the data transfer
+        Input:
+            data_format (string) : REAL,64 | REAL,32 for binary transfer (little endian), ASCII for text
+        Output:
+            None
+        '''
+        if data_format in BINARY_FORMATS:
+            self.set('data_format', data_format, 'FORM:BORD SWAP;:FORM %s' % data_format)
+        elif data_format == 'ASCII':
+            self.set('data_format', data_format, 'FORM ASC')
+        else:
+            raise ValueError('set_data_format(): must be REAL,64 | REAL,32 | ASCII')
+        self.data_format = data_format
+
     def set_frequencies(self, start, stop, nop):
         '''
         Set frequencies
@@ -105,6 +196,8 @@ class RSVNA():
         Output:
             None
         '''
+        self.sweep_mode = 'LIN'
+        self.set('sweep_type', "LIN", 'SENS%i:SWE:TYPE %s' % (self._ci, "LIN"))
         self.set_nop(nop)
         self.set_startfreq(start)
         self.set_stopfreq(stop)
@@ -115,10 +208,42 @@ class RSVNA():
         self.frequencies = numpy.linspace(start, stop, nop)
         return self.frequencies
 
+    def set_segments(self, segments):
+        '''
+        Set a segmented sweep, e.g. for a non-uniform frequency grid (see SCPITools.get_segments). All segments use the
+        power and the IF bandwidth of the channel.
+        Input:
+            segments (list) : (start, stop, nop) tuples with frequencies in Hz, ascending and not overlapping
+        Output:
+            the frequencies of the sweep
+        '''
+        segments = [(float(start), float(stop), int(nop)) for start, stop, nop in segments]
+        self.sweep_mode = 'SEGM'
+        self.segments = segments
+        self.frequencies = numpy.concatenate([numpy.linspace(start, stop, nop) for start, stop, nop in segments])
+        self.nop = len(self.frequencies)
+        self.start_freq = self.frequencies[0]
+        self.stop_freq = self.frequencies[-1]
+        if self.state.get('segments') != segments:
+            self.state.invalidate('segments')
+            with self.batch():
+                self.write('SENS%i:SEGM:DEL:ALL' % self._ci)
+                self.write('SENS%i:SEGM:BWID:CONT OFF' % self._ci)
+                self.write('SENS%i:SEGM:POW:CONT OFF' % self._ci)
+                for i, (start, stop, nop) in enumerate(segments, 1):
+                    self.write('SENS%i:SEGM%i:ADD' % (self._ci, i))
+                    self.write('SENS%i:SEGM%i:FREQ:STAR %f' % (self._ci, i, start))
+                    self.write('SENS%i:SEGM%i:FREQ:STOP %f' % (self._ci, i, stop))
+                    self.write('SENS%i:SEGM%i:SWE:POIN %i' % (self._ci, i, nop))
+                    self.write('SENS%i:SEGM%i:STAT ON' % (self._ci, i))
+            self.state.confirm('segments', segments)
+        self.set('sweep_type', "SEGM", 'SENS%i:SWE:TYPE %s' % (self._ci, "SEGMent"))
+        return self.frequencies
+
     def set_fixed_frequency(self, val):
         #val is the fixed frequency now
         self.fixed_cw_frequency = val
-        self.write(':SENS%i:FREQ:CW %.7f' % (self._ci, val))
+        self.set('cw_frequency', val, ':SENS%i:FREQ:CW %.7f' % (self._ci, val))
         return self.fixed_cw_frequency
 
     def set_nop(self, nop):
@@ -129,7 +254,7 @@ class RSVNA():
         Output:
             None
         '''
-        self.write(':SENS%i:SWE:POIN %i' %(self._ci, nop))
+        self.set('nop', nop, ':SENS%i:SWE:POIN %i' %(self._ci, nop))
         self.nop = nop
         # return nop
 
@@ -142,7 +267,7 @@ class RSVNA():
             None
         '''
         self.start_freq = val
-        self.write(':SENS%i:FREQ:STAR %f' % (self._ci, val))
+        self.set('start', val, ':SENS%i:FREQ:STAR %f' % (self._ci, val))
 
     def set_stopfreq(self, val):
         '''
@@ -153,7 +278,7 @@ class RSVNA():
             None
         '''
         self.stop_freq = val
-        self.write(':SENS%i:FREQ:STOP %f' % (self._ci, val))
+        self.set('stop', val, ':SENS%i:FREQ:STOP %f' % (self._ci, val))
     def set_power(self, power):
         '''
         Set power
@@ -162,7 +287,7 @@ class RSVNA():
         Output:
             None
         '''
-        self.write(':SOURce%i:POWer %f' % (self._ci, power))
+        self.set('power', power, ':SOURce%i:POWer %f' % (self._ci, power))
         self.power = power
 
     def set_rf_on(self):
@@ -189,10 +314,10 @@ class RSVNA():
         '''
         if status:
             self.average_mode = True
-            self.write('SENS%i:AVER:STAT %s' % (self._ci, "ON"))
+            self.set('average_state', "ON", 'SENS%i:AVER:STAT %s' % (self._ci, "ON"))
         else:
             self.average_mode = False
-            self.write('SENS%i:AVER:STAT %s' % (self._ci, "OFF"))
+            self.set('average_state', "OFF", 'SENS%i:AVER:STAT %s' % (self._ci, "OFF"))
 
     def set_averages(self, av):
         '''
@@ -205,7 +330,7 @@ class RSVNA():
         # if self._zerospan:
         #     self._visainstrument.write('SWE:POIN %.1f' % (self._ci, av))
         # else:
-        self.write('SENS%i:AVER:COUN %i' % (self._ci, av))
+        self.set('average_count', av, 'SENS%i:AVER:COUN %i' % (self._ci, av))
         self.averages = av
 
 
@@ -217,6 +342,10 @@ class RSVNA():
             self.set_frequencies(self.start_freq, self.stop_freq, self.nop)
             self.set_average(self.average_mode)
             self.set_averages(self.averages)
+        elif (self.sweep_mode == 'SEGM'):
+            self.set_segments(self.segments)
+            self.set_average(self.average_mode)
+            self.set_averages(self.averages)
         elif (self.sweep_mode == 'CW'):
             #set fixed CW frequency
             self.set_fixed_frequency(self.fixed_cw_frequency)
@@ -226,30 +355,33 @@ class RSVNA():
 
     def measure(self):
 
+        # only settings that differ from the known instrument state are sent
         self.set_all_parameters()
 
         old_timeout = self._visainstrument.timeout
         sweep_time = float(self.query('SENSe1:SWEep:TIME?'))
         self._visainstrument.timeout = sweep_time * 1000 + 5000
 
-        for i in range(self.averages):
-            # Clear status, initiate measurement
-            self.write("*CLS;INIT:IMM;*OPC")
-            # self.write(":DISPlay:WINDow1:TRACe1:Y:AUTO")
-            # Check first bit im ESR (operation complete)
-            while not (int(self._visainstrument.query("*ESR?")) & 1):
-                time.sleep(0.002)
+        # one sweep per average
+        try:
+            run_sweeps(self._visainstrument, self.completion, sweep_time, self.averages)
+        finally:
+            self._visainstrument.timeout = old_timeout
         # for ch in [1,2,3,4]:
         #     self.write('TRIGger%i:SEQuence:SOURce IMMediate' % (ch,))
         #     self.write('INITiate%i:IMMediate' % (ch,))
-
-        # print(float(sweep_time / 1e3 * self.nop))
-        time.sleep(.2)
-        self.wait()
-        # print(self.query('*OPC?'))
-        self._visainstrument.timeout = old_timeout
         return {'S-parameter': self.get_data()}
 
+    def set_completion(self, completion):
+        '''
+        Set the strategy for detecting the end of a sweep
+        Input:
+            completion (string or object) : poll | opc | srq or a strategy object from SCPITools
+        Output:
+            None
+        '''
+        self.completion = get_completion(completion)
+
     def get_sweep_time(self):
         """
         Get the time needed for one sweep
@@ -278,7 +410,7 @@ class RSVNA():
             None
         '''
         if source.upper() in ["ON", "OFF"]:
-            self.write('INIT:CONT %s' % source.upper())
+            self.set('continuous', source.upper(), 'INIT:CONT %s' % source.upper())
         else:
             raise ValueError('set_trigger_source(): must be ON | OFF ')
 
@@ -289,7 +421,7 @@ class RSVNA():
             mode (string) AUTO | FLATten | REDuse | MOVing
         '''
         if mode.upper() in ["AUTO", "FLAT", "RED", "MOV", "FLATTEN", "REDUCE", "MOVING"]:
-            self.write("SENS:AVER:MODE " + mode)
+            self.set('average_mode', mode.upper(), "SENS:AVER:MODE " + mode)
         else:
             ValueError('set_average_mode(mode): mode must be AUTO | FLATten | REDuse | MOVing')
 
@@ -297,9 +429,20 @@ class RSVNA():
 
 
     def set_bandwidth(self, band):
-        self.bw = self.write('SENS%i:BWID:RES %i' % (self._ci, band))
-        self.wait()
-        self.bw = float(self.query('SENS%i:BWID:RES?'%self._ci))
+        '''
+        Set the IF bandwidth, the instrument rounds it to the next available one
+        Input:
+            band (float) : bandwidth in Hz
+        Output:
+            the bandwidth the instrument uses, read back unless the bandwidth was cached or is set within a batch (then
+            the requested bandwidth)
+        '''
+        # the requested value is cached and kept in self.bw, so repeating the request (e.g. in set_all_parameters)
+        # is skipped even if the instrument rounded it
+        self.bw = band
+        if self.set('bandwidth', band, 'SENS%i:BWID:RES %i' % (self._ci, band)) and not self._batch.active:
+            self.wait()
+            return float(self.query('SENS%i:BWID:RES?'%self._ci))
         return self.bw
 
     #####################################################################
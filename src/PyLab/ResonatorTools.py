@@ -47,6 +47,31 @@ def get_linspace_precise(f_c, q_l, df_res=40):
     return get_linspace(f_s, f_e, q_l, df_res)
 
 
+def get_linspace_adaptive(f_c, q_l, span, nop, core_linewidths=2, core_fraction=0.8):
+    """
+    Get a non-uniform grid for a precise fit: a dense uniform core within a few linewidths around the resonance
+    frequency and sparse uniform wings up to the span (for the background and the delay). Consists of three uniform
+    segments, so it can be measured as a segmented sweep.
+    :param f_c: resonance frequency
+    :param q_l: loaded quality factor
+    :param span: full frequency span
+    :param nop: total number of points
+    :param core_linewidths: half width of the core in linewidths f_c/q_l
+    :param core_fraction: fraction of the points in the core
+    :return: the frequencies, ascending
+    """
+    half_core = core_linewidths*f_c/q_l
+    n_core = max(int(round(core_fraction*nop)), 2)
+    n_wing = (nop - n_core)//2
+    if n_wing <= 0 or half_core >= span/2:
+        return np.linspace(f_c - span/2, f_c + span/2, nop)
+    core = np.linspace(f_c - half_core, f_c + half_core, n_core)
+    # the wings end one point spacing before the core, so no frequency is measured twice
+    left = np.linspace(f_c - span/2, f_c - half_core, n_wing + 1)[:-1]
+    right = np.linspace(f_c + half_core, f_c + span/2, nop - n_core - n_wing + 1)[1:]
+    return np.concatenate([left, core, right])
+
+
 def get_params_spectrum():
     """
     :return: bandwidth, power, averages
@@ -0,0 +1,372 @@
+import numpy as np
+import logging
+import time
+
+
+"""
+helpers shared by the SCPI instrument drivers (PNA, RSVNA)
+"""
+
+
+# binary data formats (SCPI FORMat argument) and the corresponding struct data types
+BINARY_FORMATS = {"REAL,64": "d", "REAL,32": "f"}
+
+
+def query_complex_data(visainstrument, cmd: str, data_format="ASCII"):
+    """
+    Query complex-valued trace data that the instrument sends as interleaved real and imaginary parts
+
+    :param visainstrument: pyvisa resource of the instrument
+    :param cmd: SCPI query, e.g. "CALCulate:DATA? SDATa"
+    :param data_format: "REAL,64" or "REAL,32" for an IEEE 488.2 binary block in little-endian byte order (FORMat:BORDer
+                        SWAPped), "ASCII" for comma separated values. Must match the format set in the instrument.
+    :return: complex-valued np array
+    """
+    if data_format in BINARY_FORMATS:
+        data = visainstrument.query_binary_values(cmd, datatype=BINARY_FORMATS[data_format], is_big_endian=False,
+                                                  container=np.array)
+        # the block is parsed with np.frombuffer (read-only, no intermediate list), one copy makes it writable
+        return np.array(data, dtype=np.float64).view(np.complex128)
+
+    data = visainstrument.query_ascii_values(cmd, container=np.array)
+    return data[0::2] + 1j*data[1::2]
+
+
+def get_segments(frequencies, rtol=1e-6):
+    """
+    Split a frequency grid into runs of uniform spacing, e.g. for a segmented sweep
+
+    :param frequencies: ascending frequencies in Hz
+    :param rtol: relative tolerance of the spacing within a segment
+    :return: list of (start, stop, nop) tuples, a single tuple for a linear grid
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    spacing = np.diff(frequencies)
+    segments = []
+    start = 0
+    while start < len(frequencies):
+        if start == len(frequencies) - 1:
+            segments.append((frequencies[start], frequencies[start], 1))
+            break
+        # extend the segment as long as the spacing stays the one of its first step
+        step = spacing[start]
+        end = start + 1
+        while end < len(spacing) and abs(spacing[end] - step) <= rtol*abs(step):
+            end += 1
+        segments.append((frequencies[start], frequencies[end], end - start + 1))
+        start = end + 1
+    return segments
+
+
+class PollingCompletion:
+    """
+    Sweep completion by polling the OPC bit of the event status register. Nothing is polled during most of the known
+    sweep time, afterwards the polling interval grows geometrically from min_interval up to max_interval.
+    """
+
+    name = "poll"
+
+    def __init__(self, min_interval=0.002, max_interval=0.2, backoff=1.5, initial_fraction=0.9):
+        """
+        :param min_interval: first polling interval in s
+        :param max_interval: longest polling interval in s (bounded by 5% of the sweep time, but not below min_interval)
+        :param backoff: factor by which the polling interval grows
+        :param initial_fraction: fraction of the nominal sweep time to wait before the first poll
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.initial_fraction = initial_fraction
+        self.queries = 0
+
+    def sweep(self, visainstrument, sweep_time):
+        """
+        Trigger a single sweep and block until it is complete
+
+        :param visainstrument: pyvisa resource of the instrument
+        :param sweep_time: nominal time of the sweep in s
+        """
+        visainstrument.write("*CLS;INIT:IMM;*OPC")
+        time.sleep(self.initial_fraction*sweep_time)
+        max_interval = min(self.max_interval, max(self.min_interval, 0.05*sweep_time))
+        interval = self.min_interval
+        self.queries = 1
+        # Check first bit in the event status register for OPC
+        while not (int(visainstrument.query("*ESR?")) & 1):
+            time.sleep(interval)
+            interval = min(interval*self.backoff, max_interval)
+            self.queries += 1
+
+
+class OPCCompletion:
+    """
+    Sweep completion by a single blocking *OPC? query, its timeout is computed from the nominal sweep time
+    """
+
+    name = "opc"
+
+    def __init__(self, margin=1.2, timeout_offset=5.):
+        """
+        :param margin: factor on the nominal sweep time for the timeout
+        :param timeout_offset: additional timeout in s
+        """
+        self.margin = margin
+        self.timeout_offset = timeout_offset
+        self.queries = 0
+
+    def sweep(self, visainstrument, sweep_time):
+        """
+        Trigger a single sweep and block until it is complete
+
+        :param visainstrument: pyvisa resource of the instrument
+        :param sweep_time: nominal time of the sweep in s
+        """
+        old_timeout = visainstrument.timeout
+        visainstrument.timeout = (self.margin*sweep_time + self.timeout_offset)*1000
+        try:
+            visainstrument.write("*CLS;INIT:IMM")
+            visainstrument.query("*OPC?")
+        finally:
+            visainstrument.timeout = old_timeout
+        self.queries = 1
+
+
+class SRQCompletion:
+    """
+    Sweep completion by a service request: OPC sets the event status bit (ESB) of the status byte, which asserts SRQ.
+    Needs an interface with service requests (GPIB, USB, VXI-11 or HiSLIP, not raw sockets).
+    """
+
+    name = "srq"
+
+    def __init__(self, margin=1.2, timeout_offset=5.):
+        """
+        :param margin: factor on the nominal sweep time for the timeout
+        :param timeout_offset: additional timeout in s
+        """
+        self.margin = margin
+        self.timeout_offset = timeout_offset
+        self.queries = 0
+
+    def sweep(self, visainstrument, sweep_time):
+        """
+        Trigger a single sweep and block until it is complete
+
+        :param visainstrument: pyvisa resource of the instrument
+        :param sweep_time: nominal time of the sweep in s
+        """
+        visainstrument.write("*CLS;*ESE 1;*SRE 32;INIT:IMM;*OPC")
+        visainstrument.wait_for_srq((self.margin*sweep_time + self.timeout_offset)*1000)
+        # reading the event status register clears ESB and with it the request
+        visainstrument.query("*ESR?")
+        self.queries = 1
+
+
+COMPLETION_STRATEGIES = {strategy.name: strategy for strategy in [PollingCompletion, OPCCompletion, SRQCompletion]}
+
+
+def get_completion(completion):
+    """
+    Get a sweep completion strategy
+
+    :param completion: name of the strategy (poll, opc or srq) or a strategy object
+    :return: the strategy object
+    """
+    if isinstance(completion, str):
+        if completion.lower() not in COMPLETION_STRATEGIES:
+            raise ValueError(f"Sweep completion must be one of {', '.join(COMPLETION_STRATEGIES)}.")
+        return COMPLETION_STRATEGIES[completion.lower()]()
+    return completion
+
+
+def run_sweeps(visainstrument, completion, sweep_time, count=1):
+    """
+    Run a number of single sweeps and log the time spent beyond the nominal sweep time
+
+    :param visainstrument: pyvisa resource of the instrument
+    :param completion: sweep completion strategy
+    :param sweep_time: nominal time of a single sweep in s
+    :param count: number of sweeps, e.g. for sweep averaging
+    :return: the overhead in s
+    """
+    queries = 0
+    start = time.perf_counter()
+    for i in range(count):
+        completion.sweep(visainstrument, sweep_time)
+        queries += completion.queries
+    elapsed = time.perf_counter() - start
+    overhead = elapsed - count*sweep_time
+    logging.info(f"{count} sweep(s) with {completion.name} completion took {elapsed:.3f} s (nominal "
+                 f"{count*sweep_time:.3f} s, overhead {overhead:.3f} s, {queries} completion queries)")
+    return overhead
+
+
+def join_commands(commands, max_length=1000):
+    """
+    Join SCPI commands into semicolon-separated program messages
+
+    :param commands: list of SCPI commands, each starting with a colon or an asterisk (see CommandBatch.add)
+    :param max_length: maximum length of a program message in characters
+    :return: list of program messages
+    """
+    messages = [commands[0]]
+    for cmd in commands[1:]:
+        if len(messages[-1]) + len(cmd) + 1 > max_length:
+            messages.append(cmd)
+        else:
+            messages[-1] += ";" + cmd
+    return messages
+
+
+class InstrumentState:
+    """
+    Shadow copy of the instrument settings. A setting is only sent if its value differs from the last one confirmed by
+    the instrument. Changes done at the instrument itself are not noticed, call invalidate() (or resync() of the
+    driver) after touching the instrument manually.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self.skipped = 0  # number of commands that were not sent because the setting did not change
+        self.sent = 0  # number of commands sent through the state
+
+    def set(self, key, value, write, cmd):
+        """
+        Send a setting if its value changed
+
+        :param key: name of the setting
+        :param value: new value of the setting
+        :param write: function sending a SCPI command
+        :param cmd: SCPI command applying the setting
+        :return: True if the command was sent, False if it was skipped
+        """
+        if key in self._values and self._values[key] == value:
+            self.skipped += 1
+            return False
+        # forget the old value first, the setting is unknown if writing fails
+        self._values.pop(key, None)
+        write(cmd)
+        self._values[key] = value
+        self.sent += 1
+        return True
+
+    def confirm(self, key, value):
+        """
+        Store a value read back from the instrument
+
+        :param key: name of the setting
+        :param value: the value in the instrument
+        """
+        self._values[key] = value
+
+    def get(self, key, default=None):
+        """
+        Get the last confirmed value of a setting
+
+        :param key: name of the setting
+        :param default: returned if the setting is unknown
+        :return: the value
+        """
+        return self._values.get(key, default)
+
+    def invalidate(self, key=None):
+        """
+        Forget the confirmed value of one or all settings, so that they are sent again
+
+        :param key: name of the setting, or None for all settings
+        """
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+
+class CommandBatch:
+    """
+    Collects SCPI commands and sends them as semicolon-separated program messages, so that a sequence of settings costs
+    a single round trip: one write of all commands followed by *OPC?. The first message of a batch starts with *CLS,
+    so that errors left by earlier commands are not blamed on the batch, and the error queue is checked once at the end
+    of a batch that sent anything. Batches can be nested, the commands are sent when the outermost batch ends.
+    """
+
+    def __init__(self, visainstrument, max_length=1000):
+        """
+        :param visainstrument: pyvisa resource of the instrument
+        :param max_length: maximum length of a program message in characters (instruments have a limited input buffer)
+        """
+        self._visainstrument = visainstrument
+        self.max_length = max_length
+        self._commands = []
+        self._depth = 0
+        self._sent = False  # whether the current batch sent commands, i.e. its errors have to be checked
+        self.round_trips = 0  # number of program messages sent
+
+    @property
+    def active(self):
+        return self._depth > 0
+
+    def add(self, cmd):
+        """
+        Queue a command until the batch is flushed
+
+        :param cmd: SCPI command
+        """
+        # commands following a semicolon are relative to the previous header path, unless they start with a colon
+        if not cmd.startswith((":", "*")):
+            cmd = ":" + cmd
+        self._commands.append(cmd)
+
+    def flush(self):
+        """
+        Send the queued commands and block until the instrument has processed them
+
+        :return: the answer to the final *OPC?, or None if there was nothing to send
+        """
+        if len(self._commands) == 0:
+            return None
+        if not self._sent:
+            self._commands.insert(0, "*CLS")
+            self._sent = True
+        messages = join_commands(self._commands, self.max_length)
+        self._commands = []
+
+        for message in messages[:-1]:
+            self._visainstrument.write(message)
+        self.round_trips += len(messages)
+        return self._visainstrument.query(messages[-1] + ";*OPC?")
+
+    def check_errors(self):
+        """
+        Query the error queue of the instrument
+
+        :return: list of the error messages, empty if there was no error
+        """
+        errors = []
+        error = self._visainstrument.query("SYST:ERR?").strip()
+        # the queue is read until it reports 0 (no error), bounded in case an instrument never does
+        while not error.startswith(("0,", "+0,")) and len(errors) < 100:
+            errors.append(error)
+            error = self._visainstrument.query("SYST:ERR?").strip()
+        return errors
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._sent = False
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        if exc_type is not None:
+            # the commands of a failed batch are dropped
+            self._commands = []
+            return
+        self.flush()
+        if not self._sent:
+            # all settings were skipped, nothing to check
+            return
+        errors = self.check_errors()
+        if len(errors) > 0:
+            raise RuntimeError(f"Instrument reported errors in command batch: {'; '.join(errors)}")
@@ -0,0 +1,533 @@
+import numpy as np
+import re
+import socketserver
+import threading
+import time
+import logging
+from collections import deque
+from PyLab.SimVNA import SimVNA
+
+
+"""
+simulated VNA speaking SCPI over a raw TCP socket, so that the drivers (PNA, RSVNA), the VNA frontend and the scripts can
+be run and benchmarked without hardware. The resonator data comes from the SimVNA model. Connect with the VISA address
+of the server, e.g. VNA(name='PNA', address='TCPIP0::127.0.0.1::5025::SOCKET') (needs a VISA backend with socket
+support, e.g. pyvisa-py).
+"""
+
+
+def _pattern(spec):
+    """
+    Compile a SCPI header specification into a regular expression. Upper case letters are the short form, lower case
+    letters the optional rest of the long form, # allows a numeric suffix, [] marks optional nodes and | alternatives.
+
+    :param spec: specification, e.g. "SENSe#:BANDwidth|BWIDth:[RESolution]"
+    :return: compiled regular expression matching the upper case header
+    """
+    regex = ""
+    for node in spec.split(":"):
+        optional = node.startswith("[")
+        alternatives = []
+        for alternative in node.strip("[]").split("|"):
+            suffix = r"\d*" if alternative.endswith("#") else ""
+            alternative = alternative.rstrip("#")
+            short = "".join(c for c in alternative if not c.islower())
+            rest = alternative[len(short):].upper()
+            alternatives.append(short + (f"(?:{rest})?" if rest else "") + suffix)
+        node_regex = ":(?:" + "|".join(alternatives) + ")"
+        regex += f"(?:{node_regex})?" if optional else node_regex
+    return re.compile(regex + "$")
+
+
+class SimSCPIInstrument:
+    """
+    SCPI command interpreter with the state of the simulated VNA. A sweep takes the time given by the IF bandwidth,
+    the number of points and the averaging, during which *OPC? blocks and the OPC bit of *ESR? stays cleared.
+    """
+
+    # allowed IF bandwidths, other values are rounded to the closest one like on the instruments
+    bandwidths = np.array([m*10.**e for e in range(0, 7) for m in [1, 1.5, 2, 3, 5, 7]])
+
+    def __init__(self, seed=12345, time_scale=1., point_time=20e-6, sweep_overhead=1e-3):
+        """
+        :param seed: seed of the SimVNA model
+        :param time_scale: factor on all sweep times, e.g. 0.01 for fast load tests
+        :param point_time: settling time per point in s, added to the measurement time 1/bandwidth
+        :param sweep_overhead: time per sweep in s (retrace)
+        """
+        self._sim = SimVNA(seed)
+        self.time_scale = time_scale
+        self.point_time = point_time
+        self.sweep_overhead = sweep_overhead
+        self.messages = 0  # number of program messages received since the start of the server
+        self.writes = 0  # number of commands without query (settings, triggers), common commands excluded
+
+        self._handlers = [(_pattern(spec), handler) for spec, handler in [
+            ("SOURce#:POWer#:[LEVel]:[IMMediate]:[AMPLitude]", self._power),
+            ("SENSe#:BANDwidth|BWIDth:[RESolution]", self._bandwidth),
+            ("SENSe#:SWEep:POINts", self._points),
+            ("SENSe#:SWEep:TIME", self._sweep_time),
+            ("SENSe#:SWEep:TYPE", self._sweep_type),
+            ("SENSe#:FREQuency:STARt", self._start),
+            ("SENSe#:FREQuency:STOP", self._stop),
+            ("SENSe#:FREQuency:CENTer", self._center),
+            ("SENSe#:FREQuency:SPAN", self._span),
+            ("SENSe#:FREQuency:CW|FIXed", self._cw),
+            ("SENSe#:SEGMent#:DELete:ALL", self._segment_delete_all),
+            ("SENSe#:SEGMent#:ADD", self._segment_add),
+            ("SENSe#:SEGMent#:FREQuency:STARt", self._segment_start),
+            ("SENSe#:SEGMent#:FREQuency:STOP", self._segment_stop),
+            ("SENSe#:SEGMent#:SWEep:POINts", self._segment_points),
+            ("SENSe#:SEGMent#:[STATe]", self._segment_state),
+            ("SENSe#:AVERage:[STATe]", self._average_state),
+            ("SENSe#:AVERage:COUNt", self._average_count),
+            ("SENSe#:AVERage:MODE", self._average_mode),
+            ("OUTPut#:[STATe]", self._output),
+            ("INITiate#:CONTinuous", self._continuous),
+            ("INITiate#:[IMMediate]", self._initiate),
+            ("FORMat:[DATA]", self._format),
+            ("FORMat:BORDer", self._byte_order),
+            ("CALCulate#:DATA", self._data),
+            ("SYSTem:ERRor:[NEXT]", self._error),
+        ]]
+        # display and trace management is accepted but has no effect
+        self._ignored = [_pattern(spec) for spec in ["SENSe#:SEGMent#:BWIDth|BANDwidth:[RESolution]:CONTrol",
+                                                      "SENSe#:SEGMent#:POWer:[LEVel]:CONTrol",
+                                                      "DISPlay:WINDow#:STATe", "DISPlay:WINDow#:TRACe#:FEED",
+                                                      "DISPlay:WINDow#:TRACe#:DELete", "CALCulate#:PARameter:SDEFine",
+                                                      "CALCulate#:PARameter:DEFine:[EXTended]",
+                                                      "CALCulate#:PARameter:DELete:[NAME]"]]
+        self.reset()
+
+    def reset(self):
+        """
+        Reset the settings and the status registers (*RST)
+        """
+        self.power = -20.
+        self.bandwidth = 1000.
+        self.points = 201
+        self.start = 4e9
+        self.stop = 6e9
+        self.cw = 5e9
+        self.sweep_type = "LIN"
+        self.average_state = False
+        self.average_count = 1
+        self.average_mode = "SWEEP"
+        self.output = False
+        self.continuous = True
+        self.data_format = "ASCII"
+        self.byte_order = "NORM"
+        # segments of the segmented sweep by their number, each a dictionary of start, stop, points and state
+        self.segments = {}
+
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+        self._opc_armed = False
+        self._sweep_end = 0.
+        self._errors = deque(maxlen=100)
+        self._trace = None
+        self._n_averaged = 0
+        self.sweeps = 0  # number of sweeps since the start of the server
+
+    def get_sweep_time(self):
+        """
+        Get the duration of a single sweep
+
+        :return: sweep time in s
+        """
+        sweep_time = len(self.get_frequencies())*(1/self.bandwidth + self.point_time) + self.sweep_overhead
+        if self.average_state and self.average_mode.startswith("POIN"):
+            sweep_time *= self.average_count
+        return sweep_time*self.time_scale
+
+    def get_frequencies(self):
+        """
+        Get the frequencies of the current sweep settings
+
+        :return: frequencies as a np array
+        """
+        if self.sweep_type.startswith("POIN") or self.sweep_type == "CW":
+            return np.full(self.points, self.cw)
+        if self.sweep_type.startswith("SEGM"):
+            segments = [self.segments[i] for i in sorted(self.segments) if self.segments[i]["state"]]
+            if len(segments) == 0:
+                return np.array([])
+            return np.concatenate([np.linspace(segment["start"], segment["stop"], segment["points"])
+                                   for segment in segments])
+        return np.linspace(self.start, self.stop, self.points)
+
+    def process(self, message):
+        """
+        Execute a program message, i.e. one line of semicolon separated commands
+
+        :param message: the program message
+        :return: the response as bytes (including the termination) or None, if the message contains no query
+        """
+        self.messages += 1
+        responses = []
+        path = ""
+        for command in _split(message):
+            command = command.strip()
+            if len(command) == 0:
+                continue
+            header, _, argument = command.partition(" ")
+            header = header.upper()
+            # a command without leading colon continues at the header path of the previous one
+            if header.startswith("*"):
+                full_header = header
+            elif header.startswith(":"):
+                full_header = header
+            else:
+                full_header = path + ":" + header
+            if not full_header.startswith("*"):
+                path = full_header[:full_header.rfind(":")]
+
+            query = full_header.endswith("?")
+            self._header = full_header
+            response = self._execute(full_header.rstrip("?"), query, argument.strip())
+            if query and response is not None:
+                responses.append(response)
+
+        if len(responses) == 0:
+            return None
+        if any(isinstance(response, bytes) for response in responses):
+            return b";".join(response if isinstance(response, bytes) else response.encode()
+                             for response in responses) + b"\n"
+        return (";".join(responses) + "\n").encode()
+
+    def _execute(self, header, query, argument):
+        if header.startswith("*"):
+            return self._common(header, query, argument)
+        if not query:
+            self.writes += 1
+        for pattern, handler in self._handlers:
+            if pattern.match(header):
+                try:
+                    return handler(query, argument)
+                except ValueError:
+                    self._errors.append('-224,"Illegal parameter value"')
+                    return None
+        if any(pattern.match(header) for pattern in self._ignored):
+            return "1" if query else None
+        self._errors.append(f'-113,"Undefined header;{header}"')
+        logging.warning(f"SimSCPIServer: undefined header {header}")
+        return None
+
+    def _common(self, header, query, argument):
+        if header == "*IDN":
+            return "Simulated,SimVNA,0,1.0"
+        if header == "*RST":
+            self.reset()
+        elif header == "*CLS":
+            self.esr = 0
+            self._opc_armed = False
+            self._errors.clear()
+        elif header == "*ESE":
+            if query:
+                return str(self.ese)
+            self.ese = int(argument)
+        elif header == "*SRE":
+            if query:
+                return str(self.sre)
+            self.sre = int(argument)
+        elif header == "*ESR":
+            if self._opc_armed and time.monotonic() >= self._sweep_end:
+                self.esr |= 1
+                self._opc_armed = False
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        elif header == "*OPC":
+            if query:
+                self._wait()
+                return "1"
+            self._opc_armed = True
+        elif header == "*WAI":
+            self._wait()
+        else:
+            self._errors.append(f'-113,"Undefined header;{header}"')
+        return None
+
+    def _wait(self):
+        remaining = self._sweep_end - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def _setting(self, name, query, argument, convert=float):
+        if query:
+            value = getattr(self, name)
+            if isinstance(value, bool):
+                return "1" if value else "0"
+            if isinstance(value, str):
+                return value
+            if isinstance(value, (int, np.integer)):
+                return str(int(value))
+            return f"{value:+.12E}"
+        setattr(self, name, convert(argument))
+        # changed settings restart the averaging
+        self._n_averaged = 0
+        return None
+
+    def _power(self, query, argument):
+        return self._setting("power", query, argument)
+
+    def _bandwidth(self, query, argument):
+        if not query:
+            argument = self.bandwidths[np.argmin(np.abs(self.bandwidths - float(argument)))]
+        return self._setting("bandwidth", query, argument)
+
+    def _points(self, query, argument):
+        return self._setting("points", query, argument, lambda value: int(float(value)))
+
+    def _sweep_time(self, query, argument):
+        return f"{self.get_sweep_time():+.12E}"
+
+    def _sweep_type(self, query, argument):
+        return self._setting("sweep_type", query, argument, str.upper)
+
+    def _start(self, query, argument):
+        return self._setting("start", query, argument)
+
+    def _stop(self, query, argument):
+        return self._setting("stop", query, argument)
+
+    def _center(self, query, argument):
+        if query:
+            return f"{(self.start + self.stop)/2:+.12E}"
+        span = self.stop - self.start
+        self._setting("start", False, float(argument) - span/2)
+        return self._setting("stop", False, float(argument) + span/2)
+
+    def _span(self, query, argument):
+        if query:
+            return f"{self.stop - self.start:+.12E}"
+        center = (self.start + self.stop)/2
+        self._setting("start", False, center - float(argument)/2)
+        return self._setting("stop", False, center + float(argument)/2)
+
+    def _cw(self, query, argument):
+        return self._setting("cw", query, argument)
+
+    def _segment(self):
+        # the segment number is the suffix of the SEGMent node of the current header
+        number = re.search(r":SEGM(?:ENT)?(\d*)", self._header).group(1)
+        return self.segments.setdefault(int(number) if number else 1,
+                                        {"start": self.start, "stop": self.stop, "points": 21, "state": True})
+
+    def _segment_setting(self, name, query, argument, convert=float):
+        segment = self._segment()
+        if query:
+            value = segment[name]
+            return str(int(value)) if isinstance(value, (bool, int)) else f"{value:+.12E}"
+        segment[name] = convert(argument)
+        self._n_averaged = 0
+        return None
+
+    def _segment_delete_all(self, query, argument):
+        self.segments = {}
+        self._n_averaged = 0
+        return None
+
+    def _segment_add(self, query, argument):
+        self._segment()
+        return None
+
+    def _segment_start(self, query, argument):
+        return self._segment_setting("start", query, argument)
+
+    def _segment_stop(self, query, argument):
+        return self._segment_setting("stop", query, argument)
+
+    def _segment_points(self, query, argument):
+        return self._segment_setting("points", query, argument, lambda value: int(float(value)))
+
+    def _segment_state(self, query, argument):
+        return self._segment_setting("state", query, argument, _boolean)
+
+    def _average_state(self, query, argument):
+        return self._setting("average_state", query, argument, _boolean)
+
+    def _average_count(self, query, argument):
+        return self._setting("average_count", query, argument, lambda value: int(float(value)))
+
+    def _average_mode(self, query, argument):
+        return self._setting("average_mode", query, argument, str.upper)
+
+    def _output(self, query, argument):
+        return self._setting("output", query, argument, _boolean)
+
+    def _continuous(self, query, argument):
+        if query:
+            return "1" if self.continuous else "0"
+        self.continuous = _boolean(argument)
+        return None
+
+    def _initiate(self, query, argument):
+        """
+        Start a sweep: the trace is computed right away, but the sweep only completes after the sweep time
+        """
+        self._wait()
+        trace = self._sim.simulate(self.get_frequencies(), self.bandwidth, self.power)
+        if self.average_state and self._trace is not None and self._n_averaged > 0:
+            self._n_averaged = min(self._n_averaged + 1, self.average_count)
+            self._trace = self._trace + (trace - self._trace)/self._n_averaged
+        else:
+            self._n_averaged = 1
+            self._trace = trace
+        self._sweep_end = time.monotonic() + self.get_sweep_time()
+        self.sweeps += 1
+        return None
+
+    def _format(self, query, argument):
+        if query:
+            return self.data_format
+        argument = argument.upper().replace(" ", "")
+        if argument.startswith("REAL,64") or argument == "REAL":
+            self.data_format = "REAL,64"
+        elif argument.startswith("REAL,32"):
+            self.data_format = "REAL,32"
+        elif argument.startswith("ASC"):
+            self.data_format = "ASCII"
+        else:
+            raise ValueError(argument)
+        return None
+
+    def _byte_order(self, query, argument):
+        if query:
+            return self.byte_order
+        self.byte_order = "SWAP" if argument.upper().startswith("SWAP") else "NORM"
+        return None
+
+    def _data(self, query, argument):
+        if not query:
+            raise ValueError(argument)
+        trace = self._trace if self._trace is not None else np.zeros(len(self.get_frequencies()), dtype=complex)
+        values = np.empty(2*len(trace))
+        values[0::2] = trace.real
+        values[1::2] = trace.imag
+        if self.data_format == "ASCII":
+            return ",".join(f"{value:+.12E}" for value in values)
+        dtype = "<" if self.byte_order == "SWAP" else ">"
+        dtype += "f8" if self.data_format == "REAL,64" else "f4"
+        payload = values.astype(dtype).tobytes()
+        length = str(len(payload))
+        return f"#{len(length)}{length}".encode() + payload
+
+    def _error(self, query, argument):
+        if len(self._errors) == 0:
+            return '0,"No error"'
+        return self._errors.popleft()
+
+
+def _split(message):
+    """
+    Split a program message at the semicolons outside of quoted strings
+    """
+    commands = []
+    current = ""
+    quote = None
+    for char in message:
+        if quote is None and char in "'\"":
+            quote = char
+        elif char == quote:
+            quote = None
+        if char == ";" and quote is None:
+            commands.append(current)
+            current = ""
+        else:
+            current += char
+    commands.append(current)
+    return commands
+
+
+def _boolean(argument):
+    argument = argument.strip().upper()
+    if argument in ["ON", "1"]:
+        return True
+    if argument in ["OFF", "0"]:
+        return False
+    raise ValueError(argument)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            message = line.decode(errors="replace").strip()
+            with self.server.lock:
+                response = self.server.instrument.process(message)
+            if response is not None:
+                self.wfile.write(response)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SimSCPIServer:
+
+    def __init__(self, host="127.0.0.1", port=5025, **instrument_kwargs):
+        """
+        Create the server, start it with start() (in a background thread) or serve_forever()
+
+        :param host: host name or IP address to listen on
+        :param port: TCP port, 5025 is the usual SCPI socket port. 0 picks a free port.
+        :param instrument_kwargs: arguments for SimSCPIInstrument (seed, time_scale, point_time, sweep_overhead)
+        """
+        self.instrument = SimSCPIInstrument(**instrument_kwargs)
+        self._server = _Server((host, port), _Handler)
+        self._server.instrument = self.instrument
+        # one instrument, so the messages of all connections are processed one after the other
+        self._server.lock = threading.Lock()
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    @property
+    def address(self):
+        """
+        VISA resource name of the server
+        """
+        return f"TCPIP0::{self.host}::{self.port}::SOCKET"
+
+    def start(self):
+        """
+        Serve in a background thread
+
+        :return: the server itself
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Serve in the current thread until interrupted
+        """
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+
+    server = SimSCPIServer(port=5025)
+    print(f"Simulated VNA listening at {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,30 +1,27 @@
 from PyLab.Measurement import *
 import numpy as np
-import random
-import random
 
 class SimVNA:
 
-    def __init__(self, seed=12345):
+    def __init__(self, seed=12345, n_resonators=10):
         """
-        Initialize an object of the VNA class
+        Initialize an object of the VNA class. The resonator parameters, the frequency jitter and the noise are drawn
+        from a np.random.Generator, so a simulation is reproducible from the seed (and the order of the measurements).
+        :param seed: seed of the random number generator
+        :param n_resonators: number of resonators, spaced by 200 MHz starting at 4.1 GHz
         """
         self._measurement = None
         self._seed = seed
+        self._rng = np.random.default_rng(seed)
 
-        self._lorentz_params = []
-        random.seed(seed)
-        for i in range(10):
-            q_c = random.randint(150_000, 170_000)
-            # q_i0 = random.randint(100_000, 140_000)
-            q_i0 = 100_000
-            # d_i = random.randint(20_000, 50_000)
-            d_i = 50_000
-            phi = 0 + random.random()*0.2 #0.3
-            f_r = 4.1e9+0.2e9*i + random.randint(-10_000_000, 10_000_000)
-
-            self._lorentz_params.append((q_c, q_i0, d_i, phi, f_r))
-
+        self._q_c = self._rng.integers(150_000, 170_000, n_resonators, endpoint=True).astype(float)
+        # self._q_i0 = self._rng.integers(100_000, 140_000, n_resonators, endpoint=True).astype(float)
+        self._q_i0 = np.full(n_resonators, 100_000.)
+        # self._d_i = self._rng.integers(20_000, 50_000, n_resonators, endpoint=True).astype(float)
+        self._d_i = np.full(n_resonators, 50_000.)
+        self._phi = 0 + self._rng.random(n_resonators)*0.2  # 0.3
+        self._f_r = 4.1e9 + 0.2e9*np.arange(n_resonators) + self._rng.integers(-10_000_000, 10_000_000, n_resonators,
+                                                                              endpoint=True)
 
     def set_measurement(self, measurement: Measurement):
         """
@@ -33,47 +30,86 @@ class SimVNA:
         """
         self._measurement = measurement
 
-    def measure(self, save=True):
+    def measure(self, save=True, writer=None):
         """
         Start a VNA measurement with the parameters of the Measurement object
         :param save: if false, the data won't be saved
-        :return: the path of the saved measurement data, without suffix - or None, if the data wasn't saved
+        :param writer: AsyncWriter saving the data in the background, None to save before returning
+        :return: the path of the saved measurement data, without suffix (a Future of it if a writer is used) - or None,
+                 if the data wasn't saved
         """
         if self._measurement is None:
             raise TypeError("Measurement has not been set yet!")
 
-        data = []
-
-        for f in self._measurement.get_frequencies():
-            data.append(self._signal(f))
+        data = self.simulate(self._measurement.get_frequencies(), self._measurement.get_bandwidth(),
+                             self._measurement.get_power())
 
         self._measurement.set_data(data)
         print(len(self._measurement.get_data()))
 
         if save:
-            return self._measurement.save()
+            return self._measurement.save() if writer is None else writer.save_measurement(self._measurement)
         else:
             return None
 
-    def _signal(self, f):
-        sig = 1
-        f_real = f - self._measurement.get_bandwidth()/2 + random.random()*self._measurement.get_bandwidth()
-        for q_c, q_i0, d_i, phi, f_r in self._lorentz_params:
+    def measure_segmented(self, measurements, save=True, writer=None):
+        """
+        Measure several Measurement objects with separate frequency windows in a single simulated sweep, see
+        VNA.measure_segmented()
+        :param measurements: list of Measurement objects with equal bandwidth, power and averages
+        :param save: if false, the data won't be saved
+        :param writer: AsyncWriter saving the data in the background, None to save before returning
+        :return: list of the paths of the saved measurement data, without suffix (Futures of them if a writer is used) -
+                 or of None, if the data wasn't saved
+        """
+        merged = merge_measurements(measurements)
+        self.set_measurement(merged)
+        self.measure(save=False)
+        split_data(merged, measurements)
+        if not save:
+            return [None]*len(measurements)
+        return [measurement.save() if writer is None else writer.save_measurement(measurement)
+                for measurement in measurements]
+
+    def rf_on(self):
+        pass
+
+    def rf_off(self):
+        pass
+
+    def get_resonators(self):
+        """
+        Get the parameters of the simulated resonators
+        :return: dictionary of np arrays with the coupling quality factors, the phases and the resonance frequencies
+        """
+        return {'q_c': self._q_c, 'phi': self._phi, 'f_r': self._f_r}
+
+    def simulate(self, frequencies, bandwidth, power):
+        """
+        Simulate a trace, computed at once for all frequencies and resonators
+        :param frequencies: frequencies in Hz
+        :param bandwidth: IF bandwidth in Hz, each frequency is jittered uniformly within it
+        :param power: power in dBm, determines the internal quality factors and the noise level
+        :return: complex-valued np array
+        """
+        frequencies = np.asarray(frequencies, dtype=float)
+        f_real = frequencies - bandwidth/2 + self._rng.random(frequencies.shape)*bandwidth
 
-            q_i = q_i0 + d_i/(1+np.exp(-((self._measurement.get_power()+50)/70*8-4)))
-            q_l = (1/q_i+1/np.real(q_c*np.exp(-1j*phi)))**-1
+        # quality factors only depend on the power, one value per resonator
+        q_i = self._q_i0 + self._d_i/(1+np.exp(-((power+50)/70*8-4)))
+        q_l = (1/q_i+1/np.real(self._q_c*np.exp(-1j*self._phi)))**-1
 
-            sig -= _lorentz(q_l, q_c, phi, f_r, f_real)
+        sig = 1 - _lorentz(q_l, self._q_c, self._phi, self._f_r, f_real[..., np.newaxis]).sum(axis=-1)
 
         # complex signal + noise (maybe step up noise game in the future)
-        noise = (random.random()-0.5)*0.01*(20-self._measurement.get_power())/10
-        # noise = random.random()*0.0
+        noise_amp = 0.01*(20-power)/10
+        noise = (self._rng.random(frequencies.shape)-0.5 + 1j*(self._rng.random(frequencies.shape)-0.5))*noise_amp
         return sig + noise
 
 
 def _lorentz(q_l, q_c, phi, f_r, f):
     # return a*np.exp(alpha*1j)*np.exp(-2*np.pi*1j*f*tau)*(q_l/abs(q_c)*np.exp(phi*1j)/(1+2j*q_l*(f/f_r-1)))
-    return q_l/abs(q_c)*np.exp(1j*phi)/(1 + (2j*q_l*(f/f_r-1)))
+    return q_l/np.abs(q_c)*np.exp(1j*phi)/(1 + (2j*q_l*(f/f_r-1)))
 
 
 if __name__ == "__main__":
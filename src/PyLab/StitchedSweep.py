@@ -0,0 +1,175 @@
+import numpy as np
+from pathlib import Path
+import json
+from PyLab.Measurement import Measurement
+import PyLab.PeakFinder as PeakFinder
+
+
+"""
+spectra wider than a single sweep of the instrument: the band is split into chunks of a common frequency grid, which are
+measured back-to-back and joined at their overlaps. The chunks are written to disk as they arrive, so the whole spectrum
+never has to be held in memory.
+"""
+
+
+class StitchedSweep:
+
+    def __init__(self, vna, operator, chip, f_start, f_stop, nop, bandwidth, power, averages=1, chunk_points=20001,
+                 overlap=200):
+        """
+        Define a stitched spectrum
+
+        :param vna: VNA frontend object (or SimVNA)
+        :param operator: name of the operator
+        :param chip: name of the chip
+        :param f_start: start frequency in Hz
+        :param f_stop: stop frequency in Hz
+        :param nop: total number of points of the spectrum
+        :param bandwidth: IF bandwidth in Hz
+        :param power: power of the VNA in dBm
+        :param averages: number of averages
+        :param chunk_points: number of points of a single sweep, at most the point limit of the instrument
+        :param overlap: number of points measured by two neighbouring chunks, used to join them
+        """
+        if chunk_points <= overlap:
+            raise ValueError("a chunk must have more points than the overlap")
+        self._vna = vna
+        self.operator = operator
+        self.chip = chip
+        self.f_start = float(f_start)
+        self.f_stop = float(f_stop)
+        self.nop = int(nop)
+        self.bandwidth = bandwidth
+        self.power = power
+        self.averages = averages
+        self.chunk_points = int(chunk_points)
+        self.overlap = int(overlap)
+
+    def get_frequencies(self, start=0, stop=None):
+        """
+        Get (a part of) the frequency grid of the spectrum
+
+        :param start: index of the first point
+        :param stop: index after the last point, None for the end of the spectrum
+        :return: 1D array of frequencies in Hz
+        """
+        stop = self.nop if stop is None else stop
+        return self.f_start + np.arange(start, stop)*(self.f_stop - self.f_start)/(self.nop - 1)
+
+    def get_chunks(self):
+        """
+        Split the spectrum into sweeps
+
+        :return: list of (first index, index after the last point) tuples of the chunks
+        """
+        step = self.chunk_points - self.overlap
+        chunks = []
+        start = 0
+        while True:
+            stop = min(start + self.chunk_points, self.nop)
+            chunks.append((start, stop))
+            if stop == self.nop:
+                return chunks
+            start += step
+
+    def acquire(self, path):
+        """
+        Measure the chunks one after the other. Each chunk is scaled to join the previous one, which removes steps of
+        gain and phase between the sweeps (e.g. from band switching or drifts). In the overlap the mean of both chunks
+        is kept. The output of the VNA must be switched on by the caller.
+
+        :param path: path of the spectrum without suffix, the data goes to path.npy (complex, loadable with
+                     np.load(..., mmap_mode="r")) and the settings to path.json
+        :return: generator of (chunk number, first index, frequencies, data) tuples of the joined chunks
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        chunks = self.get_chunks()
+        self._write_info(path, chunks_done=0)
+        data = np.lib.format.open_memmap(f"{path}.npy", mode="w+", dtype=np.complex128, shape=(self.nop,))
+
+        previous_tail = None
+        for i, (start, stop) in enumerate(chunks):
+            frequencies = self.get_frequencies(start, stop)
+            measurement = Measurement(self.operator, self.chip, self.bandwidth, self.power,
+                                      np.linspace(frequencies[0], frequencies[-1], len(frequencies)), self.averages)
+            self._vna.set_measurement(measurement)
+            self._vna.measure(save=False)
+            chunk = np.asarray(measurement.get_data(), dtype=np.complex128)
+
+            if previous_tail is not None and self.overlap > 0:
+                ratio = chunk[:self.overlap]/previous_tail
+                # the median is robust against a resonance within the overlap
+                chunk = chunk/(np.median(ratio.real) + 1j*np.median(ratio.imag))
+                chunk[:self.overlap] = (chunk[:self.overlap] + previous_tail)/2
+            previous_tail = chunk[len(chunk) - self.overlap:].copy()
+
+            data[start:stop] = chunk
+            data.flush()
+            self._write_info(path, chunks_done=i + 1)
+            yield i, start, frequencies, chunk
+        del data
+
+    def run(self, path, q_l=1e5, **kwargs):
+        """
+        Measure the spectrum and search resonances chunk by chunk while it is measured, see PeakFinder.get_peaks()
+
+        :param path: path of the spectrum without suffix, see acquire()
+        :param q_l: expected loaded quality factor, sets the scale of the peak search
+        :param kwargs: further parameters of PeakFinder.get_peaks()
+        :return: dictionary of np arrays of the peaks of the whole spectrum, see PeakFinder.get_peaks(), the index refers
+                 to the whole spectrum
+        """
+        chunks = self.get_chunks()
+        spacing = (self.f_stop - self.f_start)/(self.nop - 1)
+        found = []
+        last_fr = -np.inf
+        for i, start, frequencies, chunk in self.acquire(path):
+            peaks = PeakFinder.get_peaks(frequencies, chunk, None, q_l, **kwargs)
+            # each chunk owns the points up to the middle of its overlaps, so no peak is counted twice
+            own_start = start + self.overlap//2 if i > 0 else 0
+            own_stop = chunks[i][1] - self.overlap//2 if i < len(chunks) - 1 else self.nop
+            peaks["index"] = peaks["index"] + start
+            own = (peaks["index"] >= own_start) & (peaks["index"] < own_stop)
+            # a peak at the border may still appear in both chunks at slightly different positions
+            own &= peaks["fr"] - last_fr > kwargs.get("min_distance", 5)*frequencies[-1]/q_l
+            found.append({key: value[own] for key, value in peaks.items()})
+            if np.any(own):
+                last_fr = peaks["fr"][own][-1]
+            print(f"chunk {i + 1}/{len(chunks)}: {np.sum(own)} peaks up to {frequencies[-1]/1e9:.3f} GHz")
+
+        peaks = {key: np.concatenate([chunk_peaks[key] for chunk_peaks in found]) for key in found[0]}
+        info = self._read_info(path)
+        info["peaks"] = {key: value.tolist() for key, value in peaks.items() if key != "index"}
+        with open(f"{path}.json", "w") as handle:
+            json.dump(info, handle, indent=1)
+        if spacing > self.f_start/q_l:
+            print(f"The point spacing {spacing:.0f} Hz is above the linewidth, Ql of the peaks is only a lower bound.")
+        return peaks
+
+    @staticmethod
+    def load(path):
+        """
+        Load a stitched spectrum without reading the data into memory
+
+        :param path: path of the spectrum without suffix
+        :return: the frequencies, the data as read-only memory map and the settings dictionary
+        """
+        with open(f"{path}.json") as handle:
+            info = json.load(handle)
+        frequencies = np.linspace(info["f_start"], info["f_stop"], info["nop"])
+        return frequencies, np.load(f"{path}.npy", mmap_mode="r"), info
+
+    # Utility methods
+
+    def _write_info(self, path, chunks_done):
+        info = {"operator": self.operator, "chip": self.chip, "f_start": self.f_start, "f_stop": self.f_stop,
+                "nop": self.nop, "bandwidth": self.bandwidth, "power": self.power, "averages": self.averages,
+                "chunk_points": self.chunk_points, "overlap": self.overlap, "chunks": len(self.get_chunks()),
+                "chunks_done": chunks_done}
+        with open(f"{path}.json", "w") as handle:
+            json.dump(info, handle, indent=1)
+
+    @staticmethod
+    def _read_info(path):
+        with open(f"{path}.json") as handle:
+            return json.load(handle)
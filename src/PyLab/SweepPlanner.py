@@ -0,0 +1,232 @@
+import numpy as np
+from pathlib import Path
+import json
+import time
+from PyLab.Measurement import Measurement
+
+
+"""
+offline planning of power sweeps: a calibrated model of the sweep time of an instrument and a search for the cheapest
+(nop, bandwidth, averages) combination reaching a target signal-to-noise ratio at each power
+"""
+
+
+class SweepTimeModel:
+
+    def __init__(self, bandwidth_factor=1., point_time=20e-6, sweep_overhead=10e-3, setup_time=0.3):
+        """
+        Model of the time of a measurement: averages * (nop * (bandwidth_factor/bandwidth + point_time)
+        + sweep_overhead) + setup_time. The defaults are rough typical values, use calibrate() for a real instrument.
+
+        :param bandwidth_factor: measurement time of a point in units of 1/bandwidth
+        :param point_time: additional time per point in s (settling, frequency switching)
+        :param sweep_overhead: additional time per sweep in s (retrace, band switching)
+        :param setup_time: additional time per measurement in s (setting up, triggering, data transfer)
+        """
+        self.bandwidth_factor = bandwidth_factor
+        self.point_time = point_time
+        self.sweep_overhead = sweep_overhead
+        self.setup_time = setup_time
+
+    def get_sweep_time(self, nop, bandwidth):
+        """
+        Predict the time of a single sweep, works elementwise on arrays
+
+        :param nop: number of points
+        :param bandwidth: IF bandwidth in Hz
+        :return: sweep time in s
+        """
+        return nop*(self.bandwidth_factor/np.asarray(bandwidth, dtype=float) + self.point_time) + self.sweep_overhead
+
+    def get_measurement_time(self, nop, bandwidth, averages=1):
+        """
+        Predict the time of a measurement with sweep averaging, works elementwise on arrays
+
+        :param nop: number of points
+        :param bandwidth: IF bandwidth in Hz
+        :param averages: number of averages
+        :return: measurement time in s
+        """
+        return averages*self.get_sweep_time(nop, bandwidth) + self.setup_time
+
+    @classmethod
+    def calibrate(cls, vna, nops=(101, 1001, 10001), bandwidths=(10, 100, 1000, 10000), f_center=5e9, span=1e6):
+        """
+        Calibrate the model from the sweep times reported by the instrument for a grid of settings, the setup time is
+        measured with a short measurement. The output stays off.
+
+        :param vna: VNA frontend object
+        :param nops: numbers of points of the grid
+        :param bandwidths: IF bandwidths of the grid in Hz
+        :param f_center: center frequency of the calibration sweeps in Hz
+        :param span: span of the calibration sweeps in Hz
+        :return: the SweepTimeModel
+        """
+        rows = []
+        times = []
+        for nop in nops:
+            for bandwidth in bandwidths:
+                vna.set_measurement(Measurement("calibration", "none", bandwidth, -30,
+                                                np.linspace(f_center - span/2, f_center + span/2, nop)))
+                rows.append([nop/bandwidth, nop, 1.])
+                times.append(float(vna.query_command(":SENS1:SWE:TIME?")))
+        bandwidth_factor, point_time, sweep_overhead = np.linalg.lstsq(np.array(rows), np.array(times), rcond=None)[0]
+        model = cls(bandwidth_factor, point_time, sweep_overhead)
+
+        # the setup time is whatever a short measurement takes beyond its sweep
+        nop, bandwidth = min(nops), max(bandwidths)
+        vna.set_measurement(Measurement("calibration", "none", bandwidth, -30,
+                                        np.linspace(f_center - span/2, f_center + span/2, nop)))
+        start = time.perf_counter()
+        vna.measure(save=False)
+        model.setup_time = max(time.perf_counter() - start - model.get_sweep_time(nop, bandwidth), 0.)
+        return model
+
+    def to_dict(self):
+        return {"bandwidth_factor": float(self.bandwidth_factor), "point_time": float(self.point_time),
+                "sweep_overhead": float(self.sweep_overhead), "setup_time": float(self.setup_time)}
+
+    def save(self, path):
+        """
+        Save the model to a JSON file
+
+        :param path: path of the file
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as handle:
+            json.dump(self.to_dict(), handle, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a model from a JSON file
+
+        :param path: path of the file
+        :return: the SweepTimeModel
+        """
+        with open(path) as handle:
+            return cls(**json.load(handle))
+
+
+class SweepPlanner:
+
+    def __init__(self, model: SweepTimeModel, noise_floor=-170., fr=5e9, Ql=1e5, span=3e5,
+                 nops=(101, 151, 201, 301, 401, 501, 801, 1001),
+                 bandwidths=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000),
+                 max_averages=100, min_points_per_linewidth=5):
+        """
+        Set up the search space of the planner
+
+        :param model: sweep time model of the instrument
+        :param noise_floor: noise power density of the measurement chain in dBm/Hz, referred to the chip (e.g. from a
+                            measured trace: power - 20*log10(snr) - 10*log10(bandwidth/averages))
+        :param fr: resonance frequency in Hz
+        :param Ql: expected loaded quality factor
+        :param span: frequency span around the resonance in Hz
+        :param nops: candidate numbers of points
+        :param bandwidths: available IF bandwidths in Hz
+        :param max_averages: maximum number of averages
+        :param min_points_per_linewidth: minimum number of points within the linewidth fr/Ql, needed for the fit
+        """
+        self.model = model
+        self.noise_floor = noise_floor
+        self.fr = fr
+        self.Ql = Ql
+        self.span = span
+        self.nops = np.asarray(nops)
+        self.bandwidths = np.asarray(bandwidths, dtype=float)
+        self.max_averages = max_averages
+        self.min_points_per_linewidth = min_points_per_linewidth
+
+    def get_snr(self, power, nop, bandwidth, averages=1):
+        """
+        Estimate the signal-to-noise ratio of the resonance: the amplitude SNR of a point, times the square root of the
+        number of points within the linewidth. Works elementwise on arrays.
+
+        :param power: power at the chip in dBm
+        :param nop: number of points
+        :param bandwidth: IF bandwidth in Hz
+        :param averages: number of averages
+        :return: the SNR (amplitude ratio)
+        """
+        point_snr = 10**((power - self.noise_floor)/20)*np.sqrt(averages/np.asarray(bandwidth, dtype=float))
+        return point_snr*np.sqrt(self._points_per_linewidth(nop))
+
+    @staticmethod
+    def snr_for_qi_error(qi_rel_err, Ql_over_Qc=0.5):
+        """
+        Rough SNR needed for a relative error of Qi. The error of Qi is dominated by the depth of the resonance,
+        whose error is about 1/SNR, so dQi/Qi ~ 1/(SNR*(1 - Ql/Qc)).
+
+        :param qi_rel_err: target relative error of Qi
+        :param Ql_over_Qc: expected ratio of loaded and coupling quality factor (depth of the resonance)
+        :return: the target SNR
+        """
+        return 1/(qi_rel_err*(1 - Ql_over_Qc))
+
+    def plan_step(self, power, target_snr):
+        """
+        Find the fastest setting reaching the target SNR at a power
+
+        :param power: power at the chip in dBm
+        :param target_snr: target SNR, see get_snr()
+        :return: (nop, bandwidth, averages, predicted time in s), the setting with the highest SNR if the target is out
+                 of reach
+        """
+        nop = self.nops[self._points_per_linewidth(self.nops) >= self.min_points_per_linewidth]
+        if len(nop) == 0:
+            nop = self.nops[-1:]
+        averages = np.arange(1, self.max_averages + 1)
+        nop, bandwidth, averages = np.meshgrid(nop, self.bandwidths, averages, indexing="ij")
+
+        snr = self.get_snr(power, nop, bandwidth, averages)
+        duration = self.model.get_measurement_time(nop, bandwidth, averages)
+        feasible = snr >= target_snr
+        if np.any(feasible):
+            best = np.unravel_index(np.argmin(np.where(feasible, duration, np.inf)), duration.shape)
+        else:
+            best = np.unravel_index(np.argmax(snr), snr.shape)
+        return int(nop[best]), float(bandwidth[best]), int(averages[best]), float(duration[best])
+
+    def plan(self, powers, target_snr):
+        """
+        Plan a power sweep
+
+        :param powers: powers at the chip in dBm
+        :param target_snr: target SNR, a single value or one per power
+        :return: list of (power, bandwidth, averages, nop) steps, see SweepPlan
+        """
+        targets = np.broadcast_to(target_snr, np.shape(powers))
+        steps = []
+        for power, target in zip(powers, targets):
+            nop, bandwidth, averages, duration = self.plan_step(power, target)
+            if self.get_snr(power, nop, bandwidth, averages) < target:
+                print(f"Target SNR {target:.0f} out of reach at {power} dBm, using the highest possible SNR.")
+            steps.append((power, bandwidth, averages, nop))
+        return steps
+
+    # Utility methods
+
+    def _points_per_linewidth(self, nop):
+        return np.asarray(nop)*self.fr/self.Ql/self.span
+
+
+def estimate_time(plan, model: SweepTimeModel):
+    """
+    Predict the duration of a sweep plan without contacting the instrument
+
+    :param plan: SweepPlan, or a SweepRunner (only its remaining steps count, a segmented runner measures all resonators
+                 of a step in one sweep)
+    :param model: sweep time model of the instrument
+    :return: the duration in s
+    """
+    steps = plan.remaining() if hasattr(plan, "remaining") else plan
+    groups = {}
+    for i, step in enumerate(steps):
+        groups.setdefault(step["step"] if getattr(plan, "segmented", False) else i, []).append(step)
+
+    duration = 0.
+    for group in groups.values():
+        nop = sum(step["nop"] for step in group)
+        duration += float(model.get_measurement_time(nop, group[0]["bandwidth"], group[0]["averages"]))
+    return duration
@@ -0,0 +1,266 @@
+from concurrent.futures import Future
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+from PyLab.Measurement import Measurement
+
+
+"""
+declarative sweep plans (resonators x power/bandwidth/averages) and a runner measuring them step by step. Every finished
+measurement is recorded in a journal, so an interrupted sweep is resumed where it stopped.
+"""
+
+
+class SweepPlan:
+
+    def __init__(self, operator, chip, resonators, steps, span=3e5, nop=301, attenuation=0, line="",
+                 folder="{chip}/Res{resonator}"):
+        """
+        Define a sweep. The steps are measured in the given order, each step for all resonators.
+
+        :param operator: name of the operator
+        :param chip: name of the chip (may contain sub folders)
+        :param resonators: dictionary of resonator names (e.g. numbers) and their resonance frequencies in Hz
+        :param steps: list of (power, bandwidth, averages) tuples, the power at the chip in dBm. An optional fourth
+                      entry overrides the number of points of the step.
+        :param span: frequency span around the resonance frequency in Hz
+        :param nop: number of points
+        :param attenuation: complete attenuation of the input line in dB (negative), the VNA power is power - attenuation
+        :param line: name of the line configuration, see Measurement
+        :param folder: folder of the measurements below the operator, formatted with chip and resonator
+        """
+        self.operator = operator
+        self.chip = chip
+        self.resonators = {name: float(frequency) for name, frequency in resonators.items()}
+        self.steps = [tuple(step) for step in steps]
+        self.span = span
+        self.nop = nop
+        self.attenuation = attenuation
+        self.line = line
+        self.folder = folder
+
+    def __iter__(self):
+        """
+        Iterate over the single measurements of the plan
+
+        :return: generator of step dictionaries
+        """
+        for i, step in enumerate(self.steps):
+            power, bandwidth, averages = step[:3]
+            nop = step[3] if len(step) > 3 else self.nop
+            for resonator, frequency in self.resonators.items():
+                yield {"step": i, "resonator": resonator, "frequency": frequency, "power": power,
+                       "vna_power": power - self.attenuation, "bandwidth": bandwidth, "averages": averages,
+                       "nop": nop, "span": self.span}
+
+    def __len__(self):
+        return len(self.steps)*len(self.resonators)
+
+    def get_measurement(self, step):
+        """
+        Create the Measurement object of a step
+
+        :param step: step dictionary
+        :return: the Measurement object
+        """
+        frequencies = np.linspace(step["frequency"] - step["span"]/2, step["frequency"] + step["span"]/2, step["nop"])
+        return Measurement(self.operator, self.folder.format(chip=self.chip, resonator=step["resonator"]),
+                           step["bandwidth"], step["vna_power"], frequencies, step["averages"], line=self.line)
+
+    def to_dict(self):
+        """
+        Get the plan as a JSON compatible dictionary
+
+        :return: dictionary of the plan
+        """
+        return {"operator": self.operator, "chip": self.chip, "resonators": list(self.resonators.items()),
+                "steps": self.steps, "span": self.span, "nop": self.nop, "attenuation": self.attenuation,
+                "line": self.line, "folder": self.folder}
+
+    def save(self, path):
+        """
+        Save the plan to a JSON file
+
+        :param path: path of the file
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as handle:
+            # steps of a plan built with numpy (e.g. np.arange powers) contain numpy scalars
+            json.dump(self.to_dict(), handle, indent=1, default=lambda value: value.item())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a plan from a JSON file
+
+        :param path: path of the file
+        :return: the SweepPlan object
+        """
+        with open(path) as handle:
+            plan = json.load(handle)
+        plan["resonators"] = dict((name, frequency) for name, frequency in plan["resonators"])
+        return cls(**plan)
+
+
+class SweepRunner:
+
+    def __init__(self, vna, plan: SweepPlan, journal=None, base_path=r"D:\Measurements\Resonators", save=True,
+                 segmented=False, store=None, writer=None):
+        """
+        Prepare a sweep
+
+        :param vna: VNA frontend object (or SimVNA)
+        :param plan: the SweepPlan
+        :param journal: path of the progress journal, by default sweep_journal.jsonl in the chip folder
+        :param base_path: base path of the measurement data, see Measurement.save()
+        :param save: if false, the measurements are not saved
+        :param segmented: if true, all resonators of a step are measured in a single segmented sweep (see
+                          VNA.measure_segmented), the windows around the resonance frequencies must not overlap
+        :param store: CampaignStore receiving the measurements instead of single files, the path of a measurement is then
+                      its record number in the store
+        :param writer: AsyncWriter saving the measurements in the background. The path of a measurement is then a Future
+                       of it, and the measurement is recorded in the journal once it is written.
+        """
+        self._vna = vna
+        self._plan = plan
+        self._base_path = base_path
+        self._save = save
+        self.segmented = segmented
+        self._store = store
+        self._writer = writer
+        # records of background writes come from the writer threads
+        self._journal_lock = threading.Lock()
+        if journal is None:
+            journal = f"{base_path}/{plan.operator}/{plan.chip}/sweep_journal.jsonl"
+        self._journal = Path(journal)
+
+    def completed(self):
+        """
+        Get the journal records of the finished measurements
+
+        :return: list of dictionaries (step dictionary with path and time of the measurement)
+        """
+        records = []
+        if not self._journal.exists():
+            return records
+        with open(self._journal) as handle:
+            for line in handle:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a line cut off by a crash, its measurement is repeated
+                    logging.warning(f"Skipping incomplete journal line in {self._journal}.")
+        return records
+
+    def remaining(self):
+        """
+        Get the steps of the plan that are not finished yet. A journal record only counts for a step if the step was
+        not changed in the plan since.
+
+        :return: list of step dictionaries
+        """
+        done = {(record["step"], str(record["resonator"])): record for record in self.completed()}
+        remaining = []
+        for step in self._plan:
+            record = done.get((step["step"], str(step["resonator"])))
+            if record is None or any(record.get(key) != step[key] for key in ["frequency", "power", "vna_power",
+                                                                              "bandwidth", "averages", "nop", "span"]):
+                remaining.append(step)
+        return remaining
+
+    def run(self):
+        """
+        Measure the remaining steps of the plan. The output is switched on for each measurement only. Each finished
+        measurement is recorded in the journal before it is handed out, so that downstream processing (e.g. a
+        FitPipeline) can work while the next measurement runs. With a writer, it is recorded once it is written, the
+        writer must be closed (or flushed) before the journal is complete.
+
+        :return: generator of (step dictionary, Measurement object, path of the saved data or record number - or a
+                 Future of it with a writer) tuples
+        """
+        remaining = self.remaining()
+        n_done = len(self._plan) - len(remaining)
+        if n_done > 0:
+            print(f"Resuming sweep: {n_done} of {len(self._plan)} measurements already done.")
+
+        try:
+            for group in self._groups(remaining):
+                measurements = [self._plan.get_measurement(step) for step in group]
+                resonators = ", ".join(f"res{step['resonator']}" for step in group)
+                print(f"Measuring {resonators} at {group[0]['power']} dBm ({n_done + 1}/{len(self._plan)}) "
+                      f"from {datetime.today().strftime('%H:%M:%S')}...")
+                try:
+                    self._vna.rf_on()
+                    if self.segmented:
+                        self._vna.measure_segmented(measurements, save=False)
+                    else:
+                        self._vna.set_measurement(measurements[0])
+                        self._vna.measure(save=False)
+                finally:
+                    self._vna.rf_off()
+
+                for step, measurement in zip(group, measurements):
+                    path = self._save_measurement(step, measurement) if self._save else None
+                    if isinstance(path, Future):
+                        path.add_done_callback(lambda future, step=step: self._record_written(step, future))
+                    else:
+                        self._record(step, path)
+                    n_done += 1
+                    yield step, measurement, path
+        finally:
+            self._vna.rf_off()
+
+    # Utility methods
+
+    def _groups(self, steps):
+        """
+        Group the steps measured in one sweep: all remaining resonators of a step if segmented, otherwise single steps
+        """
+        if not self.segmented:
+            return [[step] for step in steps]
+        groups = {}
+        for step in steps:
+            groups.setdefault(step["step"], []).append(step)
+        return list(groups.values())
+
+    def _save_measurement(self, step, measurement):
+        if self._store is not None:
+            if self._writer is not None:
+                return self._writer.submit(self._store.append, measurement, resonator=step["resonator"],
+                                           step=step["step"], chip_power=step["power"])
+            return self._store.append(measurement, resonator=step["resonator"], step=step["step"],
+                                      chip_power=step["power"])
+        if self._writer is not None:
+            return self._writer.save_measurement(measurement, self._base_path)
+        return measurement.save(self._base_path)
+
+    def _record_written(self, step, future):
+        """
+        Record a measurement saved in the background, a failed write is not recorded and measured again on resume
+        """
+        if not future.cancelled() and future.exception() is None:
+            self._record(step, future.result())
+
+    def _record(self, step, path):
+        """
+        Append a finished measurement to the journal, flushed to disk before the sweep goes on
+        """
+        self._journal.parent.mkdir(parents=True, exist_ok=True)
+        record = dict(step, path=path, time=datetime.now().isoformat(timespec="seconds"))
+        # steps of a plan built with numpy (e.g. np.arange powers) contain numpy scalars
+        line = json.dumps(record, default=lambda value: value.item()) + "\n"
+        with self._journal_lock:
+            # a line cut off by a crash must not swallow the new record
+            if self._journal.exists() and self._journal.stat().st_size > 0:
+                with open(self._journal, "rb") as handle:
+                    handle.seek(-1, os.SEEK_END)
+                    if handle.read(1) != b"\n":
+                        line = "\n" + line
+            with open(self._journal, "a") as handle:
+                handle.write(line)
+                handle.flush()
+                os.fsync(handle.fileno())
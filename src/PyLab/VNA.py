@@ -1,6 +1,11 @@
 from PyLab.Measurement import *
-# from Results.NB.PyLab.PNA import PNA
-from PyLab.RSZVA24old import RSVNA as PNA
+import numpy as np
+from PyLab.PNA import PNA
+from PyLab.RSZVA24 import RSVNA
+from PyLab.SCPITools import get_segments
+import PyLab.ResonatorTools as ResTools
+from PyLab.CircleFit import notch_port
+import logging
 
 class VNA:
     '''
@@ -10,41 +15,111 @@ class VNA:
     def __init__(self, name='ZVA24', address='TCPIP0::ZVA24-100169::inst0::INSTR'):
         """
         Initialize an object of the VNA class
-        :param name: name of the VNA
+        :param name: name of the VNA, selects the driver: PNA for a Keysight PNA (PyLab.PNA), any other name (e.g. ZVA24) for a
+                     R&S ZVA (PyLab.RSZVA24, which replaces RSZVA24old). Must match the instrument at the address.
         :param address: TCP/IP address of the instrument (can be found via NI MAX -> VISA resource name)
         """
         self._measurement = None
-        self.pna = PNA(address)
+        if name.upper() == 'PNA':
+            self.pna = PNA(address)
+        else:
+            self.pna = RSVNA(name, address)
         # self.pna.pre_sweep()
 
     def set_measurement(self, measurement: Measurement):
         """
-        Sets the Measurement object for the VNA. The parameters will be directly set up in the VNA
+        Sets the Measurement object for the VNA. The parameters will be directly set up in the VNA, settings that did not
+        change since the last measurement are not sent again
         :param measurement: a Measurement object containing all the information for a measurement
         """
         self._measurement = measurement
 
-        self.pna.set_power(self._measurement.get_power())
-        self.pna.set_bandwidth(self._measurement.get_bandwidth())
-        frequencies = self._measurement.get_frequencies()
-        self.pna.set_frequencies(frequencies[0], frequencies[-1], len(frequencies))
-        self.pna.set_averages(self._measurement.get_averages())
+        # all settings are sent in one batch
+        with self.pna.batch():
+            self.pna.set_power(self._measurement.get_power())
+            self.pna.set_bandwidth(self._measurement.get_bandwidth())
+            frequencies = self._measurement.get_frequencies()
+            segments = get_segments(frequencies)
+            if len(segments) == 1:
+                self.pna.set_frequencies(frequencies[0], frequencies[-1], len(frequencies))
+            else:
+                # non-uniform frequencies are measured as a segmented sweep
+                self.pna.set_segments(segments)
+            self.pna.set_averages(self._measurement.get_averages())
 
-    def measure(self, save=True):
+    def measure(self, save=True, writer=None):
         """
         Start a VNA measurement with the parameters of the Measurement object
         :param save: if false, the data won't be saved
-        :return: the path of the saved measurement data, without suffix - or None, if the data wasn't saved
+        :param writer: AsyncWriter saving the data in the background, None to save before returning
+        :return: the path of the saved measurement data, without suffix (a Future of it if a writer is used) - or None,
+                 if the data wasn't saved
         """
         if self._measurement is None:
             raise TypeError("Measurement has not been set yet!")
-        self.pna.measure()
-        self._measurement.set_data(self.pna.get_data())
+        self._measurement.set_data(self.pna.measure()['S-parameter'])
         if save:
-            return self._measurement.save()
+            return self._measurement.save() if writer is None else writer.save_measurement(self._measurement)
         else:
             return None
 
+    def measure_adaptive(self, measurement: Measurement, coarse_nop=101, core_linewidths=2, core_fraction=0.8,
+                         save=True):
+        """
+        Measure a resonance with the points concentrated around it. A coarse uniform sweep over the frequencies of the
+        Measurement object locates the resonance, then its points are redistributed with
+        ResonatorTools.get_linspace_adaptive and measured as a segmented sweep.
+        :param measurement: a Measurement object, its span and number of points are kept, its frequencies are replaced
+        :param coarse_nop: number of points of the coarse sweep
+        :param core_linewidths: half width of the dense core in linewidths
+        :param core_fraction: fraction of the points in the core
+        :param save: if false, the data won't be saved
+        :return: the path of the saved measurement data, without suffix - or None, if the data wasn't saved
+        """
+        frequencies = np.asarray(measurement.get_frequencies())
+        span = frequencies[-1] - frequencies[0]
+        coarse = Measurement(measurement.get_operator(), measurement.get_chip(), measurement.get_bandwidth(),
+                             measurement.get_power(), np.linspace(frequencies[0], frequencies[-1], coarse_nop),
+                             line=measurement.get_line())
+        self.set_measurement(coarse)
+        self.measure(save=False)
+
+        try:
+            fit = notch_port(coarse.get_frequencies(), coarse.get_data())
+            fit.autofit(calc_errors=False)
+            fr, Ql = fit.fitresults["fr"], fit.fitresults["Ql"]
+            if not (frequencies[0] < fr < frequencies[-1] and 0 < Ql < np.inf):
+                raise ValueError(f"resonance at {fr} Hz with Ql={Ql} is not plausible")
+        except Exception as error:
+            logging.warning(f"Coarse fit failed ({error}), measuring the uniform grid.")
+        else:
+            measurement.set_frequencies(ResTools.get_linspace_adaptive(fr, Ql, span, len(frequencies),
+                                                                      core_linewidths, core_fraction))
+
+        self.set_measurement(measurement)
+        return self.measure(save)
+
+    def measure_segmented(self, measurements, save=True, writer=None):
+        """
+        Measure several Measurement objects with separate frequency windows, e.g. around all resonances of a chip, in a
+        single segmented sweep. The settings are sent and the sweep is triggered once for all windows, the data is split
+        back into the Measurement objects.
+        :param measurements: list of Measurement objects with equal bandwidth, power and averages, see
+                             merge_measurements()
+        :param save: if false, the data won't be saved
+        :param writer: AsyncWriter saving the data in the background, None to save before returning
+        :return: list of the paths of the saved measurement data, without suffix (Futures of them if a writer is used) -
+                 or of None, if the data wasn't saved
+        """
+        merged = merge_measurements(measurements)
+        self.set_measurement(merged)
+        self.measure(save=False)
+        split_data(merged, measurements)
+        if not save:
+            return [None]*len(measurements)
+        return [measurement.save() if writer is None else writer.save_measurement(measurement)
+                for measurement in measurements]
+
     def get_measurement_time(self):
         return self.pna.get_sweep_time()
 
@@ -63,6 +138,28 @@ class VNA:
 
     def run_command(self, command):
         self.pna.write(command)
+        # the command may have changed any setting
+        self.pna.invalidate()
+
+    def invalidate(self):
+        """
+        Forget the known instrument settings, e.g. after changing them at the instrument. All settings are sent again
+        with the next measurement.
+        """
+        self.pna.invalidate()
+
+    def resync(self):
+        """
+        Read the instrument settings back from the VNA
+        """
+        self.pna.resync()
+
+    def get_skipped_commands(self):
+        """
+        Get the number of setting commands that were not sent because the setting did not change
+        :return: the number of skipped commands
+        """
+        return self.pna.state.skipped
 
     def query_command(self, command):
         return self.pna.query(command)
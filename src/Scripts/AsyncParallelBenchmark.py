@@ -0,0 +1,59 @@
+import asyncio
+import numpy as np
+import time
+from PyLab.SimSCPIServer import SimSCPIServer
+from PyLab.AsyncVNA import AsyncVNA
+from PyLab.Measurement import Measurement
+from PyLab.CircleFit import notch_port
+
+n_instruments = [1, 2, 3]  # number of simulated VNAs driven from one event loop
+completion = "poll"  # poll or opc
+time_scale = 0.05  # factor on the simulated sweep times
+nop = 2001
+bandwidth = 1000
+repetitions = 3  # measurements per instrument
+
+###################
+#
+# CORE
+#
+###################
+
+
+async def run(servers):
+    vnas = [await AsyncVNA.open(server.address, completion=completion) for server in servers]
+    fits = []
+    try:
+        start = time.perf_counter()
+        for vna, server in zip(vnas, servers):
+            f_r = server.instrument._sim.get_resonators()["f_r"][0]
+            await vna.set_measurement(Measurement("benchmark", "sim", bandwidth, -20,
+                                                  np.linspace(f_r - 5e5, f_r + 5e5, nop)))
+
+        async def sweep(vna):
+            for i in range(repetitions):
+                await vna.measure(save=False)
+                measurement = vna._measurement
+                # the fit runs in a worker thread while the VNA sweeps again
+                fit = notch_port(measurement.get_frequencies(), np.array(measurement.get_data()))
+                fits.append(asyncio.create_task(asyncio.to_thread(fit.autofit, calc_errors=False)))
+
+        await asyncio.gather(*(sweep(vna) for vna in vnas))
+        await asyncio.gather(*fits)
+        return time.perf_counter() - start
+    finally:
+        for vna in vnas:
+            await vna.close()
+
+
+print(f"{'instruments':>11} {'sweep (ms)':>11} {'total (ms)':>11} {'serial (ms)':>12} {'speedup':>8}")
+for n in n_instruments:
+    servers = [SimSCPIServer(port=0, time_scale=time_scale).start() for i in range(n)]
+    try:
+        total = asyncio.run(run(servers))
+        sweep_time = servers[0].instrument.get_sweep_time()
+    finally:
+        for server in servers:
+            server.stop()
+    serial = n*repetitions*sweep_time
+    print(f"{n:>11} {sweep_time*1e3:>11.1f} {total*1e3:>11.1f} {serial*1e3:>12.1f} {serial/total:>8.2f}")
@@ -0,0 +1,97 @@
+from PyLab.CircleFit import notch_port, numba_enable
+import scipy.optimize as spopt
+import numpy as np
+import timeit
+
+point_numbers = [301, 501, 10001]  # trace lengths to benchmark
+repetitions = 500  # number of calls per timing
+noise = 0.01  # amplitude of the complex noise added to the simulated traces
+
+
+def legacy_fit_circle(z_data):
+    """
+    Reference: previous version of circuit._fit_circle (seven separate moment sums, expanded characteristic
+    polynomial, scipy newton and full SVD)
+    """
+    x_norm = 0.5*(np.max(z_data.real) + np.min(z_data.real))
+    y_norm = 0.5*(np.max(z_data.imag) + np.min(z_data.imag))
+    z_data = z_data[:] - (x_norm + 1j*y_norm)
+    amp_norm = np.max(np.abs(z_data))
+    z_data = z_data / amp_norm
+
+    xi = z_data.real
+    xi_sqr = xi*xi
+    yi = z_data.imag
+    yi_sqr = yi*yi
+    zi = xi_sqr+yi_sqr
+    Nd = float(len(xi))
+    xi_sum = xi.sum()
+    yi_sum = yi.sum()
+    zi_sum = zi.sum()
+    xiyi_sum = (xi*yi).sum()
+    xizi_sum = (xi*zi).sum()
+    yizi_sum = (yi*zi).sum()
+    M = np.array([
+        [(zi*zi).sum(), xizi_sum, yizi_sum, zi_sum],
+        [xizi_sum, xi_sqr.sum(), xiyi_sum, xi_sum],
+        [yizi_sum, xiyi_sum, yi_sqr.sum(), yi_sum],
+        [zi_sum, xi_sum, yi_sum, Nd]
+    ])
+
+    a0 = ((M[2][0]*M[3][2]-M[2][2]*M[3][0])*M[1][1]-M[1][2]*M[2][0]*M[3][1]-M[1][0]*M[2][1]*M[3][2]+M[1][0]*M[2][2]*M[3][1]+M[1][2]*M[2][1]*M[3][0])*M[0][3]+(M[0][2]*M[2][3]*M[3][0]-M[0][2]*M[2][0]*M[3][3]+M[0][0]*M[2][2]*M[3][3]-M[0][0]*M[2][3]*M[3][2])*M[1][1]+(M[0][1]*M[1][3]*M[3][0]-M[0][1]*M[1][0]*M[3][3]-M[0][0]*M[1][3]*M[3][1])*M[2][2]+(-M[0][1]*M[1][2]*M[2][3]-M[0][2]*M[1][3]*M[2][1])*M[3][0]+((M[2][3]*M[3][1]-M[2][1]*M[3][3])*M[1][2]+M[2][1]*M[3][2]*M[1][3])*M[0][0]+(M[1][0]*M[2][3]*M[3][2]+M[2][0]*(M[1][2]*M[3][3]-M[1][3]*M[3][2]))*M[0][1]+((M[2][1]*M[3][3]-M[2][3]*M[3][1])*M[1][0]+M[1][3]*M[2][0]*M[3][1])*M[0][2]
+    a1 = (((M[3][0]-2.*M[2][2])*M[1][1]-M[1][0]*M[3][1]+M[2][2]*M[3][0]+2.*M[1][2]*M[2][1]-M[2][0]*M[3][2])*M[0][3]+(2.*M[2][0]*M[3][2]-M[0][0]*M[3][3]-2.*M[2][2]*M[3][0]+2.*M[0][2]*M[2][3])*M[1][1]+(-M[0][0]*M[3][3]+2.*M[0][1]*M[1][3]+2.*M[1][0]*M[3][1])*M[2][2]+(-M[0][1]*M[1][3]+2.*M[1][2]*M[2][1]-M[0][2]*M[2][3])*M[3][0]+(M[1][3]*M[3][1]+M[2][3]*M[3][2])*M[0][0]+(M[1][0]*M[3][3]-2.*M[1][2]*M[2][3])*M[0][1]+(M[2][0]*M[3][3]-2.*M[1][3]*M[2][1])*M[0][2]-2.*M[1][2]*M[2][0]*M[3][1]-2.*M[1][0]*M[2][1]*M[3][2])
+    a2 = ((2.*M[1][1]-M[3][0]+2.*M[2][2])*M[0][3]+(2.*M[3][0]-4.*M[2][2])*M[1][1]-2.*M[2][0]*M[3][2]+2.*M[2][2]*M[3][0]+M[0][0]*M[3][3]+4.*M[1][2]*M[2][1]-2.*M[0][1]*M[1][3]-2.*M[1][0]*M[3][1]-2.*M[0][2]*M[2][3])
+    a3 = (-2.*M[3][0]+4.*M[1][1]+4.*M[2][2]-2.*M[0][3])
+    a4 = -4.
+
+    def char_pol(x):
+        return a0 + a1*x + a2*x**2 + a3*x**3 + a4*x**4
+
+    def d_char_pol(x):
+        return a1 + 2*a2*x + 3*a3*x**2 + 4*a4*x**3
+
+    eta = spopt.newton(char_pol, 0., fprime=d_char_pol)
+
+    M[3][0] = M[3][0] + 2*eta
+    M[0][3] = M[0][3] + 2*eta
+    M[1][1] = M[1][1] - eta
+    M[2][2] = M[2][2] - eta
+
+    U, s, Vt = np.linalg.svd(M)
+    A_vec = Vt[np.argmin(s), :]
+
+    xc = -A_vec[1]/(2.*A_vec[0])
+    yc = -A_vec[2]/(2.*A_vec[0])
+    r0 = 1./(2.*np.absolute(A_vec[0]))*np.sqrt(
+        A_vec[1]*A_vec[1]+A_vec[2]*A_vec[2]-4.*A_vec[0]*A_vec[3]
+    )
+
+    return xc*amp_norm+x_norm, yc*amp_norm+y_norm, r0*amp_norm
+
+
+###################
+#
+# CORE
+#
+###################
+
+rng = np.random.default_rng(12345)
+fr = 5e9
+Ql = 2e4
+
+print(f"compiled moments (numba): {numba_enable}")
+print(f"{'nop':>6} {'legacy (us)':>12} {'new (us)':>10} {'speedup':>8} {'max. deviation':>15}")
+
+for nop in point_numbers:
+    f_data = np.linspace(fr - 5*fr/Ql, fr + 5*fr/Ql, nop)
+    z_data = notch_port.Sij(f_data, fr, Ql, 3e4, 0.2, 0.5, 1., 50e-9)
+    z_data = z_data + noise*(rng.standard_normal(nop) + 1j*rng.standard_normal(nop))
+    fit = notch_port(f_data, z_data)
+
+    # deviation of center and radius, also triggers compilation before timing
+    deviation = np.max(np.abs(np.subtract(legacy_fit_circle(z_data), fit._fit_circle(z_data))))
+
+    t_legacy = timeit.timeit(lambda: legacy_fit_circle(z_data), number=repetitions) / repetitions
+    t_new = timeit.timeit(lambda: fit._fit_circle(z_data), number=repetitions) / repetitions
+
+    print(f"{nop:>6} {t_legacy*1e6:>12.1f} {t_new*1e6:>10.1f} {t_legacy/t_new:>7.1f}x {deviation:>15.2e}")
@@ -0,0 +1,82 @@
+import pyvisa
+import numpy as np
+import time
+from PyLab.VNA import VNA
+from PyLab.Measurement import Measurement
+
+latency = 0.002  # simulated round-trip time of a VISA write or query over the network in s
+repetitions = 20  # number of setups per timing
+powers = np.linspace(-20, -80, 7)  # power sweep, the bandwidth and the frequencies change with each resonator
+
+
+class FakeVNAResource:
+    """
+    Local stand-in for the pyvisa resource of a VNA, every write and query costs the round-trip time. Only the
+    answers needed for setting up a measurement are implemented.
+    """
+
+    def __init__(self):
+        self.timeout = 5000
+        self.round_trips = 0
+
+    def write(self, cmd):
+        time.sleep(latency)
+        self.round_trips += 1
+
+    def query(self, cmd):
+        time.sleep(latency)
+        self.round_trips += 1
+        if cmd.endswith("SYST:ERR?"):
+            return '0,"No error"'
+        if "BWID" in cmd:
+            return "10"
+        return "1"
+
+    def clear(self):
+        pass
+
+
+class FakeResourceManager:
+
+    def open_resource(self, address, timeout=5000):
+        return FakeVNAResource()
+
+
+def setup_unbatched(vna, measurement):
+    """
+    Reference: setup without batching, every setting is written separately
+    """
+    vna.pna.set_power(measurement.get_power())
+    vna.pna.set_bandwidth(measurement.get_bandwidth())
+    frequencies = measurement.get_frequencies()
+    vna.pna.set_frequencies(frequencies[0], frequencies[-1], len(frequencies))
+    vna.pna.set_averages(measurement.get_averages())
+
+
+###################
+#
+# CORE
+#
+###################
+
+pyvisa.ResourceManager = FakeResourceManager
+
+print(f"simulated round-trip time: {latency*1e3:.1f} ms")
+print(f"{'driver':>6} {'mode':>10} {'setup (ms)':>11} {'round trips':>12}")
+
+for name in ["ZVA24", "PNA"]:
+    for mode in ["unbatched", "batched"]:
+        vna = VNA(name=name, address="FAKE::INSTR")
+        resource = vna.pna._visainstrument
+        start = time.perf_counter()
+        for i in range(repetitions):
+            # every setup changes all settings, so the state cache cannot skip any of them
+            vna.pna.invalidate()
+            frequencies = np.linspace(4e9 + i*1e6, 4.01e9 + i*1e6, 1001)
+            measurement = Measurement("benchmark", "none", 10, powers[i % len(powers)], frequencies)
+            if mode == "batched":
+                vna.set_measurement(measurement)
+            else:
+                setup_unbatched(vna, measurement)
+        elapsed = (time.perf_counter() - start) / repetitions
+        print(f"{name:>6} {mode:>10} {elapsed*1e3:>11.2f} {resource.round_trips/repetitions:>12.1f}")
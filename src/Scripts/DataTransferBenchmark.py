@@ -0,0 +1,94 @@
+import pyvisa
+from pyvisa import util
+import numpy as np
+import timeit
+from PyLab.PNA import PNA
+
+point_numbers = [1001, 10001, 40001]  # trace lengths to benchmark
+repetitions = 50  # number of transfers per timing
+link_rate = 100e6  # assumed LAN throughput in bit/s for the estimate of the time on the wire
+
+
+class FakeVNAResource:
+    """
+    Local stand-in for the pyvisa resource of a VNA. It answers CALCulate:DATA? with a fixed trace in the format set by
+    FORMat. The responses are rendered in advance, so only the parsing on the PC side is timed.
+    """
+
+    def __init__(self, nop):
+        rng = np.random.default_rng(12345)
+        trace = rng.standard_normal(2*nop)
+        self.responses = {
+            "ASCII": ",".join(f"{value:+.12E}" for value in trace) + "\n",
+            "REAL,64": util.to_ieee_block(trace, "d", False) + b"\n",
+            "REAL,32": util.to_ieee_block(trace.astype(np.float32), "f", False) + b"\n",
+        }
+        self.data_format = "ASCII"
+        self.timeout = 5000
+
+    def write(self, cmd):
+        for command in cmd.split(";"):
+            if command.lstrip(":").upper().startswith("FORMAT "):
+                argument = command.split(" ", 1)[1].upper()
+                self.data_format = argument if argument in self.responses else "ASCII"
+
+    def query_ascii_values(self, cmd, container=list):
+        return util.from_ascii_block(self.responses["ASCII"].strip(), "f", ",", container)
+
+    def query_binary_values(self, cmd, datatype="f", is_big_endian=False, container=list):
+        if self.data_format not in ("REAL,64", "REAL,32"):
+            raise ValueError("instrument is not in a binary format")
+        return util.from_ieee_block(self.responses[self.data_format][:-1], datatype, is_big_endian, container)
+
+    def clear(self):
+        pass
+
+
+class FakeResourceManager:
+
+    def __init__(self, nop):
+        self._nop = nop
+
+    def open_resource(self, address, timeout=5000):
+        return FakeVNAResource(self._nop)
+
+
+def legacy_get_data(visainstrument):
+    """
+    Reference: previous version of PNA.get_data (ASCII transfer into a list, sliced into real and imaginary part)
+    """
+    data = visainstrument.query_ascii_values("CALCulate:DATA? SDATa")
+    data_size = np.size(data)
+    datareal = np.array(data[0:data_size:2])
+    dataimag = np.array(data[1:data_size:2])
+    return datareal + 1j * dataimag
+
+
+###################
+#
+# CORE
+#
+###################
+
+print(f"time on the wire estimated from the size and an assumed link rate of {link_rate/1e6:.0f} Mbit/s, not measured")
+print(f"{'nop':>6} {'format':>8} {'bytes':>9} {'parse (ms)':>11} {'wire est. (ms)':>15} {'est. speedup':>13}")
+
+for nop in point_numbers:
+    pyvisa.ResourceManager = lambda: FakeResourceManager(nop)
+    pna = PNA("FAKE::INSTR")
+    reference = legacy_get_data(pna._visainstrument)
+
+    t_legacy = timeit.timeit(lambda: legacy_get_data(pna._visainstrument), number=repetitions) / repetitions
+    wire = len(pna._visainstrument.responses["ASCII"])*8/link_rate
+    print(f"{nop:>6} {'legacy':>8} {len(pna._visainstrument.responses['ASCII']):>9} {t_legacy*1e3:>11.2f} "
+          f"{wire*1e3:>15.2f} {1:>12.1f}x")
+
+    for data_format in ["ASCII", "REAL,64", "REAL,32"]:
+        pna.data_format = data_format
+        data = pna.get_data()
+        if np.max(np.abs(data - reference)) > (1e-6 if data_format == "REAL,32" else 1e-10):
+            raise ValueError(f"{data_format} transfer does not reproduce the trace")
+        t = timeit.timeit(pna.get_data, number=repetitions) / repetitions
+        size = len(pna._visainstrument.responses[data_format])
+        print(f"{nop:>6} {data_format:>8} {size:>9} {t*1e3:>11.2f} {size*8/link_rate*1e3:>15.2f} "
+              f"{(t_legacy + wire)/(t + size*8/link_rate):>12.1f}x")
@@ -2,6 +2,7 @@ from PyLab.VNA import VNA
 from PyLab.Measurement import Measurement
 import matplotlib.pyplot as plt
 from PyLab.CircleFit import notch_port
+from PyLab.AsyncWriter import AsyncWriter
 import numpy as np
 import pyvisa
 
@@ -23,7 +24,7 @@ averages = 1  # number of averages, by default 1 (i.e. no averaging)
 # print(pyvisa.ResourceManager().list_resources())
 # vna = VNA(address='TCPIP0::ZVA24-26-100428::inst0::INSTR')  # initiate the connection to the VNA (R&S ZVA24)
 # vna = VNA(address='TCPIP0::10.1.1.15::inst0::INSTR')
-vna = VNA(address='TCPIP0::10.1.1.32::inst0::INSTR')
+vna = VNA(name='PNA', address='TCPIP0::10.1.1.32::inst0::INSTR')
 print(vna.query_command("*IDN?"))
 
 chip = chip + "/peakfinding"
@@ -33,26 +34,29 @@ chip = chip + "/peakfinding"
 
 fine_peaks = []
 
-for peak in rough_peaks:
-    frequencies = np.linspace(peak-span/2, peak+span/2, nop)
-    meas = Measurement(operator, chip, bandwidth, power, frequencies, averages)
-    vna.set_measurement(meas)
-    try:
-        vna.rf_on()
-        print("rf on")
-        path = vna.measure()
-        print("measured")
-    finally:
-        vna.rf_off()
-        print("rf off")
-    
+# windows around all peaks, measured in a single segmented sweep
+measurements = [Measurement(operator, chip, bandwidth, power, np.linspace(peak-span/2, peak+span/2, nop), averages)
+                for peak in rough_peaks]
+try:
+    vna.rf_on()
+    print("rf on")
+    paths = vna.measure_segmented(measurements)
+    print("measured")
+finally:
+    vna.rf_off()
+    print("rf off")
+
+# the plots are saved in the background while the next window is fitted
+writer = AsyncWriter()
+for meas, path in zip(measurements, paths):
     freq = meas.get_frequencies()
     s21 = meas.get_data()
     fit = notch_port(freq, s21)
     fit.autofit()
     f = fit.fitresults["fr"]
     fine_peaks.append(int(f))
-    fit.plotall(path + ".pdf")
+    writer.save_fit(fit, plot_path=path + ".pdf")
     # fit.plotall()
+writer.close()
 
 print(fine_peaks)
\ No newline at end of file
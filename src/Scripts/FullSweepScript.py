@@ -2,9 +2,16 @@ from PyLab.VNA import VNA
 from PyLab.Measurement import Measurement
 import matplotlib.pyplot as plt
 from PyLab.CircleFit import notch_port
+from PyLab.FitPipeline import FitPipeline
+from PyLab.SweepRunner import SweepPlan, SweepRunner
+from PyLab.SweepPlanner import SweepTimeModel, SweepPlanner, estimate_time
+from PyLab.CampaignStore import CampaignStore
+from PyLab.AsyncWriter import AsyncWriter
+from concurrent.futures import Future
 import numpy as np
 import pyvisa
 from datetime import datetime, timedelta
+from pathlib import Path
 
 fine_peaks=[4273681600, 4478587244, 4539002588, 4702513076, 4912747880, 5126582026, 5339187224, 5552221202, 5763688478, 5977714474, 6189044588]
 res_of_interest = [10]
@@ -31,6 +38,17 @@ pow_bw_avg = [(-70, 100, 1), (-75, 100, 1), (-80, 100, 1), (-85, 100, 1), (-90,
 # pow_bw_avg = [(-70, 100, 1)]
 # pow_bw_avg = [(-70, 100, 1), (-80, 100, 1), (-90, 100, 1)]
 # pow_bw_avg = [(-150, 1, 50)]
+fit_processes = 2  # number of processes fitting and plotting in parallel to the measurement
+segmented = True  # measure all resonators of a power step in a single segmented sweep
+fit_catalog = None  # path of a FitCatalog (SQLite file) collecting the fit results, e.g. D:\Measurements\Resonators\fits.sqlite
+campaign_store = False  # keep all traces and fit results in one CampaignStore in the chip folder instead of single files
+# (no .fit files then, set fit_catalog to read the fit results with DataAnalysis.get_fit_data)
+background_writer = True  # save the traces in a background thread, the next sweep starts without waiting for the disk
+
+sweep_time_model = None  # JSON file of a calibrated SweepTimeModel (see SweepTimeModel.calibrate), None: typical VNA
+target_snr = None  # if set, bandwidth, averages and nop of each power step are chosen by the SweepPlanner
+noise_floor = -170  # noise power density of the chain at the chip in dBm/Hz, for the SweepPlanner
+Ql_expected = 1e5  # expected loaded quality factor, for the SweepPlanner
 ###################
 #
 # CORE
@@ -38,58 +56,83 @@ pow_bw_avg = [(-70, 100, 1), (-75, 100, 1), (-80, 100, 1), (-85, 100, 1), (-90,
 ###################
 
 
-# vna = VNA(address='TCPIP0::10.1.1.15::inst0::INSTR')  # old RS VNA
-vna = VNA(address='TCPIP0::10.1.1.32::inst0::INSTR')  # new keithley VNA
-print(vna.query_command("*IDN?"))
-
-chip = f"{chip}{f'/{subfolder}' if subfolder is not None else ''}/detailed_sweep_{attenuation}dBm"
+# workers of the fit pipeline import this script, so everything talking to the VNA is guarded
+if __name__ == "__main__":
+    model = SweepTimeModel() if sweep_time_model is None else SweepTimeModel.load(sweep_time_model)
+    if target_snr is not None:
+        planner = SweepPlanner(model, noise_floor, fine_peaks[res_of_interest[0]-1], Ql_expected, span)
+        pow_bw_avg = planner.plan([step[0] for step in pow_bw_avg], target_snr)
+        print(f"planned steps (power, bandwidth, averages, nop): {pow_bw_avg}")
 
+    chip = f"{chip}{f'/{subfolder}' if subfolder is not None else ''}/detailed_sweep_{attenuation}dBm"
+    plan = SweepPlan(operator, chip, {num_res: fine_peaks[num_res-1] for num_res in res_of_interest}, pow_bw_avg,
+                     span=span, nop=nop, attenuation=attenuation)
 
-# total time estimation
-total_time = 0
-try:
-    for power, bandwidth, averages in pow_bw_avg:
-        vna_power = power - attenuation
+    # vna = VNA(address='TCPIP0::10.1.1.15::inst0::INSTR')  # old RS VNA
+    vna = VNA(name='PNA', address='TCPIP0::10.1.1.32::inst0::INSTR')  # new keithley VNA
+    print(vna.query_command("*IDN?"))
+    # the journal in the chip folder remembers finished measurements, rerunning the script resumes the sweep
+    store = CampaignStore(f"D:\\Measurements\\Resonators\\{operator}\\{chip}\\campaign") if campaign_store else None
+    writer = AsyncWriter() if background_writer else None
+    runner = SweepRunner(vna, plan, segmented=segmented, store=store, writer=writer)
 
-        for num_res in res_of_interest:
-            f = fine_peaks[num_res-1]
-            frequencies = np.linspace(f-span/2, f+span/2, nop)
-            spectrum_measurement = Measurement(operator, chip + f"/Res{num_res}", bandwidth, vna_power, frequencies, averages)
-            vna.set_measurement(spectrum_measurement)
-            total_time += vna.get_measurement_time()*spectrum_measurement.get_averages()
-            # print(f"total time probably in s: {total_time/1000}")
-finally:
-    vna.rf_off()  # not needed, but safe mechanism
-    total_time /= 1000
+    # total time estimation, offline from the sweep time model
+    total_time = estimate_time(runner, model)
     d = datetime.today() + timedelta(seconds=total_time)
-    string = d.strftime('%H:%M:%S')
     print(f"Start time: {datetime.today().strftime('%H:%M:%S, %a %d.%m.')}")
     print(f"Finish time: {d.strftime('%H:%M:%S, %a %d.%m.')}")
 
 
-try:
-    for power, bandwidth, averages in pow_bw_avg:
-        vna_power = power - attenuation
-
-        for num_res in res_of_interest:
-            f = fine_peaks[num_res-1]
-            frequencies = np.linspace(f-span/2, f+span/2, nop)
-            # print(f"Measuring res{num_res} at {power} dB")
-            spectrum_measurement = Measurement(operator, chip + f"/Res{num_res}", bandwidth, vna_power, frequencies, averages)
-            vna.set_measurement(spectrum_measurement)
-            now = datetime.today()
-            meas_time = vna.get_measurement_time()*spectrum_measurement.get_averages()/1000
-            print(f"Measuring resonance res{num_res} at {power} dB from {now.strftime('%H:%M:%S')} until {(now + timedelta(seconds=meas_time)).strftime('%H:%M:%S')}...")
-            vna.rf_on()
-            path = vna.measure()
-            # print(f"...finished at {datetime.today().strftime('%H:%M:%S')}")
-            vna.rf_off()
-
-            fit = notch_port(spectrum_measurement.get_frequencies(), spectrum_measurement.get_data())
-            fit.autofit()
-            fit.save_fitresults(path)
-            fit.plotall(f"D:\\Measurements\\Resonators\\{operator}\\{chip}\\Res{num_res}\\{power}_{averages}avg.pdf")
-
-finally:
-    vna.rf_off()
-    print(f"Turned off VNA power. Finished at {datetime.today().strftime('%H:%M:%S, %a %d.%m.')}")
\ No newline at end of file
+    previous_fits = {}  # last fit of each resonator, used as warm start for the next power step
+    # fits and plots run in parallel to the next sweeps
+    fit_pipeline = FitPipeline(processes=fit_processes, catalog=fit_catalog)
+
+    def store_fit(record, fit):
+        """
+        Add the fit results of a record to the store as soon as the fit is finished, so an interrupted sweep keeps them
+        """
+        if isinstance(record, Future):
+            # the trace may still be written in the background, a failed write has no record
+            if not record.done():
+                record.add_done_callback(lambda written: store_fit(written, fit))
+            elif record.exception() is None:
+                store_fit(record.result(), fit)
+        elif fit.cancelled() or fit.exception() is not None:
+            print(f"fit failed: {fit.exception() if not fit.cancelled() else 'cancelled'}")
+        else:
+            store.add_fit(record, fit.result())
+
+    try:
+        for step, spectrum_measurement, path in runner.run():
+            num_res = step["resonator"]
+            if store is None and isinstance(path, Future):
+                # the fit results are named after the saved trace
+                path = path.result()
+            plot_folder = Path(f"D:\\Measurements\\Resonators\\{operator}\\{chip}\\Res{num_res}")
+            # with a store no trace is saved in the resonator folder, so it may not exist yet
+            plot_folder.mkdir(parents=True, exist_ok=True)
+            previous_fits[num_res] = fit_pipeline.submit(
+                spectrum_measurement, None if store is not None else path,
+                str(plot_folder/f"{step['power']}_{step['averages']}avg.pdf"),
+                warm_start=previous_fits.get(num_res),
+                catalog_info={"chip": chip, "resonator": num_res, "power": step["vna_power"],
+                              "attenuation": attenuation, "directory": str(plot_folder)})
+            if store is not None:
+                previous_fits[num_res].add_done_callback(lambda fit, record=path: store_fit(record, fit))
+
+    finally:
+        vna.rf_off()
+        print(f"Turned off VNA power. Finished at {datetime.today().strftime('%H:%M:%S, %a %d.%m.')}")
+        if writer is not None:
+            print(f"Waiting for {writer.pending()} remaining writes...")
+            writer.close()
+            stats = writer.stats()
+            print(f"{stats['written']} traces written in the background ({stats['failed']} failed), "
+                  f"max. queue depth {stats['max_depth']}, mean latency {stats['mean_latency']:.2f} s")
+        print(f"Waiting for {fit_pipeline.pending()} remaining fits...")
+        fit_pipeline.close()
+
+    if store is None:
+        for fitresults in fit_pipeline.results():
+            if isinstance(fitresults, Exception):
+                print(f"fit failed: {fitresults}")
\ No newline at end of file
@@ -1,6 +1,7 @@
 from PyLab.VNA import VNA
 from PyLab.Measurement import Measurement
 import PyLab.PeakFinder as PeakFinder
+from PyLab.StitchedSweep import StitchedSweep
 import matplotlib.pyplot as plt
 import numpy as np
 import pyvisa
@@ -14,7 +15,8 @@ attenuation = 0
 f_start = 1e8
 f_end = 40e9
 
-num_peaks = 11
+num_peaks = 11  # maximum number of peaks, None for all significant ones
+q_l = 1e5  # expected loaded quality factor, sets the scale of the peak search
 
 nop = 10001
 
@@ -24,37 +26,66 @@ averages = 1  # number of averages, by default 1 (i.e. no averaging)
 
 find_frequencies = False
 
+stitched = False  # measure nop points in chunks of chunk_points (e.g. 1000001 points for high-Q resonances)
+chunk_points = 20001  # points of a single sweep of the stitched spectrum, at most the point limit of the VNA
+stitched_path = rf"D:\Measurements\Resonators\{operator}\{chip}\spectrum_{f_start/1e9:.2f}-{f_end/1e9:.2f}GHz_nop{nop}"
+
 # print(pyvisa.ResourceManager().list_resources())
 # vna = VNA(address='TCPIP0::ZVA24-26-100428::inst0::INSTR')  # initiate the connection to the VNA (R&S ZVA24)
-# vna = VNA(address='TCPIP0::10.1.1.32::inst0::INSTR')
+# vna = VNA(name='PNA', address='TCPIP0::10.1.1.32::inst0::INSTR')
 vna = VNA(name='PNA', address='TCPIP0::10.1.1.32::inst0::INSTR')  # Keysight VNA
-# vna = VNA(name='PNA', address='TCPIP0::10.1.1.25::inst0::INSTR')  # R&S VNA
+# vna = VNA(name='ZVA24', address='TCPIP0::10.1.1.25::inst0::INSTR')  # R&S VNA
 print(vna.query_command("*IDN?"))
 #%% md
 
 ### Measure the whole spectrum
 
-frequencies = np.linspace(f_start, f_end, nop)
-spectrum_measurement = Measurement(operator, chip, bandwidth, power, frequencies, averages)
-# vna.run_command("CALC:PAR:SEL 'CH1_S21_1'")
-vna.set_measurement(spectrum_measurement)
-try:
-    vna.rf_on()
-    print("rf on")
-    vna.measure()
-    print("measured")
-finally:
-    vna.wait()
-    vna.rf_off()
-    print("rf off")
-
-freq = spectrum_measurement.get_frequencies()
-s21 = spectrum_measurement.get_data()
-
-if find_frequencies:
-    peaks = PeakFinder.find_peaks(freq, s21, num_peaks)
-    print(peaks)
-
-plt.figure(0)
-plt.plot(freq, np.abs(s21))
-plt.show()
\ No newline at end of file
+if stitched:
+    sweep = StitchedSweep(vna, operator, chip, f_start, f_end, nop, bandwidth, power, averages, chunk_points)
+    try:
+        vna.rf_on()
+        print("rf on")
+        # the chunks go to disk and to the peak finder while the next one is measured
+        peaks = sweep.run(stitched_path, q_l)
+        print("measured")
+    finally:
+        vna.wait()
+        vna.rf_off()
+        print("rf off")
+    for fr, ql, depth in zip(peaks["fr"], peaks["Ql"], peaks["depth"]):
+        print(f"{fr:.0f} Hz, Ql ~ {ql:.0f}, depth {depth:.2f}")
+    print([int(fr) for fr in peaks["fr"]])
+
+    freq, s21, info = StitchedSweep.load(stitched_path)
+    # every 100th point is plenty for the overview plot
+    plt.figure(0)
+    plt.plot(freq[::100], np.abs(s21[::100]))
+    plt.show()
+
+else:
+    frequencies = np.linspace(f_start, f_end, nop)
+    spectrum_measurement = Measurement(operator, chip, bandwidth, power, frequencies, averages)
+    # vna.run_command("CALC:PAR:SEL 'CH1_S21_1'")
+    vna.set_measurement(spectrum_measurement)
+    try:
+        vna.rf_on()
+        print("rf on")
+        vna.measure()
+        print("measured")
+    finally:
+        vna.wait()
+        vna.rf_off()
+        print("rf off")
+
+    freq = spectrum_measurement.get_frequencies()
+    s21 = spectrum_measurement.get_data()
+
+    if find_frequencies:
+        peaks = PeakFinder.get_peaks(freq, s21, num_peaks, q_l)
+        for fr, ql, depth in zip(peaks["fr"], peaks["Ql"], peaks["depth"]):
+            print(f"{fr:.0f} Hz, Ql ~ {ql:.0f}, depth {depth:.2f}")
+        print([int(fr) for fr in peaks["fr"]])
+
+    plt.figure(0)
+    plt.plot(freq, np.abs(s21))
+    plt.show()
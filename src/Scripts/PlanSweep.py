@@ -0,0 +1,35 @@
+from PyLab.SweepPlanner import SweepTimeModel, SweepPlanner, estimate_time
+from PyLab.SweepRunner import SweepPlan
+from datetime import timedelta
+
+powers = list(range(-70, -151, -5))  # powers at the chip in dBm
+target_snr = 30  # SNR of the resonance, see SweepPlanner.get_snr
+# target_snr = SweepPlanner.snr_for_qi_error(0.02, Ql_over_Qc=0.5)  # or from a target relative error of Qi
+attenuation = -72  # complete attenuation in input line (without VNA power)
+noise_floor = -170  # noise power density of the chain at the chip in dBm/Hz
+fr = 6.189e9  # resonance frequency in Hz
+Ql = 1e5  # expected loaded quality factor
+span = 3e5  # span with f0 in center
+n_resonators = 1  # number of resonators measured at each power
+
+sweep_time_model = None  # JSON file of a calibrated SweepTimeModel (see SweepTimeModel.calibrate), None: typical VNA
+
+###################
+#
+# CORE
+#
+###################
+
+# nothing in here talks to the instrument
+model = SweepTimeModel() if sweep_time_model is None else SweepTimeModel.load(sweep_time_model)
+planner = SweepPlanner(model, noise_floor, fr, Ql, span)
+steps = planner.plan(powers, target_snr)
+
+print(f"{'power':>6} {'VNA power':>10} {'bandwidth':>10} {'averages':>9} {'nop':>6} {'SNR':>7} {'time':>10}")
+for power, bandwidth, averages, nop in steps:
+    duration = model.get_measurement_time(nop, bandwidth, averages)*n_resonators
+    print(f"{power:>6} {power - attenuation:>10} {bandwidth:>10g} {averages:>9} {nop:>6} "
+          f"{planner.get_snr(power, nop, bandwidth, averages):>7.1f} {str(timedelta(seconds=round(duration))):>10}")
+
+plan = SweepPlan("planner", "none", {i: fr for i in range(n_resonators)}, steps, span=span, attenuation=attenuation)
+print(f"total runtime: {timedelta(seconds=round(estimate_time(plan, model)))} h:m:s")
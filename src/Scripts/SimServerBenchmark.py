@@ -0,0 +1,57 @@
+import numpy as np
+import time
+from PyLab.SimSCPIServer import SimSCPIServer
+from PyLab.VNA import VNA
+from PyLab.Measurement import Measurement
+from PyLab.CircleFit import notch_port
+
+drivers = ["PNA", "ZVA24"]  # VNA frontend names, PNA for the Keysight driver, otherwise the R&S driver
+data_formats = ["ASCII", "REAL,64", "REAL,32"]
+completions = ["poll", "opc"]  # srq needs service requests, which raw sockets don't have
+time_scale = 0.02  # factor on the simulated sweep times
+nop = 1001
+bandwidth = 1000
+check_bandwidth = 1200  # not available on the instrument, it is rounded (to 1 kHz)
+repetitions = 5  # measurements per configuration
+
+###################
+#
+# CORE
+#
+###################
+
+with SimSCPIServer(port=0, time_scale=time_scale) as server:
+    f_r = server.instrument._sim.get_resonators()["f_r"][0]
+    frequencies = np.linspace(f_r - 5e5, f_r + 5e5, nop)
+    print(f"simulated VNA at {server.address}")
+    print(f"{'driver':>6} {'format':>8} {'completion':>10} {'sweep (ms)':>11} {'total (ms)':>11} {'overhead (ms)':>14} "
+          f"{'fr error (Hz)':>14}")
+
+    for name in drivers:
+        vna = VNA(name=name, address=server.address)
+        # a repeated setup after a measurement must not send any setting, even with a rounded bandwidth
+        measurement = Measurement("benchmark", "sim", check_bandwidth, -20, frequencies)
+        vna.set_measurement(measurement)
+        vna.measure(save=False)
+        writes, messages = server.instrument.writes, server.instrument.messages
+        vna.set_measurement(measurement)
+        if server.instrument.writes != writes:
+            raise RuntimeError(f"{name}: repeated setup sent {server.instrument.writes - writes} command(s)")
+        print(f"{name:>6}: repeated setup sent no command ({server.instrument.messages - messages} message(s))")
+
+        for data_format in data_formats:
+            for completion in completions:
+                vna.pna.data_format = data_format
+                vna.pna.set_completion(completion)
+                measurement = Measurement("benchmark", "sim", bandwidth, -20, frequencies)
+                start = time.perf_counter()
+                for i in range(repetitions):
+                    vna.set_measurement(measurement)
+                    vna.measure(save=False)
+                total = (time.perf_counter() - start) / repetitions
+                sweep_time = server.instrument.get_sweep_time()
+
+                fit = notch_port(frequencies, np.asarray(measurement.get_data()))
+                fit.autofit(calc_errors=False)
+                print(f"{name:>6} {data_format:>8} {completion:>10} {sweep_time*1e3:>11.1f} {total*1e3:>11.1f} "
+                      f"{(total - sweep_time)*1e3:>14.1f} {fit.fitresults['fr'] - f_r:>14.1f}")